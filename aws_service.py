@@ -1,157 +1,727 @@
-from typing import Optional, List
-from botocore.exceptions import ClientError
-import boto3
-import os
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+from typing import TYPE_CHECKING, Dict, Optional, List, Tuple
+from botocore.exceptions import BotoCoreError, ClientError
+import jmespath
 import logging
-from datetime import datetime
-from mypy_boto3_autoscaling import AutoScalingClient
-from mypy_boto3_s3 import S3Client
-from stackguardian_autoscaler import CloudService, SGRunner
+import threading
+import time
+from datetime import datetime, timedelta, timezone
 
+import metrics
+import rate_limit
+from rate_limit import DeferredError, ThrottledError
+from stackguardian_autoscaler import CloudService, InventoryJoin, SGRunner
+from state_store import AutoscalerState, StateConflictError, StateStore
 
-class AwsService(CloudService):
-    def __init__(self):
-        self.asg_client: AutoScalingClient = boto3.client("autoscaling")
-        self.s3_client: S3Client = boto3.client("s3")
-        self.ec2_client = boto3.client("ec2")
-
-        self.ASG_NAME = os.getenv("AWS_ASG_NAME")
-        self.BUCKET_NAME = os.getenv("AWS_BUCKET_NAME")
-        self.SCALE_IN_TIMESTAMP_OBJECT_NAME = os.getenv(
-            "SCALE_IN_TIMESTAMP_BLOB_NAME"
-        )
-        self.SCALE_OUT_TIMESTAMP_OBJECT_NAME = os.getenv(
-            "SCALE_OUT_TIMESTAMP_BLOB_NAME"
-        )
+if TYPE_CHECKING:
+    from mypy_boto3_autoscaling import AutoScalingClient
+    from mypy_boto3_s3 import S3Client
 
-        self.asg_vms = self._get_vms_in_asg()
+_clients: Dict[str, object] = {}
+_clients_lock = threading.Lock()
 
-    def _get_vms_in_asg(self) -> Optional[List[dict]]:
-        # Describe the Auto Scaling Group and get the instances
-        response = self.asg_client.describe_auto_scaling_groups(
-            AutoScalingGroupNames=[self.ASG_NAME]
-        )
 
-        # Extracting instances
-        if response["AutoScalingGroups"]:
-            asg = response["AutoScalingGroups"][0]
-            asg_instances = asg["Instances"]
+def get_client(service_name: str):
+    """
+    boto3 clients shared by everything in the process. Clients are thread
+    safe and refresh their own credentials, so they are created on first use
+    and kept for the lifetime of a warm Lambda container.
+    """
+    with _clients_lock:
+        if service_name not in _clients:
+            # boto3 takes a good part of the cold start to import
+            import boto3
 
-            instance_ids = []
-            for asg_instance in asg_instances:
-                instance_ids.append(asg_instance["InstanceId"])
+            _clients[service_name] = boto3.client(service_name)
+        return _clients[service_name]
+
+
+# error codes AWS APIs throttle with
+THROTTLING_ERROR_CODES = frozenset(
+    {
+        "Throttling",
+        "ThrottlingException",
+        "RequestLimitExceeded",
+        "TooManyRequestsException",
+    }
+)
+
+
+# found in the status message of a scaling activity that could not launch
+# instances for lack of capacity
+CAPACITY_ERROR_CODES = (
+    "InsufficientInstanceCapacity",
+    "SpotMaxPriceTooLow",
+    "MaxSpotInstanceCountExceeded",
+    "VcpuLimitExceeded",
+)
+
+
+def _throttled(service: str, call: str, e: ClientError) -> ClientError:
+    """
+    The error to raise for a failed call, ThrottledError when botocore's
+    retries did not get the call past throttling
+    """
+    if e.response.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES:
+        rate_limit.throttled(service)
+        return ThrottledError(f"{service} {call} was throttled: {e}")
+    return e
 
-            if len(instance_ids) == 0:
-                return None
 
-            response = self.ec2_client.describe_instances(
-                InstanceIds=instance_ids
+def _call(service: str, method, **kwargs) -> dict:
+    """
+    Calls a boto3 client method within the service's rate limit, recording
+    its duration and the retries botocore made
+    """
+    call = method.__name__
+    rate_limit.acquire(service)
+    try:
+        with metrics.span("api_call", service=service, call=call):
+            response = method(**kwargs)
+    except ClientError as e:
+        raise _throttled(service, call, e) from e
+    rate_limit.succeeded(service)
+    retries = response.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+    if retries:
+        metrics.increment("api_retries", retries, service=service, call=call)
+    return response
+
+
+def _search(
+    service: str, client, operation: str, expression: str, **kwargs
+) -> List:
+    """
+    Runs a paginated operation and returns the JMESPath projection of all
+    of its pages, keeping only the fields that are used. Every page is
+    recorded as a call, the rate limit is taken once for all of them.
+    """
+    paginator = client.get_paginator(operation)
+    results = []
+    rate_limit.acquire(service)
+    start = time.perf_counter()
+    try:
+        for page in paginator.paginate(**kwargs):
+            metrics.observe(
+                "api_call",
+                time.perf_counter() - start,
+                service=service,
+                call=operation,
             )
+            rate_limit.succeeded(service)
+            retries = page.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+            if retries:
+                metrics.increment(
+                    "api_retries", retries, service=service, call=operation
+                )
+            results.extend(jmespath.search(expression, page) or [])
+            start = time.perf_counter()
+    except ClientError as e:
+        raise _throttled(service, operation, e) from e
+    return results
 
-            if not response:
-                return None
 
-            instances = []
-            for reservation in response["Reservations"]:
-                for instance in reservation["Instances"]:
-                    instances.append(instance)
+class S3StateStore(StateStore):
+    def __init__(
+        self,
+        s3_client: Optional["S3Client"],
+        bucket_name: str,
+        object_name: str,
+        legacy_scale_out_object_name: Optional[str] = None,
+        legacy_scale_in_object_name: Optional[str] = None,
+    ):
+        super().__init__(f"s3://{bucket_name}/{object_name}")
+        self._s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.object_name = object_name
+        self.legacy_scale_out_object_name = legacy_scale_out_object_name
+        self.legacy_scale_in_object_name = legacy_scale_in_object_name
 
-            return instances
-        else:
-            print(f"Auto Scaling Group '{self.ASG_NAME}' not found.")
-            return []
+    @property
+    def s3_client(self) -> "S3Client":
+        if self._s3_client is None:
+            self._s3_client = get_client("s3")
+        return self._s3_client
 
-    def _fetch_s3_blob(self, bucket_name, object_name):
+    def _read(
+        self, etag: Optional[str]
+    ) -> Tuple[Optional[str], Optional[str]]:
+        conditions = {"IfNoneMatch": etag} if etag else {}
         try:
             response = self.s3_client.get_object(
-                Bucket=bucket_name, Key=object_name
+                Bucket=self.bucket_name, Key=self.object_name, **conditions
+            )
+        except ClientError as e:
+            code = e.response["Error"]["Code"]
+            if code in ("304", "NotModified"):
+                return None, etag
+            if code == "NoSuchKey":
+                return None, None
+            raise e
+
+        return response["Body"].read().decode("utf-8"), response["ETag"]
+
+    def _write(self, content: str, etag: Optional[str]) -> str:
+        conditions = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+        try:
+            response = self.s3_client.put_object(
+                Bucket=self.bucket_name,
+                Key=self.object_name,
+                Body=content.encode("utf-8"),
+                ContentType="application/json",
+                **conditions,
+            )
+        except ClientError as e:
+            code = e.response["Error"]["Code"]
+            if code in ("PreconditionFailed", "ConditionalRequestConflict"):
+                raise StateConflictError(str(e)) from e
+            raise e
+
+        return response["ETag"]
+
+    def _lease_store(self) -> "S3StateStore":
+        return S3StateStore(
+            self._s3_client, self.bucket_name, f"{self.object_name}.lease"
+        )
+
+    def _read_legacy(self) -> Optional[AutoscalerState]:
+        if not (
+            self.legacy_scale_out_object_name
+            or self.legacy_scale_in_object_name
+        ):
+            return None
+
+        logging.info("STACKGUARDIAN: seeding state from timestamp objects")
+        return AutoscalerState(
+            last_scale_out_event=self._read_legacy_timestamp(
+                self.legacy_scale_out_object_name
+            ),
+            last_scale_in_event=self._read_legacy_timestamp(
+                self.legacy_scale_in_object_name
+            ),
+        )
+
+    def _read_legacy_timestamp(
+        self, object_name: Optional[str]
+    ) -> Optional[datetime]:
+        if not object_name:
+            return None
+        try:
+            response = self.s3_client.get_object(
+                Bucket=self.bucket_name, Key=object_name
             )
-            if response["ResponseMetadata"]["HTTPStatusCode"] == 200:
-                return response["Body"].read()
         except ClientError as e:
             if e.response["Error"]["Code"] == "NoSuchKey":
                 return None
-        except Exception as e:
-            print(f"Error fetching S3 object: {e}")
-            return None
+            raise e
 
-    def get_last_scale_out_event(self) -> Optional[datetime]:
-        logging.info("STACKGUARDIAN: get last scale out event")
-        # Fetch the scale-out timestamp from S3
-        blob_content = self._fetch_s3_blob(
+        return datetime.fromisoformat(response["Body"].read().decode("utf-8"))
+
+
+class AwsService(CloudService):
+    # set_instance_protection accepts at most 50 instance ids per call
+    PROTECTION_BATCH_SIZE = 50
+    # terminate_instance_in_auto_scaling_group takes a single instance, the
+    # calls for several runners are made concurrently
+    TERMINATE_CONCURRENCY = 8
+    # ASG lifecycle states of instances that count towards the capacity
+    LIVE_LIFECYCLE_STATES = frozenset(
+        {
+            "Pending",
+            "Pending:Wait",
+            "Pending:Proceed",
+            "InService",
+        }
+    )
+
+    def __init__(self, settings: Optional[Dict[str, str]] = None):
+        self.settings = settings
+        self.ASG_NAME = self._getenv("AWS_ASG_NAME")
+        self.BUCKET_NAME = self._getenv("AWS_BUCKET_NAME")
+        self.SCALE_IN_TIMESTAMP_OBJECT_NAME = self._getenv(
+            "SCALE_IN_TIMESTAMP_BLOB_NAME"
+        )
+        self.SCALE_OUT_TIMESTAMP_OBJECT_NAME = self._getenv(
+            "SCALE_OUT_TIMESTAMP_BLOB_NAME"
+        )
+        self.STATE_OBJECT_NAME = self._getenv(
+            "AUTOSCALER_STATE_BLOB_NAME", "stackguardian-autoscaler-state.json"
+        )
+        # Stopped, Hibernated or Running, for warm pool instances
+        self.STANDBY_POOL_STATE = self._getenv("STANDBY_POOL_STATE", "Stopped")
+        # desired capacity the ASG has not launched for this long counts as
+        # unfulfilled, shorter gaps are launches still in progress
+        self.launch_grace = timedelta(
+            minutes=float(self._getenv("LAUNCH_GRACE_MINUTES", "5"))
+        )
+
+        self.state_store = S3StateStore(
+            None,
             self.BUCKET_NAME,
-            self.SCALE_OUT_TIMESTAMP_OBJECT_NAME,
+            self.STATE_OBJECT_NAME,
+            legacy_scale_out_object_name=self.SCALE_OUT_TIMESTAMP_OBJECT_NAME,
+            legacy_scale_in_object_name=self.SCALE_IN_TIMESTAMP_OBJECT_NAME,
         )
 
-        if not blob_content:
-            return None
+        # ProtectedFromScaleIn by InstanceId, as reported by the ASG
+        self.asg_protection: Dict[str, bool] = {}
+        self.asg_desired_capacity = 0
+        # instances in the warm pool and its configured size, None without
+        # a warm pool
+        self.warm_pool_size = 0
+        self.warm_pool_min_size: Optional[int] = None
+        # InstanceId, PrivateDnsName and PrivateIpAddress of live instances
+        self.asg_vms: List[dict] = []
+        # instances by PrivateDnsName and by PrivateIpAddress
+        self.asg_vm_index: Dict[str, dict] = {}
+        # the inventory is fetched on first use in every tick, or reused
+        # from an earlier tick for INVENTORY_TTL_SECONDS, see daemon.py
+        self._asg_vms_loaded = False
+        self.inventory_ttl = float(self._getenv("INVENTORY_TTL_SECONDS", "0"))
+        # monotonic time the inventory was read, None once this process
+        # changed the ASG
+        self._asg_vms_read_at: Optional[float] = None
+        # whether the inventory of this tick was read by an earlier tick
+        self._asg_vms_cached = False
+
+    @property
+    def asg_client(self) -> "AutoScalingClient":
+        return get_client("autoscaling")
+
+    @property
+    def s3_client(self) -> "S3Client":
+        return get_client("s3")
 
-        last_scale_out_timestamp = datetime.fromisoformat(
-            blob_content.decode("utf-8")
+    @property
+    def ec2_client(self):
+        return get_client("ec2")
+
+    def refresh(self):
+        super().refresh()
+        self._asg_vms_cached = self._inventory_is_fresh()
+        self._asg_vms_loaded = self._asg_vms_cached
+
+    def _inventory_is_fresh(self) -> bool:
+        """
+        Whether the inventory read by an earlier tick can be used again. It
+        is younger than INVENTORY_TTL_SECONDS, this process did not change
+        the ASG since and the desired capacity saved by the other
+        invocations is the one it was read with.
+        """
+        if self._asg_vms_read_at is None:
+            return False
+        if time.monotonic() - self._asg_vms_read_at >= self.inventory_ttl:
+            return False
+        last_desired_capacity = self.state_store.get().last_desired_capacity
+        return last_desired_capacity in (None, self.asg_desired_capacity)
+
+    def _ensure_asg_vms(self):
+        if not self._asg_vms_loaded:
+            self._refresh_asg_vms()
+
+    def _refresh_asg_vms(self):
+        """
+        Reads the ASG and its instances once per tick. Our own changes
+        during the tick are applied to this copy instead of describing the
+        ASG again.
+        """
+        asg = self._describe_asg()
+        if asg is None:
+            logging.info(
+                f"STACKGUARDIAN: Auto Scaling Group '{self.ASG_NAME}' not found."
+            )
+            asg = {"DesiredCapacity": 0, "Instances": []}
+
+        self.asg_desired_capacity = asg["DesiredCapacity"]
+        self.warm_pool_size = asg.get("WarmPoolSize") or 0
+        self.warm_pool_min_size = asg.get("WarmPoolMinSize")
+        asg_protection = {}
+        for asg_instance in asg["Instances"] or []:
+            # instances on their way out no longer count or get matched
+            if asg_instance["LifecycleState"] in self.LIVE_LIFECYCLE_STATES:
+                asg_protection[asg_instance["InstanceId"]] = bool(
+                    asg_instance["ProtectedFromScaleIn"]
+                )
+        self.asg_protection = asg_protection
+
+        self.asg_vms = [
+            instance
+            for instance in self._describe_instances()
+            if instance["InstanceId"] in asg_protection
+        ]
+        self._asg_vms_loaded = True
+        self._asg_vms_read_at = time.monotonic()
+        self._asg_vms_cached = False
+
+        asg_vm_index = {}
+        for instance in self.asg_vms:
+            for key in ("PrivateDnsName", "PrivateIpAddress"):
+                if instance.get(key):
+                    asg_vm_index[instance[key]] = instance
+        self.asg_vm_index = asg_vm_index
+
+    def _describe_asg(self) -> Optional[dict]:
+        asgs = _search(
+            "asg",
+            self.asg_client,
+            "describe_auto_scaling_groups",
+            "AutoScalingGroups[].{DesiredCapacity: DesiredCapacity,"
+            " WarmPoolSize: WarmPoolSize,"
+            " WarmPoolMinSize: WarmPoolConfiguration.MinSize,"
+            " Instances: Instances[].{InstanceId: InstanceId,"
+            " LifecycleState: LifecycleState,"
+            " ProtectedFromScaleIn: ProtectedFromScaleIn}}",
+            AutoScalingGroupNames=[self.ASG_NAME],
         )
-        return last_scale_out_timestamp
+        return asgs[0] if asgs else None
 
-    def set_last_scale_out_event(self, timestamp) -> Optional[datetime]:
+    def _describe_instances(self) -> List[dict]:
+        # filtered by the tag the ASG puts on its instances rather than by
+        # instance ids, so the request stays small and can be paginated
+        return _search(
+            "ec2",
+            self.ec2_client,
+            "describe_instances",
+            "Reservations[].Instances[].{InstanceId: InstanceId,"
+            " PrivateDnsName: PrivateDnsName,"
+            " PrivateIpAddress: PrivateIpAddress}",
+            Filters=[
+                {
+                    "Name": "tag:aws:autoscaling:groupName",
+                    "Values": [self.ASG_NAME],
+                },
+                {
+                    "Name": "instance-state-name",
+                    "Values": ["pending", "running"],
+                },
+            ],
+            PaginationConfig={"PageSize": 1000},
+        )
+
+    def get_last_scale_out_event(self) -> Optional[datetime]:
+        logging.info("STACKGUARDIAN: get last scale out event")
+        return self.state_store.get().last_scale_out_event
+
+    def set_last_scale_out_event(self, timestamp):
         logging.info("STACKGUARDIAN: set last scale out event")
-        self.s3_client.put_object(
-            Bucket=self.BUCKET_NAME,
-            Key=self.SCALE_OUT_TIMESTAMP_OBJECT_NAME,
-            Body=datetime.isoformat(timestamp),
+        self.state_store.save(
+            last_scale_out_event=timestamp, last_action="scale_out"
         )
 
     def set_autoscale_vms(self, count_of_vms: int):
-        _ = self.asg_client.set_desired_capacity(
+        _ = _call(
+            "asg",
+            self.asg_client.set_desired_capacity,
             AutoScalingGroupName=self.ASG_NAME,
             DesiredCapacity=count_of_vms,
         )
+        self.asg_desired_capacity = count_of_vms
+        self.state_store.update(last_desired_capacity=count_of_vms)
+        # the next tick sees the instances launched for it
+        self._asg_vms_read_at = None
 
     def get_last_scale_in_event(self) -> Optional[datetime]:
         logging.info("STACKGUARDIAN: get last scale in event")
-        # Fetch the scale-in timestamp from S3
-        blob_content = self._fetch_s3_blob(
-            self.BUCKET_NAME,
-            self.SCALE_IN_TIMESTAMP_OBJECT_NAME,
-        )
-
-        if not blob_content:
-            return None
-
-        last_scale_in_timestamp = datetime.fromisoformat(
-            blob_content.decode("utf-8")
-        )
-        return last_scale_in_timestamp
+        return self.state_store.get().last_scale_in_event
 
     def set_last_scale_in_event(self, timestamp):
         logging.info("STACKGUARDIAN: set last scale in event")
-        self.s3_client.put_object(
-            Bucket=self.BUCKET_NAME,
-            Key=self.SCALE_IN_TIMESTAMP_OBJECT_NAME,
-            Body=datetime.isoformat(timestamp),
+        self.state_store.save(
+            last_scale_in_event=timestamp, last_action="scale_in"
         )
 
     def _find_aws_vm(self, sg_runner: SGRunner) -> Optional[dict]:
-        for instance in self.asg_vms:
-            if sg_runner.computer_name == instance["PrivateDnsName"]:
-                return instance
+        self._ensure_asg_vms()
+        instance = self._lookup_aws_vm(sg_runner)
+        if instance is None and self._asg_vms_cached:
+            # e.g. the runner of an instance launched since the inventory
+            # was read
+            self._refresh_asg_vms()
+            instance = self._lookup_aws_vm(sg_runner)
+        return instance
+
+    def _lookup_aws_vm(self, sg_runner: SGRunner) -> Optional[dict]:
+        instance = self.asg_vm_index.get(sg_runner.computer_name)
+        if instance is None and sg_runner.ip_address:
+            instance = self.asg_vm_index.get(sg_runner.ip_address)
+        return instance
+
+    def get_unmatched_runners(
+        self, sg_runners: List[SGRunner]
+    ) -> List[SGRunner]:
+        return [
+            sg_runner
+            for sg_runner in sg_runners
+            if self._find_aws_vm(sg_runner) is None
+        ]
 
     def add_scale_in_protection(self, sg_runner):
-        instance = self._find_aws_vm(sg_runner)
+        self._set_scale_in_protection([sg_runner], True)
 
-        _ = self.asg_client.set_instance_protection(
-            AutoScalingGroupName=self.ASG_NAME,
-            InstanceIds=[instance["InstanceId"]],
-            ProtectedFromScaleIn=True,
+    def remove_scale_in_protection(self, sg_runner):
+        self._set_scale_in_protection([sg_runner], False)
+
+    def add_scale_in_protection_bulk(self, sg_runners: List[SGRunner]):
+        self._set_scale_in_protection(sg_runners, True)
+
+    def remove_scale_in_protection_bulk(self, sg_runners: List[SGRunner]):
+        self._set_scale_in_protection(sg_runners, False)
+
+    def _set_scale_in_protection(
+        self, sg_runners: List[SGRunner], protected: bool
+    ):
+        """
+        Sets scale in protection in batches, skipping instances that are
+        already in the wanted state according to the last ASG describe.
+        """
+        self._ensure_asg_vms()
+        instance_ids = []
+        for sg_runner in sg_runners:
+            instance = self._find_aws_vm(sg_runner)
+            if instance is None:
+                logging.info(
+                    f"STACKGUARDIAN: no ASG instance found for runner {sg_runner.computer_name}"
+                )
+                continue
+            instance_id = instance["InstanceId"]
+            if self.asg_protection.get(instance_id) != protected:
+                instance_ids.append(instance_id)
+
+        for i in range(0, len(instance_ids), self.PROTECTION_BATCH_SIZE):
+            batch = instance_ids[i : i + self.PROTECTION_BATCH_SIZE]
+            logging.info(
+                f"STACKGUARDIAN: set scale in protection {protected} for {batch}"
+            )
+            try:
+                _ = _call(
+                    "asg",
+                    self.asg_client.set_instance_protection,
+                    AutoScalingGroupName=self.ASG_NAME,
+                    InstanceIds=batch,
+                    ProtectedFromScaleIn=protected,
+                )
+            except DeferredError as e:
+                # the next tick finds them in the old state again
+                logging.info(
+                    f"STACKGUARDIAN: deferred scale in protection of {len(instance_ids) - i} instances: {e}"
+                )
+                metrics.increment(
+                    "actions_deferred",
+                    len(instance_ids) - i,
+                    action="set_protection",
+                )
+                return
+            for instance_id in batch:
+                self.asg_protection[instance_id] = protected
+
+    def join_inventory(self, sg_runners: List[SGRunner]) -> InventoryJoin:
+        self._ensure_asg_vms()
+        join = InventoryJoin()
+        matched = set()
+        for sg_runner in sg_runners:
+            instance = self._find_aws_vm(sg_runner)
+            if instance is None:
+                join.ghost_runners.append(sg_runner)
+            else:
+                matched.add(instance["InstanceId"])
+        # warm pool instances are not in the ASG's instances
+        join.orphan_vms = [
+            instance["InstanceId"]
+            for instance in self.asg_vms
+            if instance["InstanceId"] not in matched
+        ]
+        return join
+
+    def terminate_runner_vms(self, sg_runners: List[SGRunner]) -> int:
+        """
+        Terminates exactly the runners' instances, decrementing the desired
+        capacity with each of them. The ASG terminates them in the
+        background, this does not wait for it.
+        """
+        instance_ids = []
+        for sg_runner in sg_runners:
+            instance = self._find_aws_vm(sg_runner)
+            if instance is None:
+                logging.info(
+                    f"STACKGUARDIAN: no ASG instance found for runner {sg_runner.computer_name}"
+                )
+                continue
+            instance_ids.append(instance["InstanceId"])
+        return self._terminate_instances(instance_ids)
+
+    def terminate_orphan_vms(self, vm_ids: List[str]) -> int:
+        self._ensure_asg_vms()
+        # e.g. deferred terminations of instances that are gone since
+        return self._terminate_instances(
+            [
+                instance_id
+                for instance_id in vm_ids
+                if instance_id in self.asg_protection
+            ]
         )
 
-    def remove_scale_in_protection(self, sg_runner):
-        instance = self._find_aws_vm(sg_runner)
+    def _terminate_instances(self, instance_ids: List[str]) -> int:
+        if len(instance_ids) == 0:
+            return 0
 
-        _ = self.asg_client.set_instance_protection(
-            AutoScalingGroupName=self.ASG_NAME,
-            InstanceIds=[instance["InstanceId"]],
-            ProtectedFromScaleIn=False,
+        def terminate(instance_id: str):
+            logging.info(f"STACKGUARDIAN: terminating instance {instance_id}")
+            _call(
+                "asg",
+                self.asg_client.terminate_instance_in_auto_scaling_group,
+                InstanceId=instance_id,
+                ShouldDecrementDesiredCapacity=True,
+            )
+
+        terminated = []
+        deferred = []
+        max_workers = min(self.TERMINATE_CONCURRENCY, len(instance_ids))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                (
+                    instance_id,
+                    executor.submit(
+                        contextvars.copy_context().run, terminate, instance_id
+                    ),
+                )
+                for instance_id in instance_ids
+            ]
+            for instance_id, future in futures:
+                try:
+                    future.result()
+                    terminated.append(instance_id)
+                except DeferredError:
+                    deferred.append(instance_id)
+                except (ClientError, BotoCoreError) as e:
+                    # e.g. the desired capacity would drop below MinSize
+                    logging.info(
+                        f"STACKGUARDIAN: terminating instance {instance_id} failed: {e}"
+                    )
+
+        self.defer_terminations(deferred)
+        self._forget_instances(set(terminated))
+        if len(terminated) > 0:
+            self._asg_vms_read_at = None
+        self.asg_desired_capacity -= len(terminated)
+        self.state_store.update(
+            last_desired_capacity=self.asg_desired_capacity
         )
+        return len(terminated)
+
+    def _forget_instances(self, instance_ids: set):
+        """Drops terminated instances from the inventory of this tick"""
+        self.asg_vms = [
+            instance
+            for instance in self.asg_vms
+            if instance["InstanceId"] not in instance_ids
+        ]
+        self.asg_vm_index = {
+            key: instance
+            for key, instance in self.asg_vm_index.items()
+            if instance["InstanceId"] not in instance_ids
+        }
+        for instance_id in instance_ids:
+            self.asg_protection.pop(instance_id, None)
 
     def count_of_existing_vms(self) -> Optional[int]:
-        instances = self._get_vms_in_asg()
-        return len(instances) if instances else 0
+        self._ensure_asg_vms()
+        return self.asg_desired_capacity
+
+    def count_of_unfulfilled_vms(self) -> int:
+        """
+        Desired capacity without a live instance, e.g. while the ASG cannot
+        get spot capacity and keeps retrying the launch. A gap only counts
+        once a scaling activity failed for lack of capacity or it lasted
+        for LAUNCH_GRACE_MINUTES, before that the ASG may still be
+        launching or replacing instances.
+        """
+        self._ensure_asg_vms()
+        gap = max(0, self.asg_desired_capacity - len(self.asg_protection))
+        if gap > 0 and self._asg_vms_cached:
+            # instances launched since the inventory was read close it
+            self._refresh_asg_vms()
+            gap = max(0, self.asg_desired_capacity - len(self.asg_protection))
+        gap_since = self.state_store.get().capacity_gap_since
+        if gap == 0:
+            if gap_since is not None:
+                self.state_store.update(capacity_gap_since=None)
+            return 0
+
+        now = datetime.now(timezone.utc)
+        if gap_since is None:
+            gap_since = now
+            self.state_store.update(capacity_gap_since=gap_since)
+        if now - gap_since >= self.launch_grace:
+            return gap
+        if self._launch_failed_for_capacity(now - self.launch_grace):
+            return gap
+        return 0
+
+    def _launch_failed_for_capacity(self, since: datetime) -> bool:
+        """Whether a scaling activity since then failed for capacity"""
+        activities = _call(
+            "asg",
+            self.asg_client.describe_scaling_activities,
+            AutoScalingGroupName=self.ASG_NAME,
+            MaxRecords=10,
+        )["Activities"]
+        for activity in activities:
+            if activity["StartTime"] < since:
+                continue
+            if activity["StatusCode"] not in ("Failed", "Cancelled"):
+                continue
+            message = activity.get("StatusMessage") or ""
+            if any(code in message for code in CAPACITY_ERROR_CODES):
+                logging.info(
+                    f"STACKGUARDIAN: ASG {self.ASG_NAME} could not launch: {message}"
+                )
+                return True
+        return False
+
+    def count_of_standby_vms(self) -> int:
+        self._ensure_asg_vms()
+        return self.warm_pool_size
+
+    def resume_standby_vms(self, count: int) -> int:
+        """
+        The ASG takes instances from its warm pool before launching new
+        ones, raising the desired capacity resumes them
+        """
+        resumed = min(count, self.count_of_standby_vms())
+        if resumed > 0:
+            self.set_autoscale_vms(self.asg_desired_capacity + resumed)
+            self.warm_pool_size -= resumed
+        return resumed
+
+    def set_standby_pool_size(self, size: int):
+        """
+        Keeps size instances in the ASG's warm pool, creating the pool when
+        there is none. The ASG refills it by launching instances.
+        """
+        self._ensure_asg_vms()
+        if size == (self.warm_pool_min_size or 0):
+            return
+        logging.info(f"STACKGUARDIAN: set warm pool size to {size}")
+        try:
+            # with MaxGroupPreparedCapacity no larger than MinSize the warm
+            # pool holds MinSize instances whatever the desired capacity
+            _call(
+                "asg",
+                self.asg_client.put_warm_pool,
+                AutoScalingGroupName=self.ASG_NAME,
+                MinSize=size,
+                MaxGroupPreparedCapacity=size,
+                PoolState=self.STANDBY_POOL_STATE,
+            )
+        except (ClientError, BotoCoreError) as e:
+            # scaling out only gets slower
+            logging.info(f"STACKGUARDIAN: updating the warm pool failed: {e}")
+            return
+        except DeferredError as e:
+            logging.info(
+                f"STACKGUARDIAN: updating the warm pool deferred: {e}"
+            )
+            metrics.increment("actions_deferred", action="standby_pool")
+            return
+        self.warm_pool_min_size = size
+        self._asg_vms_read_at = None
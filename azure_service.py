@@ -1,108 +1,495 @@
+import contextvars
 import datetime
-import os
-import io
 import logging
-from typing import List
-
-from azure.core.exceptions import ResourceNotFoundError
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from azure.core import MatchConditions
+from azure.core.exceptions import (
+    HttpResponseError,
+    ResourceExistsError,
+    ResourceModifiedError,
+    ResourceNotFoundError,
+    ResourceNotModifiedError,
+)
 
-from azure.identity import DefaultAzureCredential
 from azure.core.exceptions import AzureError
 from azure.core.polling import LROPoller
-from azure.mgmt.compute import ComputeManagementClient
-from azure.mgmt.compute.v2023_09_01.models import (
-    VirtualMachineScaleSetVM,
-    VirtualMachineScaleSet,
-    VirtualMachineScaleSetVMProtectionPolicy,
+
+import metrics
+import rate_limit
+from rate_limit import DeferredError, ThrottledError
+from stackguardian_autoscaler import CloudService, InventoryJoin, SGRunner
+from state_store import AutoscalerState, StateConflictError, StateStore
+
+if TYPE_CHECKING:
+    from azure.identity import DefaultAzureCredential
+    from azure.mgmt.compute import ComputeManagementClient
+    from azure.mgmt.compute.v2023_09_01.models import (
+        VirtualMachineScaleSetVM,
+        VirtualMachineScaleSet,
+    )
+    from azure.storage.blob import ContainerClient
+
+# Clients shared by everything in the process. They are created on first use,
+# so a tick only imports the SDKs it needs, and kept for the lifetime of a
+# warm Function host. DefaultAzureCredential caches its tokens and refreshes
+# them before they expire, so it is safe to keep across invocations.
+_clients: Dict[Tuple, object] = {}
+_clients_lock = threading.Lock()
+
+# error codes of scale set updates that could not get the VM's
+CAPACITY_ERROR_CODES = frozenset(
+    {
+        "AllocationFailed",
+        "ZonalAllocationFailed",
+        "OverconstrainedAllocationRequest",
+        "OverconstrainedZonalAllocationRequest",
+        "SkuNotAvailable",
+        "QuotaExceeded",
+        "OperationNotAllowed",
+    }
 )
-from azure.storage.blob import BlobServiceClient
 
-from stackguardian_autoscaler import SGRunner
+
+@contextmanager
+def _vmss_call(call: str):
+    """
+    Times a scale set call made within the vmss rate limit, raising
+    ThrottledError when the SDK's retries did not get it past throttling
+    """
+    rate_limit.acquire("vmss")
+    try:
+        with metrics.span("api_call", service="vmss", call=call):
+            yield
+    except HttpResponseError as e:
+        if e.status_code == 429:
+            rate_limit.throttled("vmss")
+            raise ThrottledError(f"vmss {call} was throttled: {e}") from e
+        raise
+    rate_limit.succeeded("vmss")
+
+
+def get_credential() -> "DefaultAzureCredential":
+    with _clients_lock:
+        if "credential" not in _clients:
+            from azure.identity import DefaultAzureCredential
+
+            _clients["credential"] = DefaultAzureCredential()
+        return _clients["credential"]
+
+
+def get_compute_client(
+    subscription_id: str, api_version: str
+) -> "ComputeManagementClient":
+    credential = get_credential()
+    key = ("compute", subscription_id, api_version)
+    with _clients_lock:
+        if key not in _clients:
+            from azure.mgmt.compute import ComputeManagementClient
+
+            _clients[key] = ComputeManagementClient(
+                credential=credential,
+                subscription_id=subscription_id,
+                api_version=api_version,
+            )
+        return _clients[key]
+
+
+def get_container_client(
+    conn_str: str, container_name: str
+) -> "ContainerClient":
+    key = ("container", conn_str, container_name)
+    with _clients_lock:
+        if key not in _clients:
+            from azure.storage.blob import BlobServiceClient
+
+            blob_service_client = BlobServiceClient.from_connection_string(
+                conn_str=conn_str
+            )
+            _clients[key] = blob_service_client.get_container_client(
+                container_name
+            )
+        return _clients[key]
+
+
+class BlobStateStore(StateStore):
+    def __init__(
+        self,
+        conn_str: str,
+        container_name: str,
+        blob_name: str,
+        legacy_scale_out_blob_name: Optional[str] = None,
+        legacy_scale_in_blob_name: Optional[str] = None,
+    ):
+        account_name = dict(
+            part.split("=", 1)
+            for part in (conn_str or "").split(";")
+            if "=" in part
+        ).get("AccountName")
+        super().__init__(f"{account_name}/{container_name}/{blob_name}")
+        self.conn_str = conn_str
+        self.container_name = container_name
+        self.blob_name = blob_name
+        self.legacy_scale_out_blob_name = legacy_scale_out_blob_name
+        self.legacy_scale_in_blob_name = legacy_scale_in_blob_name
+
+    @property
+    def container_client(self) -> "ContainerClient":
+        return get_container_client(self.conn_str, self.container_name)
+
+    def _read(
+        self, etag: Optional[str]
+    ) -> Tuple[Optional[str], Optional[str]]:
+        blob_client = self.container_client.get_blob_client(self.blob_name)
+        conditions = (
+            {"etag": etag, "match_condition": MatchConditions.IfModified}
+            if etag
+            else {}
+        )
+        try:
+            download_stream = blob_client.download_blob(**conditions)
+        except ResourceNotModifiedError:
+            return None, etag
+        except ResourceNotFoundError:
+            return None, None
+
+        content = download_stream.readall().decode("utf-8")
+        return content, download_stream.properties.etag
+
+    def _write(self, content: str, etag: Optional[str]) -> str:
+        blob_client = self.container_client.get_blob_client(self.blob_name)
+        try:
+            if etag:
+                response = blob_client.upload_blob(
+                    content,
+                    overwrite=True,
+                    etag=etag,
+                    match_condition=MatchConditions.IfNotModified,
+                )
+            else:
+                response = blob_client.upload_blob(content, overwrite=False)
+        except (ResourceModifiedError, ResourceExistsError) as e:
+            raise StateConflictError(str(e)) from e
+
+        return response["etag"]
+
+    def _lease_store(self) -> "BlobStateStore":
+        return BlobStateStore(
+            self.conn_str, self.container_name, f"{self.blob_name}.lease"
+        )
+
+    def _read_legacy(self) -> Optional[AutoscalerState]:
+        if not (
+            self.legacy_scale_out_blob_name or self.legacy_scale_in_blob_name
+        ):
+            return None
+
+        logging.info("STACKGUARDIAN: seeding state from timestamp blobs")
+        return AutoscalerState(
+            last_scale_out_event=self._read_legacy_timestamp(
+                self.legacy_scale_out_blob_name
+            ),
+            last_scale_in_event=self._read_legacy_timestamp(
+                self.legacy_scale_in_blob_name
+            ),
+        )
+
+    def _read_legacy_timestamp(
+        self, blob_name: Optional[str]
+    ) -> Optional[datetime.datetime]:
+        if not blob_name:
+            return None
+        try:
+            content = (
+                self.container_client.get_blob_client(blob_name)
+                .download_blob()
+                .readall()
+            )
+        except ResourceNotFoundError:
+            return None
+
+        return datetime.datetime.fromisoformat(content.decode("utf-8"))
 
 
-class AzureService:
-    def __init__(self):
+class VmssVm:
+    """The fields of a scale set VM the autoscaler uses"""
+
+    def __init__(
+        self,
+        instance_id: str,
+        name: str,
+        computer_name: Optional[str],
+        location: str,
+        protected: bool,
+        deallocated: bool = False,
+    ):
+        self.instance_id = instance_id
+        self.name = name
+        self.computer_name = computer_name
+        self.location = location
+        self.protected = protected
+        # only known when instance views were listed
+        self.deallocated = deallocated
+
+    @classmethod
+    def from_model(cls, vm: "VirtualMachineScaleSetVM") -> "VmssVm":
+        return cls(
+            instance_id=vm.instance_id,
+            name=vm.name,
+            computer_name=(
+                vm.os_profile.computer_name
+                if vm.os_profile is not None
+                else None
+            ),
+            location=vm.location,
+            protected=bool(
+                vm.protection_policy is not None
+                and vm.protection_policy.protect_from_scale_in
+            ),
+            deallocated=vm.instance_view is not None
+            and any(
+                status.code == "PowerState/deallocated"
+                for status in vm.instance_view.statuses or []
+            ),
+        )
+
+
+class AzureService(CloudService):
+    def __init__(self, settings: Optional[Dict[str, str]] = None):
+        self.settings = settings
         logging.debug("Initializing Azure Service")
         self.AZURE_API_VERSION = "2023-09-01"
-        self.AZURE_SUBSCRIPTION_ID = os.getenv("AZURE_SUBSCRIPTION_ID")
-        self.AZURE_RESOURCE_GROUP_NAME = os.getenv("AZURE_RESOURCE_GROUP_NAME")
-        self.AZURE_VMSS_NAME = os.getenv("AZURE_VMSS_NAME")
-        self.AZURE_BLOB_STORAGE_CONN_STRING = os.getenv(
+        self.AZURE_SUBSCRIPTION_ID = self._getenv("AZURE_SUBSCRIPTION_ID")
+        self.AZURE_RESOURCE_GROUP_NAME = self._getenv(
+            "AZURE_RESOURCE_GROUP_NAME"
+        )
+        self.AZURE_VMSS_NAME = self._getenv("AZURE_VMSS_NAME")
+        self.AZURE_BLOB_STORAGE_CONN_STRING = self._getenv(
             "AZURE_BLOB_STORAGE_CONN_STRING"
         )
-        self.AZURE_BLOB_CONTAINER_NAME = os.getenv("AZURE_BLOB_CONTAINER_NAME")
-        self.SCALE_IN_TIMESTAMP_BLOB_NAME = os.getenv(
+        self.AZURE_BLOB_CONTAINER_NAME = self._getenv(
+            "AZURE_BLOB_CONTAINER_NAME"
+        )
+        self.SCALE_IN_TIMESTAMP_BLOB_NAME = self._getenv(
             "SCALE_IN_TIMESTAMP_BLOB_NAME"
         )
-        self.SCALE_OUT_TIMESTAMP_BLOB_NAME = os.getenv(
+        self.SCALE_OUT_TIMESTAMP_BLOB_NAME = self._getenv(
             "SCALE_OUT_TIMESTAMP_BLOB_NAME"
         )
-
-        self.vmss_vms: List[VirtualMachineScaleSetVM] = None
-
-        self.cred = DefaultAzureCredential()
-        self.compute_client = ComputeManagementClient(
-            credential=self.cred,
-            subscription_id=self.AZURE_SUBSCRIPTION_ID,
-            api_version=self.AZURE_API_VERSION,
+        self.STATE_BLOB_NAME = self._getenv(
+            "AUTOSCALER_STATE_BLOB_NAME", "stackguardian-autoscaler-state.json"
         )
 
-        self.blob_service_client = BlobServiceClient.from_connection_string(
-            conn_str=self.AZURE_BLOB_STORAGE_CONN_STRING
+        # protection updates started at once
+        self.AZURE_MAX_CONCURRENCY = int(
+            self._getenv("AZURE_MAX_CONCURRENCY", "8")
         )
-        self.container_client = self.blob_service_client.get_container_client(
-            self.AZURE_BLOB_CONTAINER_NAME
+        # deallocated instances are kept as standby runners, which needs
+        # the VM's power states, set by the autoscaler
+        self.STANDBY_ENABLED = False
+        # standby VM's to keep, set by the autoscaler every tick
+        self.standby_pool_size: Optional[int] = None
+
+        self.vmss_vms: List[VmssVm] = None
+        # VM's by computer name
+        self.vmss_vm_index: Dict[str, VmssVm] = {}
+        # the scale set and its VM's are fetched on first use in every tick,
+        # or reused from an earlier tick for INVENTORY_TTL_SECONDS, see
+        # daemon.py
+        self._vmss: Optional["VirtualMachineScaleSet"] = None
+        self._vmss_vms_loaded = False
+        self.inventory_ttl = float(self._getenv("INVENTORY_TTL_SECONDS", "0"))
+        # monotonic time the VM's were listed
+        self._vmss_vms_read_at: Optional[float] = None
+        # whether the inventory of this tick was read by an earlier tick
+        self._vmss_vms_cached = False
+        # operations that were started but not waited for, with what they
+        # do, checked at the start of the next tick
+        self.pending_operations: List[Tuple[str, LROPoller]] = []
+        # the last capacity update, anything that changes the capacity
+        # again waits for it first
+        self._capacity_update: Optional[LROPoller] = None
+        # the capacity before the last capacity update and what it added
+        self._capacity_before = 0
+        self._capacity_increase = 0
+        # VM's a failed capacity update could not get, until the next tick
+        self.unfulfilled_vms = 0
+
+        self.state_store = BlobStateStore(
+            self.AZURE_BLOB_STORAGE_CONN_STRING,
+            self.AZURE_BLOB_CONTAINER_NAME,
+            self.STATE_BLOB_NAME,
+            legacy_scale_out_blob_name=self.SCALE_OUT_TIMESTAMP_BLOB_NAME,
+            legacy_scale_in_blob_name=self.SCALE_IN_TIMESTAMP_BLOB_NAME,
+        )
+
+    @property
+    def cred(self) -> "DefaultAzureCredential":
+        return get_credential()
+
+    @property
+    def compute_client(self) -> "ComputeManagementClient":
+        return get_compute_client(
+            self.AZURE_SUBSCRIPTION_ID, self.AZURE_API_VERSION
         )
-        self.vmss = self._fetch_vmss()
-        self._refresh_vmss_vms()
 
-    def _refresh_vmss_vms(self) -> List[VirtualMachineScaleSetVM]:
-        """Gives list of VM's in scale set"""
+    @property
+    def container_client(self) -> "ContainerClient":
+        return self.state_store.container_client
+
+    @property
+    def vmss(self) -> "VirtualMachineScaleSet":
+        if self._vmss is None:
+            self._vmss = self._fetch_vmss()
+        return self._vmss
+
+    def refresh(self):
+        # operations started by earlier ticks change the scale set
+        changed = (
+            len(self.pending_operations) > 0
+            or self._capacity_update is not None
+        )
+        super().refresh()
+        self._vmss_vms_cached = not changed and self._inventory_is_fresh()
+        if not self._vmss_vms_cached:
+            self._vmss = None
+            self._vmss_vms_loaded = False
+        self.unfulfilled_vms = 0
+        self._check_pending_operations()
+
+    def _inventory_is_fresh(self) -> bool:
+        """
+        Whether the scale set and VM's read by an earlier tick can be used
+        again. They are younger than INVENTORY_TTL_SECONDS and the capacity
+        saved by the other invocations is the one they were read with.
+        """
+        if self._vmss is None or not self._vmss_vms_loaded:
+            return False
+        if self._vmss_vms_read_at is None:
+            return False
+        if time.monotonic() - self._vmss_vms_read_at >= self.inventory_ttl:
+            return False
+        last_desired_capacity = self.state_store.get().last_desired_capacity
+        return last_desired_capacity in (None, self._vmss.sku.capacity)
+
+    def _check_pending_operations(self):
+        pending = []
+        for description, poller in self.pending_operations:
+            if not poller.done():
+                pending.append((description, poller))
+                continue
+            try:
+                poller.result()
+                logging.info(f"STACKGUARDIAN: done: {description}")
+            except AzureError as e:
+                logging.info(f"STACKGUARDIAN: failed: {description}: {e}")
+        self.pending_operations = pending
+
+    def _wait_for_capacity_update(self):
+        """
+        Waits for the last capacity update and takes the capacity from the
+        scale set it returned
+        """
+        poller, self._capacity_update = self._capacity_update, None
+        if poller is None:
+            return
+        try:
+            with metrics.span("lro_wait", service="vmss", call="update"):
+                vmss = poller.result()
+        except AzureError as e:
+            logging.info(f"STACKGUARDIAN: updating the capacity failed: {e}")
+            error = getattr(e, "error", None)
+            if getattr(error, "code", None) in CAPACITY_ERROR_CODES:
+                self.unfulfilled_vms = max(0, self._capacity_increase)
+            # read the capacity again when it is needed
+            self._vmss = None
+            return
+        if vmss is not None and vmss.sku is not None:
+            self.vmss.sku.capacity = vmss.sku.capacity
+
+    def _ensure_vmss_vms(self):
+        if not self._vmss_vms_loaded:
+            self._refresh_vmss_vms()
+
+    def _refresh_vmss_vms(self):
+        """
+        Lists the VM's in the scale set, keeping only the fields that are
+        used. The list API has no field selection, instance views are only
+        requested for the power states of standby VM's.
+        """
         logging.info("fetching vmss_vms")
         vmss_vms = []
         try:
             vmss_instances_iterator = (
                 self.compute_client.virtual_machine_scale_set_vms.list(
-                    self.AZURE_RESOURCE_GROUP_NAME, self.AZURE_VMSS_NAME
+                    self.AZURE_RESOURCE_GROUP_NAME,
+                    self.AZURE_VMSS_NAME,
+                    expand="instanceView" if self.STANDBY_ENABLED else None,
                 )
             )
-            for vm in vmss_instances_iterator:
-                vmss_vms.append(vm)
+            vmss_vm_index = {}
+            # the list is paged, pages are fetched while iterating
+            with _vmss_call("list_vms"):
+                for vm in vmss_instances_iterator:
+                    vmss_vm = VmssVm.from_model(vm)
+                    vmss_vms.append(vmss_vm)
+                    if vmss_vm.computer_name:
+                        vmss_vm_index[vmss_vm.computer_name] = vmss_vm
             self.vmss_vms = vmss_vms
+            self.vmss_vm_index = vmss_vm_index
+            self._vmss_vms_loaded = True
+            self._vmss_vms_read_at = time.monotonic()
+            self._vmss_vms_cached = False
         except AzureError as e:
             logging.info(f"Error retrieving VMSS instances: {str(e)}")
             raise e
 
-    def _fetch_vmss(self) -> VirtualMachineScaleSet:
+    def _fetch_vmss(self) -> "VirtualMachineScaleSet":
         logging.info("STACKGUARDIAN: fetch vmss")
         try:
-            vmss = self.compute_client.virtual_machine_scale_sets.get(
-                self.AZURE_RESOURCE_GROUP_NAME, self.AZURE_VMSS_NAME
-            )
+            with _vmss_call("get"):
+                vmss = self.compute_client.virtual_machine_scale_sets.get(
+                    self.AZURE_RESOURCE_GROUP_NAME, self.AZURE_VMSS_NAME
+                )
         except AzureError as e:
             logging.info(f"Error retrieving VMSS: {self.AZURE_VMSS_NAME}")
             raise e
 
         return vmss
 
-    def update_vmss_vm(
-        self,
-        vm: VirtualMachineScaleSetVM,
-    ):
+    def update_vmss_vm(self, vm: VmssVm, protected: bool) -> LROPoller:
+        """
+        Starts setting the VM's scale in protection. Only the protection
+        policy is sent, the rest of the VM's model comes from the scale set.
+        """
+        from azure.mgmt.compute.v2023_09_01.models import (
+            VirtualMachineScaleSetVM,
+        )
+
         try:
-            # Update the VM instance with the new protection policy
-            _: LROPoller[VirtualMachineScaleSetVM] = (
-                self.compute_client.virtual_machine_scale_set_vms.begin_update(
-                    self.AZURE_RESOURCE_GROUP_NAME,
-                    self.AZURE_VMSS_NAME,
-                    vm.instance_id,
-                    vm,
+            with _vmss_call("update_vm"):
+                poller: LROPoller["VirtualMachineScaleSetVM"] = (
+                    self.compute_client.virtual_machine_scale_set_vms.begin_update(
+                        self.AZURE_RESOURCE_GROUP_NAME,
+                        self.AZURE_VMSS_NAME,
+                        vm.instance_id,
+                        VirtualMachineScaleSetVM(
+                            location=vm.location,
+                            protection_policy=_protection_policy(
+                                protect_from_scale_in=protected
+                            ),
+                        ),
+                    )
                 )
-            )
 
             logging.info(
-                f"Scale-in protection has been enabled for VM: {vm.name}"
+                f"Scale-in protection {protected} is being set for VM: {vm.name}"
             )
+            return poller
 
         except AzureError as e:
             logging.info(
@@ -155,94 +542,417 @@ class AzureService:
             raise e
 
     def set_autoscale_vms(self, count):
-        """Reduce scale set sku capacity"""
+        """
+        Set the scale set's sku capacity to count running VM's plus the
+        standby VM's, without waiting for it
+        """
+        from azure.mgmt.compute.v2023_09_01.models import (
+            Sku,
+            VirtualMachineScaleSetUpdate,
+        )
+
         logging.info(f"STACKGUARDIAN: set number of VM's to {count}")
-        # Update the VMSS instance count
-        self.vmss.sku.capacity = count
+        # two updates of the scale set at once conflict
+        self._wait_for_capacity_update()
+
+        count += self.count_of_standby_vms()
+        sku = self.vmss.sku
+        self._capacity_before = sku.capacity or 0
+        self._capacity_increase = count - self._capacity_before
+        with _vmss_call("update"):
+            self._capacity_update = (
+                self.compute_client.virtual_machine_scale_sets.begin_update(
+                    self.AZURE_RESOURCE_GROUP_NAME,
+                    self.AZURE_VMSS_NAME,
+                    VirtualMachineScaleSetUpdate(
+                        sku=Sku(name=sku.name, tier=sku.tier, capacity=count)
+                    ),
+                )
+            )
 
-        # Update the VMSS with the new instance count
-        async_vmss_update: LROPoller[VirtualMachineScaleSet] = (
-            self.compute_client.virtual_machine_scale_sets.begin_update(
-                self.AZURE_RESOURCE_GROUP_NAME, self.AZURE_VMSS_NAME, self.vmss
+        sku.capacity = count
+        self.state_store.update(last_desired_capacity=count)
+        # the next tick lists the VM's created for it, even when the update
+        # was waited for within this tick
+        self._vmss_vms_read_at = None
+
+    def terminate_runner_vms(self, sg_runners: List[SGRunner]) -> int:
+        """
+        Deletes exactly the runners' instances in a single call, which also
+        lowers the scale set's capacity. While the standby pool is short,
+        instances are deallocated into it instead. Neither is waited for,
+        they are checked at the start of the next tick.
+        """
+        instance_ids = []
+        for sg_runner in sg_runners:
+            vm = self._find_azure_vm(sg_runner)
+            if vm is None:
+                logging.info(
+                    f"Azure VM for the stackguardian runner {sg_runner.computer_name} does not exist"
+                )
+                continue
+            instance_ids.append(vm.instance_id)
+        if len(instance_ids) == 0:
+            return 0
+
+        standby_missing = 0
+        if self.STANDBY_ENABLED and self.standby_pool_size is not None:
+            standby_missing = max(
+                0, self.standby_pool_size - self.count_of_standby_vms()
             )
+        deallocated = self._deallocate_instances(
+            instance_ids[:standby_missing]
         )
+        deleted = self._delete_instances(instance_ids[standby_missing:])
+        return deallocated + deleted
 
-        logging.info(f"VMSS instance count updated to {async_vmss_update}")
+    def _deallocate_instances(self, instance_ids: List[str]) -> int:
+        """Stops instances into the standby pool, keeping their disks"""
+        if len(instance_ids) == 0:
+            return 0
 
-    def _is_vm_scale_in_protected(self, vm: VirtualMachineScaleSetVM) -> bool:
-        if vm.protection_policy is not None:
-            return vm.protection_policy.protect_from_scale_in
-        return False
-
-    def add_scale_in_protection(self, sg_runner: SGRunner):
-        logging.info(
-            f"STACKGUARDIAN: add scale in protection to {sg_runner.computer_name}"
+        from azure.mgmt.compute.v2023_09_01.models import (
+            VirtualMachineScaleSetVMInstanceIDs,
         )
-        vm = self._find_azure_vm(sg_runner)
-        if not self._is_vm_scale_in_protected(vm):
-            vm.protection_policy = VirtualMachineScaleSetVMProtectionPolicy(
-                protect_from_scale_in=True
+
+        self._wait_for_capacity_update()
+
+        logging.info(f"STACKGUARDIAN: deallocating instances {instance_ids}")
+        try:
+            with _vmss_call("deallocate_instances"):
+                poller = self.compute_client.virtual_machine_scale_sets.begin_deallocate(
+                    self.AZURE_RESOURCE_GROUP_NAME,
+                    self.AZURE_VMSS_NAME,
+                    VirtualMachineScaleSetVMInstanceIDs(
+                        instance_ids=instance_ids
+                    ),
+                )
+        except AzureError as e:
+            logging.info(
+                f"STACKGUARDIAN: deallocating instances {instance_ids} failed: {e}"
             )
-            self.update_vmss_vm(vm)
+            return 0
+        except DeferredError:
+            # their runners are gone, the next tick deletes them instead
+            self.defer_terminations(instance_ids)
+            return 0
+        self.pending_operations.append(
+            (f"deallocate instances {instance_ids}", poller)
+        )
 
-    def _find_azure_vm(self, sg_runner: SGRunner) -> VirtualMachineScaleSetVM:
+        # the instances stay in the scale set and its capacity, only their
+        # runners are gone
+        deallocated = set(instance_ids)
         for vm in self.vmss_vms:
-            if sg_runner.computer_name.startswith(vm.os_profile.computer_name):
-                return vm
+            if vm.instance_id in deallocated:
+                vm.deallocated = True
+        self._forget_vms(deallocated, keep_standby=True)
+        return len(instance_ids)
 
-    def remove_scale_in_protection(self, sg_runner: SGRunner):
-        logging.info(
-            f"STACKGUARDIAN: remove scale in protection from {sg_runner.computer_name}"
+    def _delete_instances(self, instance_ids: List[str]) -> int:
+        if len(instance_ids) == 0:
+            return 0
+
+        from azure.mgmt.compute.v2023_09_01.models import (
+            VirtualMachineScaleSetVMInstanceRequiredIDs,
         )
-        vm: VirtualMachineScaleSetVM = self._find_azure_vm(sg_runner)
-        if vm is None:
+
+        self._wait_for_capacity_update()
+
+        logging.info(f"STACKGUARDIAN: deleting instances {instance_ids}")
+        try:
+            with _vmss_call("delete_instances"):
+                poller = self.compute_client.virtual_machine_scale_sets.begin_delete_instances(
+                    self.AZURE_RESOURCE_GROUP_NAME,
+                    self.AZURE_VMSS_NAME,
+                    VirtualMachineScaleSetVMInstanceRequiredIDs(
+                        instance_ids=instance_ids
+                    ),
+                )
+        except AzureError as e:
             logging.info(
-                f"Azure VM for the stackguardian runner {sg_runner} does not exist"
+                f"STACKGUARDIAN: deleting instances {instance_ids} failed: {e}"
             )
+            return 0
+        except DeferredError:
+            self.defer_terminations(instance_ids)
+            return 0
+        self.pending_operations.append(
+            (f"delete instances {instance_ids}", poller)
+        )
+
+        # keep this tick's view in line with the deletion
+        self._forget_vms(set(instance_ids))
+        self.vmss.sku.capacity -= len(instance_ids)
+        self.state_store.update(last_desired_capacity=self.vmss.sku.capacity)
+        return len(instance_ids)
+
+    def _forget_vms(self, instance_ids: set, keep_standby: bool = False):
+        """
+        Drops instances from this tick's inventory, or only from the index
+        of runner VM's when they stay on as standby VM's
+        """
+        if not keep_standby:
+            self.vmss_vms = [
+                vm
+                for vm in self.vmss_vms
+                if vm.instance_id not in instance_ids
+            ]
+        self.vmss_vm_index = {
+            name: vm
+            for name, vm in self.vmss_vm_index.items()
+            if vm.instance_id not in instance_ids
+        }
+
+    def _standby_vms(self) -> List[VmssVm]:
+        if not self.STANDBY_ENABLED:
+            return []
+        self._ensure_vmss_vms()
+        return [vm for vm in self.vmss_vms if vm.deallocated]
+
+    def count_of_standby_vms(self) -> int:
+        return len(self._standby_vms())
+
+    def resume_standby_vms(self, count: int) -> int:
+        """
+        Starts up to count deallocated instances in a single call, without
+        waiting for them. Their capacity is already allocated.
+        """
+        vms = self._standby_vms()[:count]
+        if len(vms) == 0:
+            return 0
+
+        from azure.mgmt.compute.v2023_09_01.models import (
+            VirtualMachineScaleSetVMInstanceIDs,
+        )
+
+        self._wait_for_capacity_update()
+
+        instance_ids = [vm.instance_id for vm in vms]
+        logging.info(f"STACKGUARDIAN: starting instances {instance_ids}")
+        try:
+            with _vmss_call("start"):
+                poller = (
+                    self.compute_client.virtual_machine_scale_sets.begin_start(
+                        self.AZURE_RESOURCE_GROUP_NAME,
+                        self.AZURE_VMSS_NAME,
+                        VirtualMachineScaleSetVMInstanceIDs(
+                            instance_ids=instance_ids
+                        ),
+                    )
+                )
+        except (AzureError, DeferredError) as e:
+            # new VM's are added instead
+            logging.info(
+                f"STACKGUARDIAN: starting instances {instance_ids} failed: {e}"
+            )
+            return 0
+        self.pending_operations.append(
+            (f"start instances {instance_ids}", poller)
+        )
+        for vm in vms:
+            vm.deallocated = False
+            if vm.computer_name:
+                self.vmss_vm_index[vm.computer_name] = vm
+        return len(vms)
+
+    def configure_standby_pool(self, max_size: int):
+        self.STANDBY_ENABLED = max_size > 0
+
+    def set_standby_pool_size(self, size: int):
+        """
+        The pool fills up with drained VM's, see terminate_runner_vms,
+        standby VM's above size are deleted
+        """
+        if not self.STANDBY_ENABLED:
+            return
+        self.standby_pool_size = size
+        surplus = self._standby_vms()[size:]
+        if len(surplus) > 0:
+            self._delete_instances([vm.instance_id for vm in surplus])
+
+    def add_scale_in_protection(self, sg_runner: SGRunner):
+        self._set_scale_in_protection([sg_runner], True)
+
+    def remove_scale_in_protection(self, sg_runner: SGRunner):
+        self._set_scale_in_protection([sg_runner], False)
+
+    def add_scale_in_protection_bulk(self, sg_runners: List[SGRunner]):
+        self._set_scale_in_protection(sg_runners, True)
+
+    def remove_scale_in_protection_bulk(self, sg_runners: List[SGRunner]):
+        self._set_scale_in_protection(sg_runners, False)
+
+    def _set_scale_in_protection(
+        self, sg_runners: List[SGRunner], protected: bool
+    ):
+        """
+        Starts the protection updates of VM's not already in the wanted
+        state, at most AZURE_MAX_CONCURRENCY at once. Nothing later in the
+        tick depends on them, so they are not waited for.
+        """
+        vms = []
+        for sg_runner in sg_runners:
+            vm = self._find_azure_vm(sg_runner)
+            if vm is None:
+                logging.info(
+                    f"Azure VM for the stackguardian runner {sg_runner.computer_name} does not exist"
+                )
+                continue
+            if vm.protected != protected:
+                vms.append(vm)
+        if len(vms) == 0:
             return
 
-        if self._is_vm_scale_in_protected(vm):
-            vm.protection_policy = VirtualMachineScaleSetVMProtectionPolicy(
-                protect_from_scale_in=False
+        logging.info(
+            f"STACKGUARDIAN: set scale in protection {protected} for {[vm.name for vm in vms]}"
+        )
+        max_workers = min(self.AZURE_MAX_CONCURRENCY, len(vms))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                (
+                    vm,
+                    executor.submit(
+                        contextvars.copy_context().run,
+                        self.update_vmss_vm,
+                        vm,
+                        protected,
+                    ),
+                )
+                for vm in vms
+            ]
+
+        error = None
+        deferred = 0
+        for vm, future in futures:
+            try:
+                poller = future.result()
+            except AzureError as e:
+                error = error or e
+                continue
+            except DeferredError:
+                # the next tick finds it in the old state again
+                deferred += 1
+                continue
+            vm.protected = protected
+            self.pending_operations.append(
+                (f"scale in protection {protected} for {vm.name}", poller)
+            )
+        if deferred > 0:
+            logging.info(
+                f"STACKGUARDIAN: deferred scale in protection of {deferred} VM's"
+            )
+            metrics.increment(
+                "actions_deferred", deferred, action="set_protection"
             )
-            self.update_vmss_vm(vm)
+        if error is not None:
+            raise error
+
+    def _find_azure_vm(self, sg_runner: SGRunner) -> Optional[VmssVm]:
+        """
+        Finds the VM whose computer name is the longest prefix of the
+        runner's computer name, e.g. a runner registered with its FQDN.
+        """
+        self._ensure_vmss_vms()
+        vm = self._lookup_azure_vm(sg_runner)
+        if vm is None and self._vmss_vms_cached:
+            # e.g. the runner of a VM created since the VM's were listed
+            self._refresh_vmss_vms()
+            vm = self._lookup_azure_vm(sg_runner)
+        return vm
+
+    def _lookup_azure_vm(self, sg_runner: SGRunner) -> Optional[VmssVm]:
+        computer_name = sg_runner.computer_name or ""
+        for end in range(len(computer_name), 0, -1):
+            vm = self.vmss_vm_index.get(computer_name[:end])
+            if vm is not None:
+                return vm
+        return None
+
+    def get_unmatched_runners(
+        self, sg_runners: List[SGRunner]
+    ) -> List[SGRunner]:
+        return [
+            sg_runner
+            for sg_runner in sg_runners
+            if self._find_azure_vm(sg_runner) is None
+        ]
+
+    def join_inventory(self, sg_runners: List[SGRunner]) -> InventoryJoin:
+        self._ensure_vmss_vms()
+        join = InventoryJoin()
+        matched = set()
+        for sg_runner in sg_runners:
+            vm = self._find_azure_vm(sg_runner)
+            if vm is None:
+                join.ghost_runners.append(sg_runner)
+            else:
+                matched.add(vm.instance_id)
+        join.orphan_vms = [
+            vm.instance_id
+            for vm in self.vmss_vms
+            if vm.instance_id not in matched and not vm.deallocated
+        ]
+        return join
+
+    def terminate_orphan_vms(self, vm_ids: List[str]) -> int:
+        self._ensure_vmss_vms()
+        # e.g. deferred terminations of instances that are gone since
+        existing = {vm.instance_id for vm in self.vmss_vms}
+        return self._delete_instances(
+            [vm_id for vm_id in vm_ids if vm_id in existing]
+        )
 
     def set_last_scale_in_event(self, timestamp: datetime.datetime):
         logging.info("STACKGUARDIAN: set last scale in event")
-        self.container_client.upload_blob(
-            self.SCALE_IN_TIMESTAMP_BLOB_NAME,
-            io.BytesIO(timestamp.isoformat().encode()),
-            overwrite=True,
+        self.state_store.save(
+            last_scale_in_event=timestamp, last_action="scale_in"
         )
 
     def get_last_scale_in_event(self) -> datetime.datetime:
-        last_scale_in_timestamp = self.fetch_blob_content(
-            self.SCALE_IN_TIMESTAMP_BLOB_NAME
-        )
-        if last_scale_in_timestamp is not None:
-            timestamp = datetime.datetime.fromisoformat(
-                last_scale_in_timestamp
-            )
-            return timestamp
+        logging.info("STACKGUARDIAN: get last scale in event")
+        return self.state_store.get().last_scale_in_event
 
     def set_last_scale_out_event(self, timestamp: datetime.datetime):
         logging.info("STACKGUARDIAN: set last scale out event")
-        self.container_client.upload_blob(
-            self.SCALE_OUT_TIMESTAMP_BLOB_NAME,
-            io.BytesIO(timestamp.isoformat().encode()),
-            overwrite=True,
+        self.state_store.save(
+            last_scale_out_event=timestamp, last_action="scale_out"
         )
 
     def get_last_scale_out_event(self) -> datetime.datetime:
         logging.info("STACKGUARDIAN: get last scale out event")
-        last_scale_out_timestamp = self.fetch_blob_content(
-            self.SCALE_OUT_TIMESTAMP_BLOB_NAME
+        return self.state_store.get().last_scale_out_event
+
+    def count_of_unfulfilled_vms(self) -> int:
+        """
+        VM's the last capacity update could not get, e.g. for lack of spot
+        capacity or quota
+        """
+        if self._capacity_update is not None and self._capacity_update.done():
+            self._wait_for_capacity_update()
+        if self.unfulfilled_vms == 0:
+            return 0
+        # only what the scale set kept of the capacity it could not get
+        return max(
+            0,
+            min(
+                self.unfulfilled_vms,
+                self.vmss.sku.capacity - self._capacity_before,
+            ),
         )
-        if last_scale_out_timestamp is not None:
-            timestamp = datetime.datetime.fromisoformat(
-                last_scale_out_timestamp
-            )
-            return timestamp
 
     def count_of_existing_vms(self) -> int:
-        return self.vmss.sku.capacity
+        if self._capacity_update is not None and self._capacity_update.done():
+            self._wait_for_capacity_update()
+        # deallocated instances still count towards the capacity
+        return self.vmss.sku.capacity - self.count_of_standby_vms()
+
+
+def _protection_policy(protect_from_scale_in: bool):
+    from azure.mgmt.compute.v2023_09_01.models import (
+        VirtualMachineScaleSetVMProtectionPolicy,
+    )
+
+    return VirtualMachineScaleSetVMProtectionPolicy(
+        protect_from_scale_in=protect_from_scale_in
+    )
@@ -0,0 +1,177 @@
+"""
+Memory benchmark for reading a runner group, at the sizes of large runner
+groups. A synthetic getActiveWorkflows=true response is parsed into
+SGRunner's the way each mode does it. Reported per mode and runner count:
+
+- peak: most memory allocated while parsing, the response body excluded
+- retained: memory still allocated for the runners once parsing is done
+- seconds: time to parse, measured without tracing allocations
+
+Modes:
+
+- document: the whole response loaded and kept next to the runners, as
+  before runners were parsed while streaming
+- json: iter_runner_group without ijson installed, the document is loaded
+  but only the runners are kept
+- ijson: iter_runner_group with ijson, one runner's dict at a time
+
+Usage:
+
+    python benchmarks/memory_benchmark.py [--runners 1000 --runners 5000]
+        [--workflows 5] [--json]
+"""
+
+import argparse
+import gc
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sg_api_client import iter_runner_group  # noqa: E402
+from stackguardian_autoscaler import SGRunner  # noqa: E402
+
+
+def runner_group_response(runners: int, workflows: int) -> bytes:
+    """A runner group with workflows active workflows on every runner"""
+    return json.dumps(
+        {
+            "msg": {
+                "ResourceName": "benchmark",
+                "QueuedWorkflowsCount": runners // 10,
+                "ContainerInstances": [
+                    {
+                        "instanceDetails": [
+                            {
+                                "IPAddress": f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}",
+                                "ComputerName": f"runner-{i:05d}",
+                                "InstanceId": f"i-{i:017x}",
+                                "OSType": "Linux",
+                                "AgentVersion": "1.0.0",
+                            }
+                        ],
+                        "containerInstanceArn": f"arn:aws:ecs:eu-central-1:000000000000:container-instance/benchmark/{i:032x}",
+                        "agentConnected": True,
+                        "status": "ACTIVE",
+                        "runnerId": f"runner-{i:05d}",
+                        "runningTasksCount": workflows,
+                        "pendingTasksCount": 0,
+                        "registeredAt": 1700000000 + i,
+                        "activeWorkflows": [
+                            {
+                                "ResourceName": f"wf-{i}-{w}",
+                                "WfGroup": "benchmark/stacks/network",
+                                "Stack": f"stack-{w}",
+                                "startedAt": 1700000000 + i * 10 + w,
+                                "Statuses": {
+                                    "pre_workflow_steps": [
+                                        {"name": "checkout", "status": "done"}
+                                    ]
+                                },
+                            }
+                            for w in range(workflows)
+                        ],
+                    }
+                    for i in range(runners)
+                ],
+            }
+        }
+    ).encode()
+
+
+def parse_document(stream):
+    document = json.load(stream)
+    sg_runners = [
+        SGRunner(runner) for runner in document["msg"]["ContainerInstances"]
+    ]
+    return document, sg_runners
+
+
+def parse_stream(stream):
+    return [
+        SGRunner(value)
+        for key, value in iter_runner_group(stream)
+        if key == "runner"
+    ]
+
+
+def parse_json(stream):
+    with mock.patch.dict(sys.modules, {"ijson": None}):
+        return parse_stream(stream)
+
+
+MODES = {"document": parse_document, "json": parse_json, "ijson": parse_stream}
+
+
+def measure(mode: str, body: bytes) -> dict:
+    gc.collect()
+    tracemalloc.start()
+    result = MODES[mode](io.BytesIO(body))
+    gc.collect()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+
+    # tracing slows down every allocation, time a second run without it
+    gc.collect()
+    started = time.perf_counter()
+    MODES[mode](io.BytesIO(body))
+    seconds = time.perf_counter() - started
+    return {
+        "peak_mb": round(peak / 2**20, 1),
+        "retained_mb": round(retained / 2**20, 1),
+        "seconds": round(seconds, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runners", type=int, action="append", default=None)
+    parser.add_argument("--workflows", type=int, default=5)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    try:
+        import ijson  # noqa: F401
+
+        modes = list(MODES)
+    except ImportError:
+        modes = ["document", "json"]
+
+    results = []
+    for runners in args.runners or [1000, 5000]:
+        body = runner_group_response(runners, args.workflows)
+        for mode in modes:
+            result = measure(mode, body)
+            result.update(
+                {
+                    "runners": runners,
+                    "mode": mode,
+                    "body_mb": round(len(body) / 2**20, 1),
+                }
+            )
+            results.append(result)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(
+        f"{'runners':>7} {'body MB':>8} {'mode':<9} {'peak MB':>8}"
+        f" {'retained MB':>12} {'seconds':>8}"
+    )
+    for result in results:
+        print(
+            f"{result['runners']:>7} {result['body_mb']:>8.1f}"
+            f" {result['mode']:<9} {result['peak_mb']:>8.1f}"
+            f" {result['retained_mb']:>12.1f} {result['seconds']:>8.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
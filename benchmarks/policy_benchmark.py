@@ -0,0 +1,200 @@
+"""
+Scaling policy benchmark, runs every policy against every scenario in the
+offline simulator. Traces are seeded, the same arguments give the same
+numbers on any machine. Reported per policy and scenario:
+
+- wait p50/p95: seconds jobs spent queued before a runner picked them up
+- idle: runner-minutes spent without a job
+- vm: VM-minutes, including VM's still booting
+- standby: VM-minutes of stopped standby VM's, which only pay for disks
+- calls/tick: mean SG and cloud API calls per tick
+- osc: times the desired capacity changed direction
+- events: scale out notifications that ran, with --events
+- cost: dollars of VM time, with --pools
+
+Usage:
+
+    python benchmarks/policy_benchmark.py [--scenario steady] [--policy step]
+        [--trace recorded.csv] [--policies policies.json] [--events]
+        [--pools pools.json] [--json]
+
+--events also notifies the autoscaler of every queued job, like the
+webhook handlers, on top of the periodic ticks.
+
+A policies file maps policy names to the settings they override, e.g.
+{"fast-scale-in": {"SCALE_IN_COOLDOWN_DURATION": 1}}.
+
+A pools file scales every policy over several scale groups instead of one,
+a SCALE_POOLS list without scale groups. A pool's "capacity" caps the VM's
+it can launch, e.g. to see spot shortages fall back to on-demand:
+[{"name": "spot", "runner_concurrency": 4, "hourly_cost": 0.1,
+  "spot": true, "capacity": 2}, {"name": "od", "hourly_cost": 0.05}]
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from simulator import (  # noqa: E402
+    Simulation,
+    burst_trace,
+    diurnal_trace,
+    load_trace,
+    poisson_trace,
+)
+
+SCENARIOS = {
+    "steady": lambda: poisson_trace(
+        rate_per_minute=0.5, minutes=8 * 60, mean_duration_minutes=10
+    ),
+    "diurnal": lambda: diurnal_trace(
+        peak_rate_per_minute=1.5, minutes=24 * 60, mean_duration_minutes=10
+    ),
+    "bursty": lambda: burst_trace(
+        jobs_per_burst=20,
+        interval_minutes=60,
+        minutes=8 * 60,
+        mean_duration_minutes=8,
+    ),
+    # VM's that take longer to boot than the scale out cooldown, booting
+    # VM's must count as capacity or every cooldown asks for them again
+    "slow-boot": lambda: burst_trace(
+        jobs_per_burst=20,
+        interval_minutes=240,
+        minutes=8 * 60,
+        mean_duration_minutes=60,
+    ),
+}
+
+# seconds a new VM takes to boot and register, by scenario, instead of
+# --boot-seconds
+SCENARIO_BOOT_SECONDS = {"slow-boot": 480}
+
+POLICIES = {
+    "step": {},
+    "step-aggressive": {
+        "SCALE_OUT_STEP": 3,
+        "SCALE_OUT_COOLDOWN_DURATION": 2,
+        "SCALE_IN_COOLDOWN_DURATION": 10,
+    },
+    "step-holt": {"FORECASTER": "holt"},
+    "target": {"SCALING_MODE": "target", "MAX_SCALE_IN_STEP": 2},
+    "step-standby": {"STANDBY_POOL_MAX": 5},
+    # runners kept warm through the busy half of the diurnal scenario
+    "step-scheduled": {
+        "CAPACITY_SCHEDULE": json.dumps(
+            {
+                "prewarm_minutes": 10,
+                "windows": [
+                    {
+                        "name": "daytime",
+                        "cron": "0 6 * * *",
+                        "duration_minutes": 720,
+                        "min_runners": 8,
+                    }
+                ],
+            }
+        )
+    },
+}
+
+
+def run(scenario: str, trace, policy: str, settings: dict, args) -> dict:
+    simulation = Simulation(
+        trace,
+        settings=settings,
+        tick_interval=timedelta(seconds=args.tick_seconds),
+        boot_delay=timedelta(
+            seconds=SCENARIO_BOOT_SECONDS.get(scenario, args.boot_seconds)
+        ),
+        resume_delay=timedelta(seconds=args.resume_seconds),
+        scale_out_on_arrival=args.events,
+        pools=args.pools,
+    )
+    result = simulation.run().as_dict()
+    result.update({"scenario": scenario, "policy": policy})
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--scenario", action="append", choices=SCENARIOS, default=None
+    )
+    parser.add_argument("--trace", help="recorded trace CSV")
+    parser.add_argument("--policy", action="append", default=None)
+    parser.add_argument("--policies", help="JSON file with extra policies")
+    parser.add_argument("--tick-seconds", type=float, default=60)
+    parser.add_argument("--boot-seconds", type=float, default=180)
+    parser.add_argument("--resume-seconds", type=float, default=30)
+    parser.add_argument("--events", action="store_true")
+    parser.add_argument("--pools", help="JSON file with scale pools")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    # the autoscaler logs every step of every tick
+    logging.basicConfig(level=logging.WARNING)
+
+    policies = dict(POLICIES)
+    if args.policies:
+        with open(args.policies) as policies_file:
+            policies.update(json.load(policies_file))
+    for policy in args.policy or []:
+        if policy not in policies:
+            parser.error(f"unknown policy {policy}")
+    if args.pools:
+        with open(args.pools) as pools_file:
+            args.pools = json.load(pools_file)
+
+    traces = {}
+    if args.trace:
+        traces[os.path.basename(args.trace)] = load_trace(args.trace)
+    if args.scenario or not args.trace:
+        for scenario in args.scenario or SCENARIOS:
+            traces[scenario] = SCENARIOS[scenario]()
+
+    results = [
+        run(scenario, trace, policy, policies[policy], args)
+        for scenario, trace in traces.items()
+        for policy in args.policy or policies
+    ]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(
+        f"{'scenario':<12} {'policy':<16} {'jobs':>5} {'wait p50':>9}"
+        f" {'wait p95':>9} {'idle min':>9} {'vm min':>8} {'standby':>8}"
+        f" {'calls/tick':>10}"
+        f" {'osc':>4}"
+        + (f" {'events':>7}" if args.events else "")
+        + (f" {'cost':>7}" if args.pools else "")
+    )
+    for result in results:
+        print(
+            f"{result['scenario']:<12} {result['policy']:<16}"
+            f" {result['jobs']:>5}"
+            f" {result['queue_wait_p50_seconds'] or 0:>8.0f}s"
+            f" {result['queue_wait_p95_seconds'] or 0:>8.0f}s"
+            f" {result['idle_runner_minutes']:>9.0f}"
+            f" {result['vm_minutes']:>8.0f}"
+            f" {result['standby_vm_minutes']:>8.0f}"
+            f" {result['api_calls_per_tick_mean'] or 0:>10.1f}"
+            f" {result['oscillations']:>4}"
+            + (
+                f" {result['events'] - result['events_coalesced']:>7}"
+                if args.events
+                else ""
+            )
+            + (f" {result['vm_cost']:>7.2f}" if args.pools else "")
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+Cold start benchmark for the Lambda and Azure Function entry points.
+
+For every entry point a fresh interpreter imports the entry module and runs
+one invocation until it makes its first outbound API call. Outbound HTTP is
+intercepted at urllib3 (used by boto3, the Azure SDK and requests), so
+nothing leaves the machine. Reported per entry point:
+
+- import: time to import the entry module
+- first call: time from the start of the import to the first API call of
+  the invocation
+- modules: number of modules loaded at the first API call
+
+Usage:
+
+    python benchmarks/startup_benchmark.py [--runs 5] [--json]
+"""
+
+import argparse
+import importlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENTRY_POINTS = {
+    "lambda": "lambda",
+    "function_app": "function_app",
+}
+
+# placeholder configuration, only used to get through the constructors
+BENCHMARK_ENV = {
+    "SG_BASE_URI": "https://sg-api.invalid",
+    "SG_API_KEY": "benchmark",
+    "SG_ORG": "benchmark",
+    "SG_RUNNER_GROUP": "benchmark",
+    "SCALE_IN_THRESHOLD": "0",
+    "SCALE_IN_STEP": "1",
+    "SCALE_OUT_THRESHOLD": "1",
+    "SCALE_OUT_STEP": "1",
+    "SCALE_IN_COOLDOWN_DURATION": "5",
+    "SCALE_OUT_COOLDOWN_DURATION": "5",
+    "AWS_ASG_NAME": "benchmark",
+    "AWS_BUCKET_NAME": "benchmark",
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "benchmark",
+    "AWS_SECRET_ACCESS_KEY": "benchmark",
+    "AZURE_SUBSCRIPTION_ID": "00000000-0000-0000-0000-000000000000",
+    "AZURE_RESOURCE_GROUP_NAME": "benchmark",
+    "AZURE_VMSS_NAME": "benchmark",
+    "AZURE_BLOB_CONTAINER_NAME": "benchmark",
+    "AZURE_BLOB_STORAGE_CONN_STRING": (
+        "DefaultEndpointsProtocol=https;AccountName=benchmark;"
+        "AccountKey=YmVuY2htYXJr;EndpointSuffix=core.windows.net"
+    ),
+}
+
+
+class _FirstApiCall(BaseException):
+    """Raised from urllib3 to stop the invocation at its first API call"""
+
+
+def _invoke(entry_point: str, module):
+    if entry_point == "lambda":
+        module.lambda_handler({}, None)
+    else:
+        module.timer_trigger._function.get_user_function()(None)
+
+
+def _child(entry_point: str):
+    start = time.perf_counter()
+    import urllib3.connectionpool
+
+    first_call = {}
+
+    def urlopen(pool, method, url, *args, **kwargs):
+        first_call["seconds"] = time.perf_counter() - start
+        first_call["modules"] = len(sys.modules)
+        first_call["host"] = pool.host
+        raise _FirstApiCall()
+
+    urllib3.connectionpool.HTTPConnectionPool.urlopen = urlopen
+
+    sys.path.insert(0, REPO_ROOT)
+    module = importlib.import_module(ENTRY_POINTS[entry_point])
+    import_seconds = time.perf_counter() - start
+
+    try:
+        _invoke(entry_point, module)
+    except _FirstApiCall:
+        pass
+
+    print(
+        json.dumps(
+            {
+                "import_seconds": import_seconds,
+                "first_call_seconds": first_call.get("seconds"),
+                "modules": first_call.get("modules"),
+                "host": first_call.get("host"),
+            }
+        )
+    )
+
+
+def _run(entry_point: str) -> dict:
+    env = dict(os.environ)
+    env.update(BENCHMARK_ENV)
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", entry_point],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument(
+        "--child", choices=ENTRY_POINTS, help=argparse.SUPPRESS
+    )
+    args = parser.parse_args()
+
+    if args.child:
+        _child(args.child)
+        return
+
+    results = {}
+    for entry_point in ENTRY_POINTS:
+        runs = [_run(entry_point) for _ in range(args.runs)]
+        first_calls = [
+            run["first_call_seconds"]
+            for run in runs
+            if run["first_call_seconds"] is not None
+        ]
+        results[entry_point] = {
+            "import_ms": statistics.median(
+                run["import_seconds"] * 1000 for run in runs
+            ),
+            "first_call_ms": (
+                statistics.median(first_calls) * 1000 if first_calls else None
+            ),
+            "modules": runs[-1]["modules"],
+            "first_call_host": runs[-1]["host"],
+        }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    for entry_point, result in results.items():
+        first_call_ms = result["first_call_ms"]
+        print(
+            f"{entry_point:<14} import {result['import_ms']:8.1f} ms"
+            f"   first API call {first_call_ms or float('nan'):8.1f} ms"
+            f" ({result['first_call_host']}, {result['modules']} modules)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Runs the autoscaler as a long running process instead of a timer triggered
+function, e.g. in a container or on a VM next to the runners:
+
+    CLOUD_PROVIDER=aws AUTOSCALER_INTERVAL_SECONDS=10 python daemon.py
+
+With AUTOSCALER_CONFIG set, every runner group in the config file is
+reconciled on each tick, see multi_group.py.
+
+The cloud service, its SDK clients and the StackGuardian connection pool are
+created once and reused by every tick. SIGTERM and SIGINT let the running
+tick finish before exiting.
+
+With INVENTORY_TTL_SECONDS set, the ASG or scale set and its VM's read by one
+tick are reused by the ticks that follow for that long, instead of being
+described again every few seconds. The copy is read again before then when
+a tick changed the capacity or terminated VM's, when another invocation
+saved a different desired capacity, when a runner does not match a VM in
+it, e.g. on a VM launched since, and on AWS when it shows a capacity gap.
+VM's that disappear without the autoscaler's doing, e.g. terminated from
+the console, stay in the copy until it expires, so keep the TTL well below
+ORPHAN_GRACE_MINUTES and LAUNCH_GRACE_MINUTES.
+"""
+
+import asyncio
+import logging
+import os
+import signal
+from typing import Union
+
+from multi_group import MultiGroupAutoscaler, create_cloud_service
+from stackguardian_autoscaler import StackGuardianAutoscaler
+
+
+class AutoscalerDaemon:
+    def __init__(
+        self,
+        autoscaler: Union[StackGuardianAutoscaler, MultiGroupAutoscaler],
+        interval_seconds: float,
+    ):
+        self.autoscaler = autoscaler
+        self.interval_seconds = interval_seconds
+        self._stopping: asyncio.Event = None
+
+    def stop(self):
+        logging.info("STACKGUARDIAN: stopping after the current tick")
+        self._stopping.set()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self.stop)
+
+        logging.info(
+            f"STACKGUARDIAN: reconciling every {self.interval_seconds}s"
+        )
+        while not self._stopping.is_set():
+            tick_started = loop.time()
+            try:
+                # ticks block on HTTP, keep them off the loop so signals
+                # are handled while a tick is running
+                await asyncio.to_thread(self.autoscaler.start)
+            except Exception as e:
+                logging.exception(f"STACKGUARDIAN: tick failed: {e}")
+
+            remaining = self.interval_seconds - (loop.time() - tick_started)
+            if remaining > 0:
+                try:
+                    await asyncio.wait_for(
+                        self._stopping.wait(), timeout=remaining
+                    )
+                except asyncio.TimeoutError:
+                    pass
+
+        self.autoscaler.sg_client.close()
+        logging.info("STACKGUARDIAN: stopped")
+
+
+def main():
+    logging.basicConfig(
+        level=os.getenv("LOG_LEVEL", "INFO"),
+        format="%(asctime)s %(levelname)s %(message)s",
+    )
+    if os.getenv("AUTOSCALER_CONFIG"):
+        autoscaler = MultiGroupAutoscaler.from_config(
+            os.getenv("AUTOSCALER_CONFIG")
+        )
+    else:
+        autoscaler = StackGuardianAutoscaler(
+            create_cloud_service(os.getenv("CLOUD_PROVIDER", "aws"))
+        )
+    daemon = AutoscalerDaemon(
+        autoscaler,
+        interval_seconds=float(os.getenv("AUTOSCALER_INTERVAL_SECONDS", "10")),
+    )
+    asyncio.run(daemon.run())
+
+
+if __name__ == "__main__":
+    main()
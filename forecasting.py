@@ -0,0 +1,120 @@
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+
+class DemandSample:
+    """Queue depth and capacity observed at the start of a tick"""
+
+    def __init__(
+        self,
+        timestamp: datetime,
+        queued_jobs: int,
+        running_tasks: int,
+        runners: int,
+    ):
+        self.timestamp = timestamp
+        self.queued_jobs = queued_jobs
+        self.running_tasks = running_tasks
+        self.runners = runners
+
+    @classmethod
+    def from_list(cls, sample: List) -> "DemandSample":
+        return cls(datetime.fromisoformat(sample[0]), *sample[1:4])
+
+    def to_list(self) -> List:
+        # kept compact, the history is stored in the state document
+        return [
+            self.timestamp.isoformat(),
+            self.queued_jobs,
+            self.running_tasks,
+            self.runners,
+        ]
+
+
+class Forecaster(ABC):
+    @abstractmethod
+    def forecast(
+        self, history: List[DemandSample], horizon: timedelta
+    ) -> Optional[float]:
+        """
+        Forecast the number of queued jobs horizon after the last sample in
+        history, None when there is not enough history
+        """
+        pass
+
+
+class EwmaForecaster(Forecaster):
+    """Exponentially weighted moving average, projected flat"""
+
+    def __init__(self, alpha: float = 0.5):
+        self.alpha = alpha
+
+    def forecast(
+        self, history: List[DemandSample], horizon: timedelta
+    ) -> Optional[float]:
+        if len(history) == 0:
+            return None
+
+        level = history[0].queued_jobs
+        for sample in history[1:]:
+            level = self.alpha * sample.queued_jobs + (1 - self.alpha) * level
+        return level
+
+
+class HoltForecaster(Forecaster):
+    """
+    Holt's linear trend (double exponential smoothing). Ticks are not evenly
+    spaced, so the trend is kept per minute and scaled by the time between
+    samples. Samples closer together than MIN_TREND_INTERVAL only update the
+    level, a per minute slope over a few seconds is mostly noise.
+    """
+
+    MIN_TREND_INTERVAL = timedelta(seconds=10)
+
+    def __init__(self, alpha: float = 0.5, beta: float = 0.3):
+        self.alpha = alpha
+        self.beta = beta
+
+    def forecast(
+        self, history: List[DemandSample], horizon: timedelta
+    ) -> Optional[float]:
+        if len(history) < 2:
+            return None
+
+        level = float(history[0].queued_jobs)
+        trend = 0.0
+        previous = history[0].timestamp
+        for sample in history[1:]:
+            interval = sample.timestamp - previous
+            if interval < self.MIN_TREND_INTERVAL:
+                level = (
+                    self.alpha * sample.queued_jobs + (1 - self.alpha) * level
+                )
+                continue
+            minutes = interval.total_seconds() / 60
+            predicted = level + trend * minutes
+            new_level = (
+                self.alpha * sample.queued_jobs + (1 - self.alpha) * predicted
+            )
+            trend = (
+                self.beta * (new_level - level) / minutes
+                + (1 - self.beta) * trend
+            )
+            level = new_level
+            previous = sample.timestamp
+
+        horizon_minutes = horizon.total_seconds() / 60
+        return max(0.0, level + trend * horizon_minutes)
+
+
+def create_forecaster(
+    name: Optional[str], alpha: float = 0.5, beta: float = 0.3
+) -> Optional[Forecaster]:
+    if not name:
+        return None
+    if name == "ewma":
+        return EwmaForecaster(alpha=alpha)
+    if name == "holt":
+        return HoltForecaster(alpha=alpha, beta=beta)
+    raise ValueError(f"Unknown FORECASTER {name}")
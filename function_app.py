@@ -1,24 +1,61 @@
-from azure_service import AzureService
-from stackguardian_autoscaler import StackGuardianAutoscaler
-
-import azure.functions as func
-
-app = func.FunctionApp()
-
-# TODO: Set VM's are registered but unhealthy to draining for termination
-# TODO: Delete VM's are not registered but are unhealthy.
-# TODO: VM is registered but not connected. Solution: Set it as draining
-# TODO: VM's that are not registered but exist in the scale set. Terminate them
-
-
-@app.timer_trigger(
-    schedule="0 * * * * *",
-    arg_name="myTimer",
-    run_on_startup=False,
-    use_monitor=False,
-)
-def timer_trigger(myTimer: func.TimerRequest) -> None:
-    cloud_service = AzureService()
-
-    sg_autoscaler = StackGuardianAutoscaler(cloud_service)
-    sg_autoscaler.start()
+import json
+import os
+
+from multi_group import MultiGroupAutoscaler, create_cloud_service
+from stackguardian_autoscaler import StackGuardianAutoscaler
+
+import azure.functions as func
+
+app = func.FunctionApp()
+
+# Kept at module scope so warm invocations reuse the Azure credential and
+# clients, the StackGuardian connection pool and the cached state document.
+# Nothing is created or imported until the first invocation needs it.
+_autoscaler: StackGuardianAutoscaler = None
+
+
+def _get_autoscaler() -> StackGuardianAutoscaler:
+    global _autoscaler
+    if _autoscaler is None:
+        if os.getenv("AUTOSCALER_CONFIG"):
+            # one tick for every runner group in the config file
+            _autoscaler = MultiGroupAutoscaler.from_config(
+                os.getenv("AUTOSCALER_CONFIG")
+            )
+        else:
+            _autoscaler = StackGuardianAutoscaler(
+                create_cloud_service("azure")
+            )
+    return _autoscaler
+
+
+@app.timer_trigger(
+    schedule="0 * * * * *",
+    arg_name="myTimer",
+    run_on_startup=False,
+    use_monitor=False,
+)
+def timer_trigger(myTimer: func.TimerRequest) -> None:
+    sg_autoscaler = _get_autoscaler()
+    sg_autoscaler.start()
+
+
+@app.route(
+    route="scale-out",
+    methods=["POST"],
+    auth_level=func.AuthLevel.FUNCTION,
+)
+def scale_out_trigger(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Webhook for StackGuardian "workflow queued" notifications, runs only
+    the scale out half of a tick. Callers authenticate with a function key.
+    """
+    outcome = _get_autoscaler().scale_out_on_demand()
+    if isinstance(outcome, list):
+        failed = any(result.failed for result in outcome)
+        return func.HttpResponse(
+            json.dumps([result.as_dict() for result in outcome]),
+            status_code=500 if failed else 200,
+            mimetype="application/json",
+        )
+    return func.HttpResponse(outcome)
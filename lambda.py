@@ -1,5 +1,33 @@
+import hmac
+import json
+import os
+
 from stackguardian_autoscaler import StackGuardianAutoscaler
-from aws_service import AwsService
+from multi_group import MultiGroupAutoscaler, create_cloud_service
+
+# Kept at module scope so warm invocations reuse the AWS clients, the
+# StackGuardian connection pool and the cached state document. Nothing is
+# created or imported until the first invocation needs it.
+_autoscaler: StackGuardianAutoscaler = None
+_multi_group_autoscaler: MultiGroupAutoscaler = None
+
+
+def _get_autoscaler() -> StackGuardianAutoscaler:
+    global _autoscaler
+    if _autoscaler is None:
+        _autoscaler = StackGuardianAutoscaler(
+            cloud_service=create_cloud_service("aws")
+        )
+    return _autoscaler
+
+
+def _get_multi_group_autoscaler() -> MultiGroupAutoscaler:
+    global _multi_group_autoscaler
+    if _multi_group_autoscaler is None:
+        _multi_group_autoscaler = MultiGroupAutoscaler.from_config(
+            os.getenv("AUTOSCALER_CONFIG")
+        )
+    return _multi_group_autoscaler
 
 
 def lambda_handler(event, context):
@@ -16,8 +44,17 @@ def lambda_handler(event, context):
     # Log the incoming event for debugging
     print("Received event:", event)
 
+    if os.getenv("AUTOSCALER_CONFIG"):
+        # one tick for every runner group in the config file
+        results = _get_multi_group_autoscaler().start()
+        failed = any(result.failed for result in results)
+        return {
+            "statusCode": 500 if failed else 200,
+            "body": json.dumps([result.as_dict() for result in results]),
+        }
+
     # Process the event (this is a placeholder for your actual logic)
-    autoscaler = StackGuardianAutoscaler(cloud_service=AwsService())
+    autoscaler = _get_autoscaler()
     try:
         autoscaler.start()
 
@@ -27,3 +64,61 @@ def lambda_handler(event, context):
         response = {"statusCode": 500, "body": str(e)}
 
     return response
+
+
+def _authorized(event) -> bool:
+    """
+    Checks the bearer token of webhook calls against WEBHOOK_TOKEN, no call
+    is authorized without it. SQS messages are authorized by the queue's
+    policy.
+    """
+    if "Records" in event:
+        return True
+    token = os.getenv("WEBHOOK_TOKEN")
+    if not token:
+        print("WEBHOOK_TOKEN is not set, refusing the webhook call")
+        return False
+    headers = {
+        name.lower(): value
+        for name, value in (event.get("headers") or {}).items()
+    }
+    return hmac.compare_digest(
+        headers.get("authorization", ""), f"Bearer {token}"
+    )
+
+
+def webhook_handler(event, context):
+    """
+    AWS Lambda handler for StackGuardian "workflow queued" notifications,
+    from a function URL, an API Gateway route or an SQS queue. Runs only
+    the scale out half of a tick, lambda_handler keeps running on its
+    schedule for everything else.
+
+    The notification itself is not parsed, the queue is read from the
+    StackGuardian API; a batch of SQS messages is a single notification.
+
+    Args:
+        event (dict): The function URL, API Gateway or SQS event.
+        context (LambdaContext): The context object provided by AWS Lambda.
+
+    Returns:
+        dict: A response object containing the status code and message.
+    """
+    if not _authorized(event):
+        return {"statusCode": 401, "body": "unauthorized"}
+
+    if os.getenv("AUTOSCALER_CONFIG"):
+        results = _get_multi_group_autoscaler().scale_out_on_demand()
+        failed = any(result.failed for result in results)
+        return {
+            "statusCode": 500 if failed else 200,
+            "body": json.dumps([result.as_dict() for result in results]),
+        }
+
+    try:
+        outcome = _get_autoscaler().scale_out_on_demand()
+        response = {"statusCode": 200, "body": outcome}
+    except Exception as e:
+        response = {"statusCode": 500, "body": str(e)}
+
+    return response
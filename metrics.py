@@ -0,0 +1,294 @@
+"""
+Per tick spans, counters and gauges.
+
+A tick activates a TickMetrics for the current context; the autoscaler,
+the cloud services and the StackGuardian client record into it through
+span(), increment() and gauge(), which do nothing outside of a tick. At the
+end of the tick the metrics are exported in the format set by
+METRICS_FORMAT:
+
+- json: one JSON log line per tick
+- emf: CloudWatch embedded metric format, one log line per tick that
+  CloudWatch turns into metrics
+- openmetrics: OpenMetrics text, e.g. for the node exporter's textfile
+  collector when METRICS_FILE is set
+
+Every value describes a single tick.
+"""
+
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from typing import Dict, Optional, Tuple
+
+METRICS_FORMATS = ("json", "emf", "openmetrics")
+
+# metric name and sorted label items
+MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+_current: ContextVar[Optional["TickMetrics"]] = ContextVar(
+    "tick_metrics", default=None
+)
+
+
+class SpanStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record(self, seconds: float, ok: bool):
+        self.count += 1
+        if not ok:
+            self.errors += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    def as_dict(self) -> Dict:
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "total_seconds": round(self.total_seconds, 4),
+            "max_seconds": round(self.max_seconds, 4),
+        }
+
+
+class TickMetrics:
+    """Everything recorded during one tick, safe to record from threads"""
+
+    def __init__(self, labels: Optional[Dict[str, str]] = None):
+        # added to every metric, e.g. the runner group
+        self.labels = {
+            name: str(value) for name, value in (labels or {}).items()
+        }
+        self.timestamp = time.time()
+        self.spans: Dict[MetricKey, SpanStats] = {}
+        self.counters: Dict[MetricKey, float] = {}
+        self.gauges: Dict[MetricKey, float] = {}
+        self._lock = threading.Lock()
+
+    def record_span(self, name: str, seconds: float, ok: bool, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            if key not in self.spans:
+                self.spans[key] = SpanStats()
+            self.spans[key].record(seconds, ok)
+
+    def increment(self, name: str, value: float = 1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name: str, value: float, **labels):
+        with self._lock:
+            self.gauges[_key(name, labels)] = value
+
+    def as_dict(self) -> Dict:
+        with self._lock:
+            return {
+                "timestamp": round(self.timestamp, 3),
+                "labels": self.labels,
+                "spans": {
+                    _format_key(key): stats.as_dict()
+                    for key, stats in self.spans.items()
+                },
+                "counters": {
+                    _format_key(key): value
+                    for key, value in self.counters.items()
+                },
+                "gauges": {
+                    _format_key(key): value
+                    for key, value in self.gauges.items()
+                },
+            }
+
+
+def _key(name: str, labels: Dict) -> MetricKey:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_key(key: MetricKey) -> str:
+    name, labels = key
+    if not labels:
+        return name
+    return f"{name}{{{','.join(f'{k}={v}' for k, v in labels)}}}"
+
+
+def activate(tick: TickMetrics) -> Token:
+    return _current.set(tick)
+
+
+def deactivate(token: Token):
+    _current.reset(token)
+
+
+def current() -> Optional[TickMetrics]:
+    return _current.get()
+
+
+@contextmanager
+def span(name: str, **labels):
+    """Times the block, recorded as failed when it raises"""
+    tick = _current.get()
+    if tick is None:
+        yield
+        return
+    start = time.perf_counter()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        tick.record_span(name, time.perf_counter() - start, ok, **labels)
+
+
+def observe(name: str, seconds: float, ok: bool = True, **labels):
+    """Records a span that was timed by the caller"""
+    tick = _current.get()
+    if tick is not None:
+        tick.record_span(name, seconds, ok, **labels)
+
+
+def increment(name: str, value: float = 1, **labels):
+    tick = _current.get()
+    if tick is not None:
+        tick.increment(name, value, **labels)
+
+
+def gauge(name: str, value: float, **labels):
+    tick = _current.get()
+    if tick is not None:
+        tick.gauge(name, value, **labels)
+
+
+def format_json(tick: TickMetrics) -> str:
+    return json.dumps({"metrics": tick.as_dict()})
+
+
+def _flat_name(key: MetricKey) -> str:
+    name, labels = key
+    return ".".join([name] + [value for _, value in labels])
+
+
+def format_emf(tick: TickMetrics, namespace: str) -> str:
+    """
+    CloudWatch embedded metric format. The tick labels become dimensions,
+    other labels are folded into the metric name since EMF metrics of one
+    document share their dimensions.
+    """
+    document = dict(tick.labels)
+    metrics = []
+
+    def put(name: str, value: float, unit: str):
+        document[name] = value
+        metrics.append({"Name": name, "Unit": unit})
+
+    with tick._lock:
+        for key, stats in tick.spans.items():
+            name = _flat_name(key)
+            put(f"{name}.count", stats.count, "Count")
+            put(f"{name}.errors", stats.errors, "Count")
+            put(f"{name}.duration", stats.total_seconds * 1000, "Milliseconds")
+            put(f"{name}.max", stats.max_seconds * 1000, "Milliseconds")
+        for key, value in tick.counters.items():
+            put(_flat_name(key), value, "Count")
+        for key, value in tick.gauges.items():
+            put(_flat_name(key), value, "None")
+
+    document["_aws"] = {
+        "Timestamp": int(tick.timestamp * 1000),
+        "CloudWatchMetrics": [
+            {
+                "Namespace": namespace,
+                "Dimensions": [sorted(tick.labels)],
+                # at most 100 metrics per directive
+                "Metrics": metrics[i : i + 100],
+            }
+            for i in range(0, max(len(metrics), 1), 100)
+        ],
+    }
+    return json.dumps(document)
+
+
+def _openmetrics_name(prefix: str, name: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", f"{prefix}_{name}")
+
+
+def _openmetrics_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels.items()
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def format_openmetrics(tick: TickMetrics, prefix: str) -> str:
+    """OpenMetrics text, every metric is a gauge for the last tick"""
+    samples: Dict[str, list] = {}
+
+    def add(name: str, labels: Tuple, value: float):
+        all_labels = dict(tick.labels)
+        all_labels.update(labels)
+        samples.setdefault(_openmetrics_name(prefix, name), []).append(
+            f"{_openmetrics_labels(all_labels)} {value}"
+        )
+
+    with tick._lock:
+        for (name, labels), stats in tick.spans.items():
+            add(f"{name}_count", labels, stats.count)
+            add(f"{name}_errors", labels, stats.errors)
+            add(f"{name}_seconds", labels, round(stats.total_seconds, 6))
+            add(f"{name}_max_seconds", labels, round(stats.max_seconds, 6))
+        for (name, labels), value in tick.counters.items():
+            add(name, labels, value)
+        for (name, labels), value in tick.gauges.items():
+            add(name, labels, value)
+    add("last_tick_timestamp_seconds", (), round(tick.timestamp, 3))
+
+    lines = []
+    for name, values in samples.items():
+        lines.append(f"# TYPE {name} gauge")
+        lines.extend(f"{name}{value}" for value in values)
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+def export(
+    tick: TickMetrics,
+    metrics_format: Optional[str],
+    namespace: str = "StackGuardianAutoscaler",
+    path: Optional[str] = None,
+):
+    """
+    Writes the tick's metrics to stdout, or replaces the file at path so a
+    reader never sees half a tick
+    """
+    if not metrics_format:
+        return
+    if metrics_format == "json":
+        output = format_json(tick) + "\n"
+    elif metrics_format == "emf":
+        output = format_emf(tick, namespace) + "\n"
+    elif metrics_format == "openmetrics":
+        output = format_openmetrics(tick, "stackguardian_autoscaler")
+    else:
+        raise ValueError(f"Unknown METRICS_FORMAT {metrics_format}")
+
+    if path is None:
+        # stdout, where Lambda and Azure Functions pick up EMF and log lines
+        print(output, end="", flush=True)
+        return
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(
+        "w", dir=directory, delete=False
+    ) as metrics_file:
+        metrics_file.write(output)
+    os.replace(metrics_file.name, path)
@@ -0,0 +1,295 @@
+"""
+Autoscales several runner groups from a single process.
+
+The groups are described by a JSON config file, see README.md:
+
+    {
+        "defaults": {"SCALE_OUT_STEP": 2, "SCALE_IN_COOLDOWN_DURATION": 5},
+        "bindings": [
+            {
+                "org": "acme",
+                "runner_group": "linux-small",
+                "cloud": "aws",
+                "scale_group": "sg-runners-small",
+                "policy": {"SCALE_OUT_THRESHOLD": 3}
+            }
+        ]
+    }
+
+Settings are the environment variables the autoscaler and the cloud services
+read; a binding's policy overrides the defaults, which override the
+environment. All groups share one StackGuardian connection pool and the
+process-wide cloud SDK clients, and are reconciled concurrently.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Dict, List, Optional
+
+from sg_api_client import SGApiClient, get_shared_client
+from stackguardian_autoscaler import (
+    CloudService,
+    StackGuardianAutoscaler,
+    get_setting,
+)
+
+# setting holding the scale group's name, per cloud
+SCALE_GROUP_SETTINGS = {
+    "aws": "AWS_ASG_NAME",
+    "azure": "AZURE_VMSS_NAME",
+}
+
+
+def create_cloud_service(
+    provider: str, settings: Optional[Dict[str, str]] = None
+) -> CloudService:
+    """
+    The cloud service of a runner group, over several scale groups when
+    SCALE_POOLS is set, see multi_pool.py
+    """
+    pools = get_setting(settings, "SCALE_POOLS")
+    if pools:
+        from multi_pool import MultiPoolService, load_pools
+
+        return MultiPoolService.from_config(
+            load_pools(pools), provider, settings, _create_scale_group_service
+        )
+    return _create_scale_group_service(provider, settings)
+
+
+def _create_scale_group_service(
+    provider: str, settings: Optional[Dict[str, str]] = None
+) -> CloudService:
+    if provider == "aws":
+        from aws_service import AwsService
+
+        return AwsService(settings=settings)
+    if provider == "azure":
+        from azure_service import AzureService
+
+        return AzureService(settings=settings)
+    raise ValueError(f"Unknown CLOUD_PROVIDER {provider}")
+
+
+class RunnerGroupBinding:
+    """
+    A runner group, the scale group its runners run in, or the pools of
+    scale groups, and its policy
+    """
+
+    def __init__(
+        self,
+        org: str,
+        runner_group: str,
+        cloud: str,
+        scale_group: Optional[str] = None,
+        policy: Optional[Dict] = None,
+        pools: Optional[List[Dict]] = None,
+    ):
+        if cloud not in SCALE_GROUP_SETTINGS:
+            raise ValueError(f"Unknown cloud {cloud} for {org}/{runner_group}")
+        if (scale_group is None) == (pools is None):
+            raise ValueError(
+                f"Either scale_group or pools is needed for {org}/{runner_group}"
+            )
+        self.org = org
+        self.runner_group = runner_group
+        self.cloud = cloud
+        self.scale_group = scale_group
+        self.policy = policy or {}
+        self.pools = pools
+
+    @property
+    def name(self) -> str:
+        return f"{self.org}/{self.runner_group}"
+
+    def settings(self, defaults: Dict) -> Dict[str, str]:
+        settings = {
+            # groups usually share a bucket or container
+            "AUTOSCALER_STATE_BLOB_NAME": f"{self.org}/{self.runner_group}/stackguardian-autoscaler-state.json",
+        }
+        settings.update(defaults)
+        settings.update(self.policy)
+        metrics_file = get_setting(settings, "METRICS_FILE")
+        if metrics_file and "METRICS_FILE" not in self.policy:
+            # every group replaces a file of its own, e.g. metrics.prom
+            # becomes metrics.acme.linux.prom
+            root, ext = os.path.splitext(metrics_file)
+            settings["METRICS_FILE"] = (
+                f"{root}.{self.org}.{self.runner_group}{ext}"
+            )
+        settings.update(
+            {"SG_ORG": self.org, "SG_RUNNER_GROUP": self.runner_group}
+        )
+        if self.pools is not None:
+            settings["SCALE_POOLS"] = json.dumps(self.pools)
+        else:
+            settings[SCALE_GROUP_SETTINGS[self.cloud]] = self.scale_group
+        return {name: str(value) for name, value in settings.items()}
+
+
+class GroupResult:
+    def __init__(
+        self,
+        name: str,
+        status: str,
+        duration_seconds: float = 0.0,
+        error: Optional[str] = None,
+    ):
+        self.name = name
+        # success, failed, timeout or skipped
+        self.status = status
+        self.duration_seconds = duration_seconds
+        self.error = error
+
+    @property
+    def failed(self) -> bool:
+        """
+        Whether the group's tick went wrong. A group skipped because its
+        previous tick is still running is not an error, reporting it as one
+        gets SQS messages redelivered while that tick catches up.
+        """
+        return self.status in ("failed", "timeout")
+
+    def as_dict(self) -> Dict:
+        return {
+            "name": self.name,
+            "status": self.status,
+            "duration_seconds": round(self.duration_seconds, 3),
+            "error": self.error,
+        }
+
+
+def load_config(path: str):
+    """Returns the bindings and the default settings of a config file"""
+    with open(path) as config_file:
+        config = json.load(config_file)
+
+    bindings = [
+        RunnerGroupBinding(
+            org=binding["org"],
+            runner_group=binding["runner_group"],
+            cloud=binding["cloud"],
+            scale_group=binding.get("scale_group"),
+            policy=binding.get("policy"),
+            pools=binding.get("pools"),
+        )
+        for binding in config["bindings"]
+    ]
+    return bindings, config.get("defaults", {})
+
+
+class MultiGroupAutoscaler:
+    def __init__(
+        self,
+        bindings: List[RunnerGroupBinding],
+        defaults: Optional[Dict] = None,
+        sg_client: Optional[SGApiClient] = None,
+    ):
+        self.bindings = bindings
+        self.defaults = defaults or {}
+        self.sg_client = sg_client or get_shared_client()
+
+        self.MAX_CONCURRENT_GROUPS = int(
+            get_setting(self.defaults, "MAX_CONCURRENT_GROUPS", "8")
+        )
+        # a group still running after this is reported as timed out and
+        # left to finish in the background
+        self.GROUP_TIMEOUT_SECONDS = float(
+            get_setting(self.defaults, "GROUP_TIMEOUT_SECONDS", "240")
+        )
+
+        self.autoscalers: Dict[str, StackGuardianAutoscaler] = {}
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.MAX_CONCURRENT_GROUPS,
+            thread_name_prefix="runner-group",
+        )
+        # the last tick of every group, which may still be running
+        self._running: Dict[str, Future] = {}
+        # start() and scale_out_on_demand() may overlap, e.g. a timer and
+        # an HTTP trigger, guards autoscalers and _running
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, path: str) -> "MultiGroupAutoscaler":
+        bindings, defaults = load_config(path)
+        return cls(bindings, defaults)
+
+    def _get_autoscaler(
+        self, binding: RunnerGroupBinding
+    ) -> StackGuardianAutoscaler:
+        with self._lock:
+            if binding.name not in self.autoscalers:
+                settings = binding.settings(self.defaults)
+                self.autoscalers[binding.name] = StackGuardianAutoscaler(
+                    create_cloud_service(binding.cloud, settings=settings),
+                    sg_client=self.sg_client,
+                    settings=settings,
+                )
+            return self.autoscalers[binding.name]
+
+    def _start_group(
+        self, binding: RunnerGroupBinding, action: str
+    ) -> GroupResult:
+        started = time.perf_counter()
+        try:
+            logging.info(f"STACKGUARDIAN: {action} {binding.name}")
+            getattr(self._get_autoscaler(binding), action)()
+        except Exception as e:
+            logging.exception(f"STACKGUARDIAN: {binding.name} failed: {e}")
+            return GroupResult(
+                binding.name, "failed", time.perf_counter() - started, str(e)
+            )
+        return GroupResult(
+            binding.name, "success", time.perf_counter() - started
+        )
+
+    def start(self) -> List[GroupResult]:
+        return self._run("start")
+
+    def scale_out_on_demand(self) -> List[GroupResult]:
+        """StackGuardianAutoscaler.scale_out_on_demand for every group"""
+        return self._run("scale_out_on_demand")
+
+    def _run(self, action: str) -> List[GroupResult]:
+        started = time.perf_counter()
+        results: Dict[str, GroupResult] = {}
+        futures: Dict[str, Future] = {}
+        with self._lock:
+            for binding in self.bindings:
+                previous = self._running.get(binding.name)
+                if previous is not None and not previous.done():
+                    # never run two ticks of the same group at once
+                    results[binding.name] = GroupResult(
+                        binding.name,
+                        "skipped",
+                        error="previous tick still running",
+                    )
+                    continue
+                futures[binding.name] = self.executor.submit(
+                    self._start_group, binding, action
+                )
+                self._running[binding.name] = futures[binding.name]
+
+        wait(futures.values(), timeout=self.GROUP_TIMEOUT_SECONDS)
+
+        for name, future in futures.items():
+            if future.done():
+                results[name] = future.result()
+            else:
+                results[name] = GroupResult(
+                    name,
+                    "timeout",
+                    time.perf_counter() - started,
+                    f"still running after {self.GROUP_TIMEOUT_SECONDS}s",
+                )
+
+        ordered = [results[binding.name] for binding in self.bindings]
+        logging.info(
+            f"STACKGUARDIAN: runner groups {[result.as_dict() for result in ordered]}"
+        )
+        return ordered
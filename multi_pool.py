@@ -0,0 +1,568 @@
+"""
+Scales one runner group over several scale groups, e.g. ASG's or scale sets
+of different instance sizes, spot and on-demand. The pools are described by
+the SCALE_POOLS setting, a JSON list, see README.md:
+
+    [
+        {
+            "name": "spot-large",
+            "scale_group": "sg-runners-spot-large",
+            "runner_concurrency": 4,
+            "hourly_cost": 0.12,
+            "spot": true,
+            "boot_seconds": 150,
+            "max_vms": 20
+        },
+        {
+            "name": "on-demand-small",
+            "scale_group": "sg-runners-small",
+            "hourly_cost": 0.05
+        }
+    ]
+
+The autoscaler keeps deciding in runners of RUNNER_CONCURRENCY workflows.
+MultiPoolService turns the runners it adds into workflow slots and places
+them with plan_placement: pools that boot within TARGET_QUEUE_WAIT_SECONDS
+before slower ones, spot before on-demand, and within that the cheapest mix
+of VM's. A pool that could not launch the VM's it was asked for is skipped
+for POOL_CAPACITY_BACKOFF_MINUTES and its VM's are placed elsewhere.
+"""
+
+import json
+import logging
+import math
+import os
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+import metrics
+from multi_group import SCALE_GROUP_SETTINGS
+from rate_limit import DeferredError
+from stackguardian_autoscaler import (
+    CloudService,
+    InventoryJoin,
+    SGRunner,
+    get_setting,
+)
+
+
+class ScalePool:
+    """A scale group of VM's of one size and price"""
+
+    def __init__(
+        self,
+        name: str,
+        cloud_service: CloudService,
+        hourly_cost: float,
+        runner_concurrency: int = 1,
+        spot: bool = False,
+        boot_seconds: float = 180.0,
+        max_vms: Optional[int] = None,
+    ):
+        self.name = name
+        self.cloud_service = cloud_service
+        self.hourly_cost = hourly_cost
+        # workflows a runner on one of the pool's VM's runs at once
+        self.runner_concurrency = runner_concurrency
+        self.spot = spot
+        # until a new VM's runner takes workflows
+        self.boot_seconds = boot_seconds
+        self.max_vms = max_vms
+
+    @property
+    def cost_per_slot(self) -> float:
+        return self.hourly_cost / self.runner_concurrency
+
+
+def plan_placement(
+    pools: List[ScalePool],
+    slots: int,
+    headroom: Dict[str, Optional[int]],
+    target_wait_seconds: Optional[float] = None,
+) -> Dict[str, int]:
+    """
+    VM's to add per pool name for slots more concurrent workflows, at most
+    headroom VM's per pool, None for no limit. Pools are used in tiers:
+    those booting within target_wait_seconds before slower ones, spot
+    before on-demand. Within a tier the cheapest mix of VM's covering the
+    slots is picked, a tier too small for them is used up entirely.
+    """
+
+    def tier(pool: ScalePool) -> Tuple[bool, bool]:
+        slow = (
+            target_wait_seconds is not None
+            and pool.boot_seconds > target_wait_seconds
+        )
+        return (slow, not pool.spot)
+
+    placement: Dict[str, int] = {}
+    for key in sorted({tier(pool) for pool in pools}):
+        if slots <= 0:
+            break
+        tier_pools = [
+            pool
+            for pool in pools
+            if tier(pool) == key and headroom.get(pool.name, 0) != 0
+        ]
+        capacity = sum(
+            (
+                math.inf
+                if headroom[pool.name] is None
+                else headroom[pool.name] * pool.runner_concurrency
+            )
+            for pool in tier_pools
+        )
+        if capacity == 0:
+            continue
+        if capacity < slots:
+            for pool in tier_pools:
+                placement[pool.name] = headroom[pool.name]
+            slots -= capacity
+            continue
+        placement.update(_cheapest_cover(tier_pools, slots, headroom))
+        slots = 0
+    return {name: vms for name, vms in placement.items() if vms > 0}
+
+
+def _cheapest_cover(
+    pools: List[ScalePool], slots: int, headroom: Dict[str, Optional[int]]
+) -> Dict[str, int]:
+    """
+    The cheapest VM's of pools with at least slots workflow slots, fewest
+    VM's on a tie. A bounded knapsack over the slots: every pool's VM's are
+    split into chunks of 1, 2, 4, ... VM's that are each taken or not.
+    """
+    chunks: List[Tuple[ScalePool, int]] = []
+    for pool in pools:
+        count = math.ceil(slots / pool.runner_concurrency)
+        if headroom[pool.name] is not None:
+            count = min(count, headroom[pool.name])
+        size = 1
+        while count > 0:
+            chunks.append((pool, min(size, count)))
+            count -= size
+            size *= 2
+
+    # best[s] is the cheapest (cost, VM's, chunks) with at least s slots
+    best: List[Optional[Tuple[float, int, Tuple[int, ...]]]] = [None] * (
+        slots + 1
+    )
+    best[0] = (0.0, 0, ())
+    for index, (pool, vms) in enumerate(chunks):
+        added_slots = vms * pool.runner_concurrency
+        added_cost = vms * pool.hourly_cost
+        # from the top down, so every chunk is taken at most once
+        for covered in range(slots - 1, -1, -1):
+            if best[covered] is None:
+                continue
+            cost, count, taken = best[covered]
+            candidate = (cost + added_cost, count + vms, taken + (index,))
+            target = min(slots, covered + added_slots)
+            if best[target] is None or candidate[:2] < best[target][:2]:
+                best[target] = candidate
+
+    placement: Dict[str, int] = {}
+    for index in best[slots][2]:
+        pool, vms = chunks[index]
+        placement[pool.name] = placement.get(pool.name, 0) + vms
+    return placement
+
+
+class MultiPoolService(CloudService):
+    """
+    A cloud service over the scale groups of several pools. Runners and
+    VM's are routed to the pool whose scale group has the runner's VM; the
+    state document, cooldowns and lease are the first pool's.
+    """
+
+    def __init__(
+        self,
+        pools: List[ScalePool],
+        settings: Optional[Dict[str, str]] = None,
+        clock: Callable[[], datetime] = datetime.now,
+    ):
+        if len(pools) == 0:
+            raise ValueError("SCALE_POOLS has no pools")
+        self.pools = pools
+        self.pools_by_name = {pool.name: pool for pool in pools}
+        self.settings = settings
+        self.clock = clock
+        self.state_store = pools[0].cloud_service.state_store
+
+        # the autoscaler's runners, the unit it scales in
+        self.RUNNER_CONCURRENCY = int(self._getenv("RUNNER_CONCURRENCY", "1"))
+        # pools whose VM's take longer than this to take workflows are only
+        # scaled out once the faster ones are at max_vms, empty disables it
+        target_wait = self._getenv("TARGET_QUEUE_WAIT_SECONDS", "300")
+        self.target_wait_seconds = float(target_wait) if target_wait else None
+        # how long a pool that could not launch VM's is left alone
+        self.capacity_backoff = timedelta(
+            minutes=float(self._getenv("POOL_CAPACITY_BACKOFF_MINUTES", "10"))
+        )
+
+        # pools of runners by runnerID, found again every tick
+        self._runner_pools: Dict[str, Optional[ScalePool]] = {}
+        # pools_unavailable_until without a state store
+        self._unavailable: Dict[str, str] = {}
+
+    @classmethod
+    def from_config(
+        cls,
+        pools: List[Dict],
+        provider: str,
+        settings: Optional[Dict[str, str]],
+        create_cloud_service: Callable[[str, Dict[str, str]], CloudService],
+    ) -> "MultiPoolService":
+        """
+        Creates the cloud service of every pool in a SCALE_POOLS config with
+        settings, the pool's scale group and a state document of its own
+        """
+        state_name = get_setting(
+            settings,
+            "AUTOSCALER_STATE_BLOB_NAME",
+            "stackguardian-autoscaler-state.json",
+        )
+        scale_pools = []
+        for index, pool in enumerate(pools):
+            cloud = pool.get("cloud", provider)
+            if cloud not in SCALE_GROUP_SETTINGS:
+                raise ValueError(f"Unknown cloud {cloud} for {pool['name']}")
+            pool_settings = dict(settings or {})
+            pool_settings.update(pool.get("settings", {}))
+            pool_settings[SCALE_GROUP_SETTINGS[cloud]] = pool["scale_group"]
+            # the first pool keeps the runner group's own state document
+            if index > 0:
+                root, ext = os.path.splitext(state_name)
+                pool_settings["AUTOSCALER_STATE_BLOB_NAME"] = (
+                    f"{root}.{pool['name']}{ext}"
+                )
+            scale_pools.append(
+                ScalePool(
+                    name=pool["name"],
+                    cloud_service=create_cloud_service(
+                        cloud,
+                        {
+                            name: str(value)
+                            for name, value in pool_settings.items()
+                        },
+                    ),
+                    hourly_cost=float(pool["hourly_cost"]),
+                    runner_concurrency=int(pool.get("runner_concurrency", 1)),
+                    spot=bool(pool.get("spot", False)),
+                    boot_seconds=float(pool.get("boot_seconds", 180)),
+                    max_vms=pool.get("max_vms"),
+                )
+            )
+        return cls(scale_pools, settings=settings)
+
+    def _preferred(self) -> List[ScalePool]:
+        """Pools in the order plan_placement uses them, cheapest first"""
+        return sorted(
+            self.pools,
+            key=lambda pool: (
+                self.target_wait_seconds is not None
+                and pool.boot_seconds > self.target_wait_seconds,
+                not pool.spot,
+                pool.cost_per_slot,
+            ),
+        )
+
+    def refresh(self):
+        for pool in self.pools:
+            pool.cloud_service.refresh()
+        self._runner_pools = {}
+
+    def flush_state(self):
+        for pool in self.pools:
+            pool.cloud_service.flush_state()
+
+    def get_last_scale_out_event(self) -> Optional[datetime]:
+        return self.pools[0].cloud_service.get_last_scale_out_event()
+
+    def set_last_scale_out_event(self, timestamp: datetime):
+        self.pools[0].cloud_service.set_last_scale_out_event(timestamp)
+
+    def get_last_scale_in_event(self) -> Optional[datetime]:
+        return self.pools[0].cloud_service.get_last_scale_in_event()
+
+    def set_last_scale_in_event(self, timestamp: datetime):
+        self.pools[0].cloud_service.set_last_scale_in_event(timestamp)
+
+    def _pool_of(self, sg_runner: SGRunner) -> Optional[ScalePool]:
+        if sg_runner.runnerID not in self._runner_pools:
+            self._runner_pools[sg_runner.runnerID] = next(
+                (
+                    pool
+                    for pool in self.pools
+                    if not pool.cloud_service.get_unmatched_runners(
+                        [sg_runner]
+                    )
+                ),
+                None,
+            )
+        return self._runner_pools[sg_runner.runnerID]
+
+    def _by_pool(
+        self, sg_runners: List[SGRunner]
+    ) -> List[Tuple[ScalePool, List[SGRunner]]]:
+        by_pool: Dict[str, List[SGRunner]] = {}
+        for sg_runner in sg_runners:
+            pool = self._pool_of(sg_runner)
+            if pool is not None:
+                by_pool.setdefault(pool.name, []).append(sg_runner)
+        return [
+            (self.pools_by_name[name], pool_runners)
+            for name, pool_runners in by_pool.items()
+        ]
+
+    def runner_capacity(self, sg_runner: SGRunner) -> Optional[int]:
+        pool = self._pool_of(sg_runner)
+        return pool.runner_concurrency if pool is not None else None
+
+    def runner_hourly_cost(self, sg_runner: SGRunner) -> Optional[float]:
+        pool = self._pool_of(sg_runner)
+        return pool.hourly_cost if pool is not None else None
+
+    def count_of_existing_vms(self) -> int:
+        return sum(
+            pool.cloud_service.count_of_existing_vms() for pool in self.pools
+        )
+
+    def count_of_standby_vms(self) -> int:
+        return sum(
+            pool.cloud_service.count_of_standby_vms() for pool in self.pools
+        )
+
+    def resume_standby_vms(self, count: int) -> int:
+        resumed = 0
+        for pool in self._preferred():
+            if resumed >= count:
+                break
+            resumed += pool.cloud_service.resume_standby_vms(count - resumed)
+        return resumed
+
+    def configure_standby_pool(self, max_size: int):
+        for pool in self.pools:
+            pool.cloud_service.configure_standby_pool(max_size)
+
+    def set_standby_pool_size(self, size: int):
+        """
+        Keeps the standby VM's in the preferred on-demand pool, spot VM's
+        are not kept stopped
+        """
+        preferred = self._preferred()
+        standby_pool = next(
+            (pool for pool in preferred if not pool.spot), preferred[0]
+        )
+        for pool in self.pools:
+            pool.cloud_service.set_standby_pool_size(
+                size if pool is standby_pool else 0
+            )
+
+    def _unavailable_until(self) -> Dict[str, str]:
+        if self.state_store is None:
+            return self._unavailable
+        return self.state_store.get().pools_unavailable_until
+
+    def _headroom(self) -> Dict[str, Optional[int]]:
+        """VM's every pool can still add, 0 while it is backing off"""
+        timestamp_now = self.clock()
+        unavailable_until = self._unavailable_until()
+        headroom = {}
+        for pool in self.pools:
+            until = unavailable_until.get(pool.name)
+            if until and datetime.fromisoformat(until) > timestamp_now:
+                headroom[pool.name] = 0
+            elif pool.max_vms is None:
+                headroom[pool.name] = None
+            else:
+                headroom[pool.name] = max(
+                    0,
+                    pool.max_vms - pool.cloud_service.count_of_existing_vms(),
+                )
+        return headroom
+
+    def _back_off(self, pool: ScalePool):
+        until = self.clock() + self.capacity_backoff
+        logging.info(
+            f"STACKGUARDIAN: pool {pool.name} could not launch VM's, skipping it until {until.isoformat()}"
+        )
+        metrics.increment("pool_capacity_errors", pool=pool.name)
+        unavailable_until = dict(self._unavailable_until())
+        unavailable_until[pool.name] = until.isoformat()
+        if self.state_store is None:
+            self._unavailable = unavailable_until
+            return
+        # written with the rest of the state at the end of the tick
+        self.state_store.update(pools_unavailable_until=unavailable_until)
+
+    def _place(self, slots: int) -> int:
+        """
+        Adds VM's for slots more workflows, falling back to the other pools
+        when a pool fails, returns the number of VM's added
+        """
+        added = 0
+        while slots > 0:
+            headroom = self._headroom()
+            placement = plan_placement(
+                self.pools, slots, headroom, self.target_wait_seconds
+            )
+            if len(placement) == 0:
+                logging.info(
+                    f"STACKGUARDIAN: no pool has room for {slots} more workflows"
+                )
+                break
+            logging.info(f"STACKGUARDIAN: placing VM's {placement}")
+            failed_slots = 0
+            for name, vms in placement.items():
+                pool = self.pools_by_name[name]
+                try:
+                    pool.cloud_service.set_autoscale_vms(
+                        pool.cloud_service.count_of_existing_vms() + vms
+                    )
+                except DeferredError:
+                    raise
+                except Exception as e:
+                    logging.info(
+                        f"STACKGUARDIAN: adding VM's to pool {name} failed: {e}"
+                    )
+                    self._back_off(pool)
+                    failed_slots += vms * pool.runner_concurrency
+                    continue
+                added += vms
+                metrics.increment("vms_placed", vms, pool=name)
+            # the failed pools have no headroom on the next round
+            slots = failed_slots
+        return added
+
+    def set_autoscale_vms(self, count_of_vms: int):
+        """
+        Places the runners added on top of count_of_existing_vms as workflow
+        slots, or lowers the most expensive pools first
+        """
+        change = count_of_vms - self.count_of_existing_vms()
+        if change > 0:
+            self._place(change * self.RUNNER_CONCURRENCY)
+            return
+        for pool in reversed(self._preferred()):
+            if change >= 0:
+                break
+            existing = pool.cloud_service.count_of_existing_vms()
+            removed = min(existing, -change)
+            if removed > 0:
+                pool.cloud_service.set_autoscale_vms(existing - removed)
+                change += removed
+
+    def replace_unfulfilled_vms(self) -> int:
+        """
+        Gives up on VM's a pool could not launch and places their workflow
+        slots in the other pools
+        """
+        slots = 0
+        for pool in self.pools:
+            unfulfilled = pool.cloud_service.count_of_unfulfilled_vms()
+            if unfulfilled == 0:
+                continue
+            logging.info(
+                f"STACKGUARDIAN: pool {pool.name} is short of {unfulfilled} VM's"
+            )
+            self._back_off(pool)
+            pool.cloud_service.set_autoscale_vms(
+                pool.cloud_service.count_of_existing_vms() - unfulfilled
+            )
+            slots += unfulfilled * pool.runner_concurrency
+        if slots == 0:
+            return 0
+        return self._place(slots)
+
+    def add_scale_in_protection(self, sg_runner: SGRunner):
+        self.add_scale_in_protection_bulk([sg_runner])
+
+    def remove_scale_in_protection(self, sg_runner: SGRunner):
+        self.remove_scale_in_protection_bulk([sg_runner])
+
+    def add_scale_in_protection_bulk(self, sg_runners: List[SGRunner]):
+        for pool, pool_runners in self._by_pool(sg_runners):
+            pool.cloud_service.add_scale_in_protection_bulk(pool_runners)
+
+    def remove_scale_in_protection_bulk(self, sg_runners: List[SGRunner]):
+        for pool, pool_runners in self._by_pool(sg_runners):
+            pool.cloud_service.remove_scale_in_protection_bulk(pool_runners)
+
+    def get_unmatched_runners(
+        self, sg_runners: List[SGRunner]
+    ) -> List[SGRunner]:
+        return [
+            sg_runner
+            for sg_runner in sg_runners
+            if self._pool_of(sg_runner) is None
+        ]
+
+    def join_inventory(self, sg_runners: List[SGRunner]) -> InventoryJoin:
+        """
+        Joins the runners with every pool's VM's. Orphan VM's are named
+        <pool>/<id>, ids are only unique within a scale group. Also records
+        the fleet's cost and throughput per dollar.
+        """
+        join = InventoryJoin()
+        matched = set()
+        for pool in self.pools:
+            pool_join = pool.cloud_service.join_inventory(sg_runners)
+            ghosts = set(pool_join.ghost_runners)
+            for sg_runner in sg_runners:
+                if sg_runner not in ghosts:
+                    matched.add(sg_runner)
+                    self._runner_pools.setdefault(sg_runner.runnerID, pool)
+            join.orphan_vms.extend(
+                f"{pool.name}/{vm_id}" for vm_id in pool_join.orphan_vms
+            )
+        for sg_runner in sg_runners:
+            if sg_runner not in matched:
+                join.ghost_runners.append(sg_runner)
+                self._runner_pools[sg_runner.runnerID] = None
+        self._record_fleet()
+        return join
+
+    def _record_fleet(self):
+        slots = 0
+        hourly_cost = 0.0
+        for pool in self.pools:
+            vms = pool.cloud_service.count_of_existing_vms()
+            metrics.gauge("pool_vms", vms, pool=pool.name)
+            slots += vms * pool.runner_concurrency
+            hourly_cost += vms * pool.hourly_cost
+        metrics.gauge("fleet_hourly_cost", hourly_cost)
+        if hourly_cost > 0:
+            # workflow slot hours per dollar
+            metrics.gauge("throughput_per_dollar", slots / hourly_cost)
+
+    def terminate_orphan_vms(self, vm_ids: List[str]) -> int:
+        by_pool: Dict[str, List[str]] = {}
+        for vm_id in vm_ids:
+            name, _, pool_vm_id = vm_id.partition("/")
+            if name in self.pools_by_name:
+                by_pool.setdefault(name, []).append(pool_vm_id)
+        return sum(
+            self.pools_by_name[name].cloud_service.terminate_orphan_vms(ids)
+            for name, ids in by_pool.items()
+        )
+
+    def terminate_deferred_vms(self) -> int:
+        # every pool keeps the terminations it deferred in its own state
+        return sum(
+            pool.cloud_service.terminate_deferred_vms() for pool in self.pools
+        )
+
+    def terminate_runner_vms(self, sg_runners: List[SGRunner]) -> int:
+        return sum(
+            pool.cloud_service.terminate_runner_vms(pool_runners)
+            for pool, pool_runners in self._by_pool(sg_runners)
+        )
+
+
+def load_pools(value: str) -> List[Dict]:
+    """The pools of a SCALE_POOLS setting, JSON or the path of a JSON file"""
+    if value.lstrip().startswith("["):
+        return json.loads(value)
+    with open(value) as pools_file:
+        return json.load(pools_file)
@@ -0,0 +1,156 @@
+"""
+Client side rate limits for the StackGuardian and cloud APIs.
+
+Every API has a token bucket shared by everything in the process, e.g. all
+runner groups of a daemon. Its rate adapts to throttling like TCP's AIMD:
+it halves when the API throttles a call and grows back by a small step with
+every call that goes through. The rates start from RATE_LIMIT_<API>, in
+calls per second, e.g. RATE_LIMIT_SG=10; bursts of twice the rate are
+allowed.
+
+A call waits for a token, but never past the deadline of the current tick.
+Calls that would have to raise DeferredError instead, as do calls the API
+keeps throttling after their retries. The autoscaler leaves such work to
+the next tick rather than failing the tick.
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+import metrics
+
+# calls per second by API, well below the documented limits
+DEFAULT_RATES = {
+    "sg": 10.0,
+    "asg": 5.0,
+    "ec2": 20.0,
+    "vmss": 5.0,
+}
+
+# time.monotonic() the current tick has to be done by
+_deadline: ContextVar[Optional[float]] = ContextVar(
+    "tick_deadline", default=None
+)
+
+
+class DeferredError(Exception):
+    """The call was not made, it is left to the next tick"""
+
+
+class ThrottledError(DeferredError):
+    """The API kept throttling the call after its retries"""
+
+
+class TokenBucket:
+    def __init__(
+        self,
+        rate: float,
+        burst: float,
+        increase: Optional[float] = None,
+        decrease: float = 0.5,
+    ):
+        self.max_rate = rate
+        self.min_rate = rate / 20
+        self.rate = rate
+        self.burst = burst
+        # the rate recovers from halving within about 10 calls
+        self.increase = rate / 20 if increase is None else increase
+        self.decrease = decrease
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    def acquire(self, deadline: Optional[float] = None) -> bool:
+        """
+        Takes a token, waiting for it until deadline at the latest. Returns
+        False without waiting when it would not come in time.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def throttled(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            # no burst right after being throttled
+            self.tokens = min(self.tokens, 0.0)
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+
+_buckets: Dict[str, TokenBucket] = {}
+_buckets_lock = threading.Lock()
+
+
+def get_bucket(api: str) -> TokenBucket:
+    with _buckets_lock:
+        if api not in _buckets:
+            rate = float(
+                os.getenv(f"RATE_LIMIT_{api.upper()}", DEFAULT_RATES[api])
+            )
+            _buckets[api] = TokenBucket(rate, burst=2 * rate)
+        return _buckets[api]
+
+
+@contextmanager
+def tick_budget(seconds: Optional[float]):
+    """Calls made in the block are deferred once seconds have passed"""
+    token = _deadline.set(
+        time.monotonic() + seconds if seconds is not None else None
+    )
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """Seconds left in the current tick, None without a budget"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def acquire(api: str):
+    """Waits for the API's rate limit, raises DeferredError past the tick"""
+    if not get_bucket(api).acquire(_deadline.get()):
+        metrics.increment("calls_deferred", service=api)
+        raise DeferredError(f"No time left in the tick for a {api} call")
+
+
+def throttled(api: str):
+    metrics.increment("throttles", service=api)
+    get_bucket(api).throttled()
+
+
+def succeeded(api: str):
+    get_bucket(api).succeeded()
+
+
+def sleep(seconds: float):
+    """Sleeps, e.g. before a retry, unless it ends past the tick"""
+    left = remaining()
+    if left is not None and seconds > left:
+        raise DeferredError("No time left in the tick to retry")
+    time.sleep(seconds)
@@ -0,0 +1,233 @@
+"""
+Capacity schedules: floors and ceilings for the number of runners that
+follow the working week, e.g. keep runners warm during office hours and
+none at night. The schedule is the CAPACITY_SCHEDULE setting, JSON or the
+path of a JSON file, see README.md:
+
+    {
+        "timezone": "Europe/Berlin",
+        "prewarm_minutes": 15,
+        "holidays": ["2026-12-24", "2026-12-25"],
+        "windows": [
+            {
+                "name": "office-hours",
+                "cron": "0 8 * * 1-5",
+                "duration_minutes": 600,
+                "min_runners": 5,
+                "max_runners": 40
+            },
+            {
+                "name": "nightly-release",
+                "cron": "30 1 * * *",
+                "duration_minutes": 60,
+                "min_runners": 10,
+                "prewarm_minutes": 30,
+                "holidays": "include"
+            }
+        ]
+    }
+
+A window starts at every time its cron expression matches, in the
+schedule's timezone, and lasts duration_minutes. It applies from
+prewarm_minutes before its start, so VM's have booted and registered by
+then. Windows starting on a holiday are skipped, unless the window sets
+holidays to "include", or to "only" for windows that apply on holidays
+alone. While windows apply, the floor is the highest of their min_runners
+and the ceiling the highest of their max_runners; outside of windows, or
+for limits no window sets, MIN_RUNNERS and MAX_RUNNERS apply.
+"""
+
+import json
+from datetime import date, datetime, timedelta, tzinfo
+from typing import Callable, Dict, List, NamedTuple, Optional, Set
+from zoneinfo import ZoneInfo
+
+# minute, hour, day of month, month, day of week
+_CRON_FIELDS = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+HOLIDAY_MODES = ("skip", "include", "only")
+
+
+def _parse_cron_field(field: str, low: int, high: int) -> Set[int]:
+    values = set()
+    for part in field.split(","):
+        value_range, _, step = part.partition("/")
+        if value_range == "*":
+            first, last = low, high
+        elif "-" in value_range:
+            first, last = (int(value) for value in value_range.split("-"))
+        else:
+            first = int(value_range)
+            # "5/15" runs from 5 to the end of the range
+            last = high if step else first
+        if first < low or last > high or first > last:
+            raise ValueError(f"Cron field {field} out of range {low}-{high}")
+        values.update(range(first, last + 1, int(step) if step else 1))
+    return values
+
+
+class CronExpression:
+    """The five fields of a cron expression, e.g. 0 8 * * 1-5"""
+
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression {expression} needs 5 fields")
+        self.expression = expression
+        (
+            self.minutes,
+            self.hours,
+            self.days,
+            self.months,
+            weekdays,
+        ) = (
+            _parse_cron_field(field, low, high)
+            for field, (low, high) in zip(fields, _CRON_FIELDS)
+        )
+        # 0 and 7 are both Sunday, isoweekday() % 7 counts from Sunday too
+        self.weekdays = {weekday % 7 for weekday in weekdays}
+        # like cron, a restricted day of month or day of week matches on
+        # either of them
+        self.days_restricted = fields[2] != "*"
+        self.weekdays_restricted = fields[4] != "*"
+        # latest first, for latest_before
+        self._times = sorted(
+            ((hour, minute) for hour in self.hours for minute in self.minutes),
+            reverse=True,
+        )
+
+    def matches_day(self, day: date) -> bool:
+        if day.month not in self.months:
+            return False
+        day_match = day.day in self.days
+        weekday_match = day.isoweekday() % 7 in self.weekdays
+        if self.days_restricted and self.weekdays_restricted:
+            return day_match or weekday_match
+        return day_match and weekday_match
+
+    def latest_before(
+        self,
+        until: datetime,
+        since: datetime,
+        accept_day: Callable[[date], bool] = lambda day: True,
+    ) -> Optional[datetime]:
+        """
+        The latest match after since and at or before until, both aware
+        datetimes, on a day accept_day accepts. Only the days in between are
+        looked at, a window's duration rather than every minute of the week.
+        """
+        tz = until.tzinfo
+        day = until.date()
+        while day >= since.date():
+            if self.matches_day(day) and accept_day(day):
+                for hour, minute in self._times:
+                    match = datetime(
+                        day.year, day.month, day.day, hour, minute, tzinfo=tz
+                    )
+                    if match <= until:
+                        if match > since:
+                            return match
+                        break
+            day -= timedelta(days=1)
+        return None
+
+
+class CapacityWindow:
+    def __init__(self, config: Dict, prewarm_minutes: float = 0):
+        self.cron = CronExpression(config["cron"])
+        self.name = config.get("name", self.cron.expression)
+        self.duration = timedelta(minutes=float(config["duration_minutes"]))
+        self.prewarm = timedelta(
+            minutes=float(config.get("prewarm_minutes", prewarm_minutes))
+        )
+        self.min_runners: Optional[int] = config.get("min_runners")
+        self.max_runners: Optional[int] = config.get("max_runners")
+        self.holidays = config.get("holidays", "skip")
+        if self.holidays not in HOLIDAY_MODES:
+            raise ValueError(
+                f"Window {self.name} holidays must be one of {HOLIDAY_MODES}"
+            )
+
+    def starts_on(self, day: date, holidays: Set[date]) -> bool:
+        if self.holidays == "skip":
+            return day not in holidays
+        if self.holidays == "only":
+            return day in holidays
+        return True
+
+    def applies(self, now: datetime, holidays: Set[date]) -> bool:
+        """
+        Whether the window starts within prewarm after now or started less
+        than its duration before now
+        """
+        start = self.cron.latest_before(
+            now + self.prewarm,
+            now - self.duration,
+            lambda day: self.starts_on(day, holidays),
+        )
+        return start is not None
+
+
+class CapacityLimits(NamedTuple):
+    min_runners: int
+    max_runners: Optional[int]
+    # names of the windows that apply
+    windows: List[str]
+
+
+class CapacitySchedule:
+    def __init__(self, config: Dict):
+        self.timezone: tzinfo = ZoneInfo(config.get("timezone", "UTC"))
+        self.holidays = {
+            date.fromisoformat(holiday)
+            for holiday in config.get("holidays", [])
+        }
+        prewarm_minutes = float(config.get("prewarm_minutes", 0))
+        self.windows = [
+            CapacityWindow(window, prewarm_minutes)
+            for window in config.get("windows", [])
+        ]
+
+    def limits(
+        self,
+        now: datetime,
+        min_runners: int = 0,
+        max_runners: Optional[int] = None,
+    ) -> CapacityLimits:
+        """
+        The floor and ceiling at now, min_runners and max_runners where no
+        window applies. A naive now is taken as local time.
+        """
+        now = now.astimezone(self.timezone)
+        windows = [
+            window
+            for window in self.windows
+            if window.applies(now, self.holidays)
+        ]
+        floors = [w.min_runners for w in windows if w.min_runners is not None]
+        ceilings = [
+            w.max_runners for w in windows if w.max_runners is not None
+        ]
+        if floors:
+            min_runners = max(floors)
+        if ceilings:
+            max_runners = max(ceilings)
+        if max_runners is not None:
+            # a window's floor wins over a ceiling it does not set itself
+            max_runners = max(max_runners, min_runners)
+        return CapacityLimits(
+            min_runners, max_runners, [window.name for window in windows]
+        )
+
+
+def load_schedule(value: Optional[str]) -> Optional[CapacitySchedule]:
+    """
+    The schedule of a CAPACITY_SCHEDULE setting, JSON or the path of a JSON
+    file, None when unset
+    """
+    if not value:
+        return None
+    if value.lstrip().startswith("{"):
+        return CapacitySchedule(json.loads(value))
+    with open(value) as schedule_file:
+        return CapacitySchedule(json.load(schedule_file))
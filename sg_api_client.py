@@ -0,0 +1,302 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+from typing import IO, Dict, Iterator, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+import metrics
+import rate_limit
+
+_shared_client: Optional["SGApiClient"] = None
+_shared_client_lock = threading.Lock()
+
+
+def get_shared_client() -> "SGApiClient":
+    """
+    SGApiClient configured from the environment, shared by everything in the
+    process so its connection pool stays warm across invocations.
+    """
+    global _shared_client
+    with _shared_client_lock:
+        if _shared_client is None:
+            _shared_client = SGApiClient.from_env()
+        return _shared_client
+
+
+# the parts of a runner group response the autoscaler reads
+_QUEUED_WORKFLOWS_PREFIX = "msg.QueuedWorkflowsCount"
+_RUNNER_PREFIX = "msg.ContainerInstances.item"
+
+# the json fallback is logged once per process
+_json_fallback_logged = False
+
+
+def iter_runner_group(stream: IO[bytes]) -> Iterator[Tuple[str, object]]:
+    """
+    Parses a runner group response while it is read, yielding
+    ("QueuedWorkflowsCount", count) and ("runner", runner) for every runner,
+    so at most one runner's dict is built at a time. Without ijson installed
+    the whole document is loaded with json instead.
+    """
+    global _json_fallback_logged
+    try:
+        import ijson
+    except ImportError:
+        if not _json_fallback_logged:
+            logging.warning(
+                "STACKGUARDIAN: ijson is not installed, the runner group is loaded whole with json"
+            )
+            _json_fallback_logged = True
+        msg = json.load(stream).get("msg") or {}
+        if "QueuedWorkflowsCount" in msg:
+            yield "QueuedWorkflowsCount", msg["QueuedWorkflowsCount"]
+        for runner in msg.get("ContainerInstances") or []:
+            yield "runner", runner
+        return
+
+    builder = None
+    for prefix, event, value in ijson.parse(stream, use_float=True):
+        if builder is not None:
+            builder.event(event, value)
+            # the end of the runner, not of a map nested in it
+            if prefix == _RUNNER_PREFIX and event == "end_map":
+                yield "runner", builder.value
+                builder = None
+        elif prefix == _RUNNER_PREFIX and event == "start_map":
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+        elif prefix == _QUEUED_WORKFLOWS_PREFIX:
+            yield "QueuedWorkflowsCount", value
+
+
+def _never_sent(e: requests.RequestException) -> bool:
+    """Whether a request failed before it could reach the server"""
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0], "reason", None) if e.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+class EndpointStats:
+    """Latency counters for a single StackGuardian API endpoint"""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record(self, seconds: float, ok: bool):
+        self.calls += 1
+        if not ok:
+            self.errors += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    @property
+    def avg_seconds(self) -> float:
+        return self.total_seconds / self.calls if self.calls else 0.0
+
+    def as_dict(self) -> Dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "retries": self.retries,
+            "total_seconds": round(self.total_seconds, 4),
+            "avg_seconds": round(self.avg_seconds, 4),
+            "max_seconds": round(self.max_seconds, 4),
+        }
+
+
+class SGApiClient:
+    """
+    Client for the StackGuardian runner group API.
+
+    Keeps a single keep-alive connection pool for the lifetime of the client,
+    retries 429 and 5xx responses with jittered exponential backoff and
+    records per-endpoint latency. POST calls, which drain and deregister
+    runners, are only retried when the server cannot have acted on them: on
+    429 and when the connection could not be made. Calls are rate limited,
+    see rate_limit.py. One instance can be shared between several
+    autoscalers and runner groups.
+    """
+
+    RETRY_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+    IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+
+    def __init__(
+        self,
+        base_uri: str,
+        api_key: str,
+        connect_timeout: float = 3.05,
+        read_timeout: float = 30.0,
+        max_retries: int = 3,
+        backoff_base: float = 0.5,
+        backoff_max: float = 10.0,
+        pool_maxsize: int = 10,
+    ):
+        self.base_uri = base_uri.rstrip("/") if base_uri else base_uri
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.session = requests.Session()
+        # retries are handled in _request so they can be jittered and counted
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_maxsize, max_retries=0
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["Authorization"] = f"apikey {api_key}"
+
+        self.stats: Dict[str, EndpointStats] = {}
+        self._stats_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "SGApiClient":
+        return cls(
+            base_uri=os.getenv("SG_BASE_URI"),
+            api_key=os.getenv("SG_API_KEY"),
+            connect_timeout=float(os.getenv("SG_API_CONNECT_TIMEOUT", "3.05")),
+            read_timeout=float(os.getenv("SG_API_READ_TIMEOUT", "30")),
+            max_retries=int(os.getenv("SG_API_MAX_RETRIES", "3")),
+            pool_maxsize=int(os.getenv("SG_API_POOL_SIZE", "10")),
+        )
+
+    def _runner_group_uri(self, org: str, runner_group: str) -> str:
+        return f"{self.base_uri}/api/v1/orgs/{org}/runnergroups/{runner_group}"
+
+    def stream_runner_group(
+        self, org: str, runner_group: str
+    ) -> Iterator[Tuple[str, object]]:
+        """
+        The runner group parsed as it is downloaded, see iter_runner_group.
+        The connection goes back to the pool once the iterator is done.
+        """
+        uri = f"{self._runner_group_uri(org, runner_group)}/?getActiveWorkflows=true"
+        res = self._request("get_runner_group", "GET", uri, stream=True)
+        with res:
+            # the headers were timed by _request, this is the body
+            with metrics.span(
+                "api_call", service="sg", call="get_runner_group_body"
+            ):
+                res.raw.decode_content = True
+                yield from iter_runner_group(res.raw)
+
+    def update_runner_status(
+        self, org: str, runner_group: str, runner_id: str, status: str
+    ):
+        uri = f"{self._runner_group_uri(org, runner_group)}/runner_status/"
+        payload = {"Status": status, "RunnerId": runner_id}
+        self._request("update_runner_status", "POST", uri, data=payload)
+
+    def deregister_runner(self, org: str, runner_group: str, runner_id: str):
+        uri = f"{self._runner_group_uri(org, runner_group)}/deregister/"
+        payload = {"RunnerId": runner_id}
+        self._request("deregister_runner", "POST", uri, data=payload)
+
+    def get_stats(self) -> Dict[str, Dict]:
+        with self._stats_lock:
+            return {
+                endpoint: stats.as_dict()
+                for endpoint, stats in self.stats.items()
+            }
+
+    def close(self):
+        self.session.close()
+
+    def _endpoint_stats(self, endpoint: str) -> EndpointStats:
+        with self._stats_lock:
+            if endpoint not in self.stats:
+                self.stats[endpoint] = EndpointStats()
+            return self.stats[endpoint]
+
+    def _backoff(self, attempt: int, res: Optional[requests.Response]):
+        retry_after = (
+            res.headers.get("Retry-After") if res is not None else None
+        )
+        if retry_after is not None and retry_after.isdigit():
+            delay = min(float(retry_after), self.backoff_max)
+        else:
+            # full jitter, see "Exponential Backoff And Jitter"
+            delay = random.uniform(
+                0, min(self.backoff_max, self.backoff_base * 2**attempt)
+            )
+        rate_limit.sleep(delay)
+
+    def _request(
+        self, endpoint: str, method: str, uri: str, **kwargs
+    ) -> requests.Response:
+        stats = self._endpoint_stats(endpoint)
+        idempotent = method in self.IDEMPOTENT_METHODS
+        retry_status_codes = (
+            self.RETRY_STATUS_CODES if idempotent else frozenset({429})
+        )
+        attempt = 0
+        while True:
+            rate_limit.acquire("sg")
+            start = time.perf_counter()
+            res = None
+            try:
+                res = self.session.request(
+                    method, uri, timeout=self.timeout, **kwargs
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                seconds = time.perf_counter() - start
+                with self._stats_lock:
+                    stats.record(seconds, ok=False)
+                metrics.observe(
+                    "api_call", seconds, ok=False, service="sg", call=endpoint
+                )
+                if attempt >= self.max_retries or not (
+                    idempotent or _never_sent(e)
+                ):
+                    raise e
+                logging.info(
+                    f"STACKGUARDIAN: {endpoint} failed with {e}, retrying"
+                )
+            else:
+                ok = res.status_code < 400
+                seconds = time.perf_counter() - start
+                with self._stats_lock:
+                    stats.record(seconds, ok=ok)
+                metrics.observe(
+                    "api_call", seconds, ok=ok, service="sg", call=endpoint
+                )
+                if res.status_code == 429:
+                    rate_limit.throttled("sg")
+                    if attempt >= self.max_retries:
+                        res.close()
+                        raise rate_limit.ThrottledError(
+                            f"{endpoint} was throttled {attempt + 1} times"
+                        )
+                elif ok:
+                    rate_limit.succeeded("sg")
+                if (
+                    res.status_code not in retry_status_codes
+                    or attempt >= self.max_retries
+                ):
+                    if not ok:
+                        res.close()
+                    res.raise_for_status()
+                    return res
+                logging.info(
+                    f"STACKGUARDIAN: {endpoint} returned {res.status_code}, retrying"
+                )
+
+            if res is not None:
+                # returns a streamed response's connection to the pool
+                res.close()
+            with self._stats_lock:
+                stats.retries += 1
+            metrics.increment("api_retries", service="sg", call=endpoint)
+            self._backoff(attempt, res)
+            attempt += 1
@@ -0,0 +1,16 @@
+"""
+Offline simulator for comparing scaling policies, see README.md. Runs the
+real StackGuardianAutoscaler against in-memory fakes of the scale group and
+the StackGuardian API, no cloud access needed.
+"""
+
+from simulator.engine import SIMULATION_DEFAULTS, Simulation, SimulationReport
+from simulator.fakes import FakeRunnerGroup, FakeScaleGroup, SimClock
+from simulator.traces import (
+    JobSpec,
+    burst_trace,
+    diurnal_trace,
+    load_trace,
+    poisson_trace,
+    save_trace,
+)
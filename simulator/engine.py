@@ -0,0 +1,390 @@
+"""
+Discrete event simulation of a runner group scaled by the real
+StackGuardianAutoscaler. Events are job arrivals and completions, VM's
+becoming ready and autoscaler ticks; time only moves from one event to the
+next, so a day of traffic runs in seconds.
+"""
+
+import heapq
+import itertools
+import logging
+from datetime import datetime, timedelta, timezone
+from collections import Counter
+from typing import Dict, List, Optional
+
+from multi_pool import MultiPoolService, ScalePool
+from simulator.fakes import FakeRunnerGroup, FakeScaleGroup, FakeVM, Job
+from simulator.fakes import SimClock
+from simulator.traces import JobSpec
+from stackguardian_autoscaler import StackGuardianAutoscaler
+
+# every setting the autoscaler reads, so the results never depend on the
+# environment the simulation happens to run in
+SIMULATION_DEFAULTS = {
+    "SG_ORG": "simulator",
+    "SG_RUNNER_GROUP": "simulator",
+    "SCALE_IN_THRESHOLD": "0",
+    "SCALE_IN_STEP": "1",
+    "SCALE_OUT_THRESHOLD": "1",
+    "SCALE_OUT_STEP": "1",
+    "SCALE_IN_COOLDOWN_DURATION": "5",
+    "SCALE_OUT_COOLDOWN_DURATION": "5",
+    "MIN_RUNNERS": "0",
+    "MAX_RUNNERS": "",
+    "CAPACITY_SCHEDULE": "",
+    "SCALING_MODE": "step",
+    "RUNNER_CONCURRENCY": "1",
+    "MAX_SCALE_OUT_STEP": "",
+    "MAX_SCALE_IN_STEP": "",
+    "SG_API_MAX_CONCURRENCY": "8",
+    "FORECASTER": "",
+    "FORECAST_ALPHA": "0.5",
+    "FORECAST_BETA": "0.3",
+    "FORECAST_HORIZON_MINUTES": "5",
+    "FORECAST_HISTORY_SIZE": "60",
+    "METRICS_FORMAT": "",
+    "EVENT_COALESCE_SECONDS": "10",
+    "STANDBY_POOL_MIN": "0",
+    "STANDBY_POOL_MAX": "0",
+    "DISCONNECTED_GRACE_MINUTES": "10",
+    "GHOST_GRACE_MINUTES": "",
+    "ORPHAN_GRACE_MINUTES": "",
+    "LEASE_TTL_SECONDS": "0",
+    "TICK_BUDGET_SECONDS": "",
+    "TARGET_QUEUE_WAIT_SECONDS": "300",
+    "POOL_CAPACITY_BACKOFF_MINUTES": "10",
+}
+
+# events at the same time are handled in this order
+_VM_READY, _JOB_DONE, _JOB_ARRIVAL, _TICK = range(4)
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Nearest rank percentile, q between 0 and 100"""
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * q // 100))
+    return ordered[int(rank) - 1]
+
+
+class SimulationReport:
+    def __init__(self):
+        # seconds between arrival and start, jobs that never started count
+        # with their wait until the end of the simulation
+        self.queue_waits: List[float] = []
+        self.jobs = 0
+        self.jobs_finished = 0
+        self.jobs_never_started = 0
+        self.jobs_interrupted = 0
+        self.idle_runner_minutes = 0.0
+        self.vm_minutes = 0.0
+        # stopped VM's only pay for their disks
+        self.standby_vm_minutes = 0.0
+        # dollars for VM time, only known with pools
+        self.vm_cost: Optional[float] = None
+        self.ticks = 0
+        self.tick_errors = 0
+        # scale_out_on_demand calls, one per job arrival when enabled
+        self.events = 0
+        self.events_coalesced = 0
+        # SG and cloud API calls of every tick
+        self.api_calls_per_tick: List[int] = []
+        self.sg_api_calls: Dict[str, int] = {}
+        self.cloud_api_calls: Dict[str, int] = {}
+        # desired capacity after every tick
+        self.capacity: List[int] = []
+
+    @property
+    def oscillations(self) -> int:
+        """Times the capacity changed direction, e.g. grew then shrank"""
+        oscillations = 0
+        direction = 0
+        for previous, current in zip(self.capacity, self.capacity[1:]):
+            if current == previous:
+                continue
+            new_direction = 1 if current > previous else -1
+            if direction != 0 and new_direction != direction:
+                oscillations += 1
+            direction = new_direction
+        return oscillations
+
+    def as_dict(self) -> Dict:
+        api_calls = self.api_calls_per_tick
+        return {
+            "jobs": self.jobs,
+            "jobs_finished": self.jobs_finished,
+            "jobs_never_started": self.jobs_never_started,
+            "jobs_interrupted": self.jobs_interrupted,
+            "queue_wait_p50_seconds": percentile(self.queue_waits, 50),
+            "queue_wait_p95_seconds": percentile(self.queue_waits, 95),
+            "queue_wait_max_seconds": percentile(self.queue_waits, 100),
+            "idle_runner_minutes": round(self.idle_runner_minutes, 1),
+            "vm_minutes": round(self.vm_minutes, 1),
+            "standby_vm_minutes": round(self.standby_vm_minutes, 1),
+            "vm_cost": (
+                round(self.vm_cost, 2) if self.vm_cost is not None else None
+            ),
+            "ticks": self.ticks,
+            "tick_errors": self.tick_errors,
+            "events": self.events,
+            "events_coalesced": self.events_coalesced,
+            "api_calls_per_tick_mean": (
+                round(sum(api_calls) / len(api_calls), 2)
+                if api_calls
+                else None
+            ),
+            "api_calls_per_tick_p95": percentile(api_calls, 95),
+            "api_calls_per_tick_max": percentile(api_calls, 100),
+            "sg_api_calls": self.sg_api_calls,
+            "cloud_api_calls": self.cloud_api_calls,
+            "peak_capacity": max(self.capacity, default=0),
+            "oscillations": self.oscillations,
+        }
+
+
+class Simulation:
+    def __init__(
+        self,
+        trace: List[JobSpec],
+        settings: Optional[Dict[str, str]] = None,
+        tick_interval: timedelta = timedelta(minutes=1),
+        boot_delay: timedelta = timedelta(minutes=3),
+        resume_delay: timedelta = timedelta(seconds=30),
+        initial_runners: int = 0,
+        duration: Optional[timedelta] = None,
+        start: datetime = datetime(2024, 1, 1, tzinfo=timezone.utc),
+        scale_out_on_arrival: bool = False,
+        pools: Optional[List[Dict]] = None,
+    ):
+        self.trace = trace
+        self.settings = dict(SIMULATION_DEFAULTS)
+        self.settings.update(
+            {name: str(value) for name, value in (settings or {}).items()}
+        )
+        self.tick_interval = tick_interval
+        self.boot_delay = boot_delay
+        self.initial_runners = initial_runners
+        self.start = start
+        # notify the autoscaler of every queued job, like the webhook
+        self.scale_out_on_arrival = scale_out_on_arrival
+        if duration is None:
+            # long enough for the last jobs to finish and the group to
+            # scale back in
+            last = max(
+                (job.arrival_seconds for job in trace), default=0
+            ) + max((job.duration_seconds for job in trace), default=0)
+            duration = timedelta(seconds=last) + timedelta(hours=1)
+        self.end = start + duration
+
+        self.clock = SimClock(start)
+        # with pools, a scale group per pool scaled by a MultiPoolService:
+        # SCALE_POOLS entries without scale_group, and capacity, the VM's
+        # the pool can get at most, e.g. for a spot shortage
+        self.pools = pools
+        self.scale_groups = [
+            FakeScaleGroup(
+                self.clock,
+                timedelta(
+                    seconds=pool.get(
+                        "boot_seconds", boot_delay.total_seconds()
+                    )
+                ),
+                on_launch=self._on_launch,
+                on_terminate=self._on_terminate,
+                resume_delay=resume_delay,
+                name_prefix=pool["name"],
+                max_capacity=pool.get("capacity"),
+                runner_concurrency=pool.get("runner_concurrency", 1),
+            )
+            for pool in pools or [{"name": "vm", "runner_concurrency": None}]
+        ]
+        self.scale_group = self.scale_groups[0]
+        cloud_service = self.scale_group
+        if pools:
+            cloud_service = MultiPoolService(
+                [
+                    ScalePool(
+                        name=pool["name"],
+                        cloud_service=scale_group,
+                        hourly_cost=pool["hourly_cost"],
+                        runner_concurrency=pool.get("runner_concurrency", 1),
+                        spot=pool.get("spot", False),
+                        boot_seconds=scale_group.boot_delay.total_seconds(),
+                        max_vms=pool.get("max_vms"),
+                    )
+                    for pool, scale_group in zip(pools, self.scale_groups)
+                ],
+                settings=self.settings,
+                clock=self.clock.now,
+            )
+        self.runner_group = FakeRunnerGroup(
+            self.clock,
+            runner_concurrency=int(self.settings["RUNNER_CONCURRENCY"]),
+        )
+        self.autoscaler = StackGuardianAutoscaler(
+            cloud_service,
+            sg_client=self.runner_group,
+            settings=self.settings,
+            clock=self.clock.now,
+            sleep=self._sleep,
+        )
+        self.report = SimulationReport()
+        self._events = []
+        self._sequence = itertools.count()
+        self._jobs: List[Job] = []
+
+    def _schedule(self, timestamp: datetime, kind: int, payload=None):
+        heapq.heappush(
+            self._events, (timestamp, kind, next(self._sequence), payload)
+        )
+
+    def _on_launch(self, vm: FakeVM):
+        self._schedule(vm.ready_at, _VM_READY, vm)
+
+    def _on_terminate(self, vm: FakeVM):
+        self.runner_group.disconnect(vm.name)
+
+    def _advance(self, timestamp: datetime):
+        """Accounts for runner and VM time up to timestamp"""
+        minutes = (timestamp - self.clock.now()).total_seconds() / 60
+        if minutes > 0:
+            idle_runners = sum(
+                1
+                for runner in self.runner_group.runners.values()
+                if runner.connected and len(runner.jobs) == 0
+            )
+            self.report.idle_runner_minutes += idle_runners * minutes
+            for scale_group in self.scale_groups:
+                self.report.vm_minutes += len(scale_group.vms) * minutes
+                self.report.standby_vm_minutes += (
+                    len(scale_group.standby) * minutes
+                )
+            if self.pools:
+                self.report.vm_cost = (self.report.vm_cost or 0.0) + sum(
+                    len(scale_group.vms) * pool["hourly_cost"] * minutes / 60
+                    for pool, scale_group in zip(self.pools, self.scale_groups)
+                )
+        self.clock.advance_to(timestamp)
+
+    def _api_calls(self) -> int:
+        return sum(self.runner_group.calls.values()) + sum(
+            sum(scale_group.calls.values())
+            for scale_group in self.scale_groups
+        )
+
+    def _tick(self):
+        calls_before = self._api_calls()
+        try:
+            self.autoscaler.start()
+        except Exception as e:
+            logging.warning(f"STACKGUARDIAN: simulated tick failed: {e}")
+            self.report.tick_errors += 1
+        self.report.ticks += 1
+        self.report.api_calls_per_tick.append(self._api_calls() - calls_before)
+        self.report.capacity.append(
+            sum(
+                scale_group.desired_capacity
+                for scale_group in self.scale_groups
+            )
+        )
+
+    def _event(self):
+        try:
+            outcome = self.autoscaler.scale_out_on_demand()
+        except Exception as e:
+            logging.warning(f"STACKGUARDIAN: simulated event failed: {e}")
+            outcome = None
+        self.report.events += 1
+        self.report.events_coalesced += 1 if outcome == "coalesced" else 0
+
+    def _sleep(self, seconds: float):
+        # jobs keep arriving while a notification waits out the coalesce
+        # window, their notifications are coalesced into it
+        self._run_until(self.clock.now() + timedelta(seconds=seconds))
+
+    def _dispatch(self):
+        for job in self.runner_group.dispatch():
+            self._schedule(
+                job.started_at + job.duration,
+                _JOB_DONE,
+                (job, job.attempt),
+            )
+
+    def run(self) -> SimulationReport:
+        for _ in range(self.initial_runners):
+            self.scale_group.launch(ready=True)
+        self.scale_group.desired_capacity = self.initial_runners
+
+        for spec in self.trace:
+            self._schedule(
+                self.start + timedelta(seconds=spec.arrival_seconds),
+                _JOB_ARRIVAL,
+                spec,
+            )
+        self._schedule(self.start, _TICK)
+
+        self._run_until(self.end)
+        return self._finish()
+
+    def _run_until(self, end: datetime):
+        while self._events and self._events[0][0] <= end:
+            timestamp, kind, _, payload = heapq.heappop(self._events)
+            self._advance(timestamp)
+
+            if kind == _VM_READY:
+                if any(
+                    payload.name in scale_group.vms
+                    for scale_group in self.scale_groups
+                ):
+                    self.runner_group.register(
+                        payload.name, payload.runner_concurrency
+                    )
+            elif kind == _JOB_DONE:
+                job, attempt = payload
+                if attempt == job.attempt:
+                    job.finished_at = timestamp
+                    self.runner_group.finish(job)
+            elif kind == _JOB_ARRIVAL:
+                job = Job(
+                    timestamp, timedelta(seconds=payload.duration_seconds)
+                )
+                self._jobs.append(job)
+                self.runner_group.enqueue(job)
+                if self.scale_out_on_arrival:
+                    # jobs that can start right away never reach the queue
+                    self._dispatch()
+                    if len(self.runner_group.queue) > 0:
+                        self._event()
+            else:
+                self._tick()
+                self._schedule(timestamp + self.tick_interval, _TICK)
+
+            self._dispatch()
+
+        self._advance(end)
+
+    def _finish(self) -> SimulationReport:
+        report = self.report
+        report.jobs = len(self._jobs)
+        for job in self._jobs:
+            report.jobs_interrupted += 1 if job.interrupted else 0
+            if job.finished_at is not None:
+                report.jobs_finished += 1
+            if job.started_at is None:
+                report.jobs_never_started += 1
+                report.queue_waits.append(
+                    (self.end - job.arrival).total_seconds()
+                )
+            else:
+                report.queue_waits.append(
+                    (job.started_at - job.arrival).total_seconds()
+                )
+        report.sg_api_calls = dict(self.runner_group.calls)
+        report.cloud_api_calls = dict(
+            sum(
+                (scale_group.calls for scale_group in self.scale_groups),
+                Counter(),
+            )
+        )
+        return report
@@ -0,0 +1,462 @@
+"""
+In-memory stand-ins for a cloud scale group and the StackGuardian runner
+group API. Both count the API calls the autoscaler makes against them.
+"""
+
+import itertools
+import threading
+from collections import Counter, deque
+from datetime import datetime, timedelta
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from stackguardian_autoscaler import CloudService, InventoryJoin, SGRunner
+from state_store import StateConflictError, StateStore
+
+
+class SimClock:
+    """Simulated time, only moves when the simulation advances it"""
+
+    def __init__(self, start: datetime):
+        self.current = start
+
+    def now(self) -> datetime:
+        return self.current
+
+    def advance_to(self, timestamp: datetime):
+        self.current = max(self.current, timestamp)
+
+
+class Job:
+    def __init__(self, arrival: datetime, duration: timedelta):
+        self.arrival = arrival
+        self.duration = duration
+        self.started_at: Optional[datetime] = None
+        self.finished_at: Optional[datetime] = None
+        # bumped when the job is requeued, completions of earlier attempts
+        # are ignored
+        self.attempt = 0
+        self.interrupted = 0
+
+
+class MemoryStateStore(StateStore):
+    """State document kept in memory, reads and writes count as API calls"""
+
+    _keys = itertools.count()
+
+    def __init__(self, calls: Counter):
+        super().__init__(f"simulator/{next(self._keys)}")
+        self.calls = calls
+        self.content: Optional[str] = None
+        self.version = 0
+
+    def _read(
+        self, etag: Optional[str]
+    ) -> Tuple[Optional[str], Optional[str]]:
+        self.calls["state_read"] += 1
+        if self.content is None:
+            return None, None
+        if etag == str(self.version):
+            return None, etag
+        return self.content, str(self.version)
+
+    def _write(self, content: str, etag: Optional[str]) -> str:
+        self.calls["state_write"] += 1
+        if etag != (str(self.version) if self.content is not None else None):
+            raise StateConflictError()
+        self.content = content
+        self.version += 1
+        return str(self.version)
+
+
+class FakeVM:
+    def __init__(
+        self,
+        name: str,
+        launched_at: datetime,
+        ready_at: datetime,
+        runner_concurrency: Optional[int] = None,
+    ):
+        self.name = name
+        self.launched_at = launched_at
+        self.ready_at = ready_at
+        self.protected = False
+        # workflows its runner runs at once, None for the runner group's
+        self.runner_concurrency = runner_concurrency
+
+
+class FakeScaleGroup(CloudService):
+    """
+    A scale group that behaves like an ASG: it launches or terminates VM's
+    to match the desired capacity, oldest unprotected VM's first, and never
+    terminates protected VM's. New VM's become ready after boot_delay.
+
+    Like an ASG warm pool, it keeps standby_pool_size stopped VM's, which
+    are warmed for boot_delay and refilled as they are resumed. A resumed
+    VM becomes ready after resume_delay.
+
+    With max_capacity it launches no more than that many VM's, like an ASG
+    short of spot capacity; the rest of the desired capacity stays
+    unfulfilled.
+    """
+
+    PROTECTION_BATCH_SIZE = 50
+
+    def __init__(
+        self,
+        clock: SimClock,
+        boot_delay: timedelta,
+        on_launch: Callable[[FakeVM], None] = None,
+        on_terminate: Callable[[FakeVM], None] = None,
+        resume_delay: Optional[timedelta] = None,
+        name_prefix: str = "vm",
+        max_capacity: Optional[int] = None,
+        runner_concurrency: Optional[int] = None,
+    ):
+        self.clock = clock
+        self.boot_delay = boot_delay
+        self.resume_delay = (
+            boot_delay if resume_delay is None else resume_delay
+        )
+        self.on_launch = on_launch
+        self.on_terminate = on_terminate
+        self.calls: Counter = Counter()
+        self.state_store = MemoryStateStore(self.calls)
+        self.vms: Dict[str, FakeVM] = {}
+        self.desired_capacity = 0
+        self.standby: Dict[str, FakeVM] = {}
+        self.standby_pool_size = 0
+        self.name_prefix = name_prefix
+        self.max_capacity = max_capacity
+        self.runner_concurrency = runner_concurrency
+        self._names = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _new_vm(self, ready: bool) -> FakeVM:
+        now = self.clock.now()
+        return FakeVM(
+            f"{self.name_prefix}-{next(self._names):05d}",
+            launched_at=now,
+            ready_at=now if ready else now + self.boot_delay,
+            runner_concurrency=self.runner_concurrency,
+        )
+
+    def launch(self, ready: bool = False) -> FakeVM:
+        vm = self._new_vm(ready)
+        self.vms[vm.name] = vm
+        if self.on_launch is not None:
+            self.on_launch(vm)
+        return vm
+
+    def _fill_standby(self):
+        while len(self.standby) < self.standby_pool_size:
+            vm = self._new_vm(ready=False)
+            self.standby[vm.name] = vm
+        # the most recently launched go first
+        for name in list(self.standby)[self.standby_pool_size :]:
+            del self.standby[name]
+
+    def _converge(self):
+        while len(self.vms) < self.desired_capacity and (
+            self.max_capacity is None or len(self.vms) < self.max_capacity
+        ):
+            self.launch()
+
+        excess = len(self.vms) - self.desired_capacity
+        if excess <= 0:
+            return
+        unprotected = [vm for vm in self.vms.values() if not vm.protected]
+        for vm in unprotected[:excess]:
+            del self.vms[vm.name]
+            if self.on_terminate is not None:
+                self.on_terminate(vm)
+
+    def get_last_scale_out_event(self) -> Optional[datetime]:
+        return self.state_store.get().last_scale_out_event
+
+    def set_last_scale_out_event(self, timestamp):
+        self.state_store.save(
+            last_scale_out_event=timestamp, last_action="scale_out"
+        )
+
+    def get_last_scale_in_event(self) -> Optional[datetime]:
+        return self.state_store.get().last_scale_in_event
+
+    def set_last_scale_in_event(self, timestamp):
+        self.state_store.save(
+            last_scale_in_event=timestamp, last_action="scale_in"
+        )
+
+    def set_autoscale_vms(self, count_of_vms: int):
+        with self._lock:
+            self.calls["set_capacity"] += 1
+            self.desired_capacity = max(0, count_of_vms)
+            self._converge()
+        self.state_store.update(last_desired_capacity=count_of_vms)
+
+    def count_of_existing_vms(self) -> int:
+        with self._lock:
+            self.calls["describe"] += 1
+            # like an ASG, the desired capacity counts before it launched
+            return max(len(self.vms), self.desired_capacity)
+
+    def count_of_unfulfilled_vms(self) -> int:
+        with self._lock:
+            return max(0, self.desired_capacity - len(self.vms))
+
+    def count_of_standby_vms(self) -> int:
+        with self._lock:
+            return len(self.standby)
+
+    def resume_standby_vms(self, count: int) -> int:
+        with self._lock:
+            # warmed VM's first
+            resumed = sorted(
+                self.standby.values(), key=lambda vm: vm.ready_at
+            )[:count]
+            if len(resumed) == 0:
+                return 0
+            self.calls["set_capacity"] += 1
+            now = self.clock.now()
+            for vm in resumed:
+                del self.standby[vm.name]
+                vm.ready_at = max(vm.ready_at, now) + self.resume_delay
+                self.vms[vm.name] = vm
+                if self.on_launch is not None:
+                    self.on_launch(vm)
+            self.desired_capacity += len(resumed)
+            self._converge()
+            self._fill_standby()
+        self.state_store.update(last_desired_capacity=self.desired_capacity)
+        return len(resumed)
+
+    def set_standby_pool_size(self, size: int):
+        with self._lock:
+            if size != self.standby_pool_size:
+                self.calls["put_warm_pool"] += 1
+                self.standby_pool_size = size
+            self._fill_standby()
+
+    def get_unmatched_runners(
+        self, sg_runners: List[SGRunner]
+    ) -> List[SGRunner]:
+        return [
+            sg_runner
+            for sg_runner in sg_runners
+            if sg_runner.computer_name not in self.vms
+        ]
+
+    def join_inventory(self, sg_runners: List[SGRunner]) -> InventoryJoin:
+        with self._lock:
+            join = InventoryJoin()
+            matched = set()
+            for sg_runner in sg_runners:
+                if sg_runner.computer_name in self.vms:
+                    matched.add(sg_runner.computer_name)
+                else:
+                    join.ghost_runners.append(sg_runner)
+            join.orphan_vms = [
+                name for name in self.vms if name not in matched
+            ]
+            return join
+
+    def terminate_orphan_vms(self, vm_ids: List[str]) -> int:
+        return self._terminate(vm_ids)
+
+    def terminate_runner_vms(self, sg_runners: List[SGRunner]) -> int:
+        return self._terminate(
+            [sg_runner.computer_name for sg_runner in sg_runners]
+        )
+
+    def _terminate(self, names: List[str]) -> int:
+        # one call per VM, like terminate_instance_in_auto_scaling_group
+        terminated = 0
+        with self._lock:
+            for name in names:
+                vm = self.vms.pop(name, None)
+                if vm is None:
+                    continue
+                self.calls["terminate"] += 1
+                self.desired_capacity = max(0, self.desired_capacity - 1)
+                terminated += 1
+                if self.on_terminate is not None:
+                    self.on_terminate(vm)
+        return terminated
+
+    def add_scale_in_protection(self, sg_runner: SGRunner):
+        self._set_scale_in_protection([sg_runner], True)
+
+    def remove_scale_in_protection(self, sg_runner: SGRunner):
+        self._set_scale_in_protection([sg_runner], False)
+
+    def add_scale_in_protection_bulk(self, sg_runners: List[SGRunner]):
+        self._set_scale_in_protection(sg_runners, True)
+
+    def remove_scale_in_protection_bulk(self, sg_runners: List[SGRunner]):
+        self._set_scale_in_protection(sg_runners, False)
+
+    def _set_scale_in_protection(
+        self, sg_runners: List[SGRunner], protected: bool
+    ):
+        # batched and skipping VM's already in the wanted state, like
+        # AwsService
+        with self._lock:
+            vms = [
+                self.vms[sg_runner.computer_name]
+                for sg_runner in sg_runners
+                if sg_runner.computer_name in self.vms
+                and self.vms[sg_runner.computer_name].protected != protected
+            ]
+            for i in range(0, len(vms), self.PROTECTION_BATCH_SIZE):
+                self.calls["set_protection"] += 1
+                for vm in vms[i : i + self.PROTECTION_BATCH_SIZE]:
+                    vm.protected = protected
+            if not protected:
+                self._converge()
+
+
+class FakeRunner:
+    def __init__(
+        self,
+        runner_id: str,
+        computer_name: str,
+        ip_address: str,
+        concurrency: int = 1,
+    ):
+        self.runner_id = runner_id
+        self.computer_name = computer_name
+        self.ip_address = ip_address
+        self.concurrency = concurrency
+        self.status = "ACTIVE"
+        self.connected = True
+        self.jobs: List[Job] = []
+
+    def as_dict(self) -> Dict:
+        return {
+            "instanceDetails": [
+                {
+                    "IPAddress": self.ip_address,
+                    "ComputerName": self.computer_name,
+                }
+            ],
+            "containerInstanceArn": f"arn:simulator:{self.runner_id}",
+            "agentConnected": self.connected,
+            "status": self.status,
+            "runnerId": self.runner_id,
+            "runningTasksCount": len(self.jobs),
+            "pendingTasksCount": 0,
+            "activeWorkflows": [
+                {"startedAt": job.started_at.isoformat()} for job in self.jobs
+            ],
+        }
+
+
+class FakeRunnerGroup:
+    """
+    The StackGuardian side of a runner group, used in place of SGApiClient.
+    Queued jobs are started first in first out on connected ACTIVE runners
+    with a free slot.
+    """
+
+    def __init__(self, clock: SimClock, runner_concurrency: int = 1):
+        self.clock = clock
+        self.runner_concurrency = runner_concurrency
+        self.calls: Counter = Counter()
+        self.runners: Dict[str, FakeRunner] = {}
+        self.queue: Deque[Job] = deque()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def register(
+        self, computer_name: str, concurrency: Optional[int] = None
+    ) -> FakeRunner:
+        index = next(self._ids)
+        runner = FakeRunner(
+            f"runner-{index:05d}",
+            computer_name,
+            f"10.{index // 65536 % 256}.{index // 256 % 256}.{index % 256}",
+            concurrency=concurrency or self.runner_concurrency,
+        )
+        self.runners[runner.runner_id] = runner
+        return runner
+
+    def disconnect(self, computer_name: str) -> List[Job]:
+        """The runner's VM is gone, its jobs are requeued"""
+        interrupted = []
+        for runner in self.runners.values():
+            if runner.computer_name == computer_name and runner.connected:
+                runner.connected = False
+                interrupted.extend(self._requeue(runner))
+        return interrupted
+
+    def enqueue(self, job: Job):
+        self.queue.append(job)
+
+    def finish(self, job: Job):
+        for runner in self.runners.values():
+            if job in runner.jobs:
+                runner.jobs.remove(job)
+                return
+
+    def dispatch(self) -> List[Job]:
+        """Start queued jobs on free runners, returns the started jobs"""
+        started = []
+        for runner in self.runners.values():
+            while (
+                len(self.queue) > 0
+                and runner.connected
+                and runner.status == "ACTIVE"
+                and len(runner.jobs) < runner.concurrency
+            ):
+                job = self.queue.popleft()
+                job.started_at = self.clock.now()
+                runner.jobs.append(job)
+                started.append(job)
+        return started
+
+    def _requeue(self, runner: FakeRunner) -> List[Job]:
+        interrupted = runner.jobs
+        runner.jobs = []
+        for job in interrupted:
+            job.attempt += 1
+            job.interrupted += 1
+            job.started_at = None
+        # retried ahead of jobs that have not started yet
+        self.queue.extendleft(reversed(interrupted))
+        return interrupted
+
+    def get_runner_group(self, org: str, runner_group: str) -> Dict:
+        with self._lock:
+            self.calls["get_runner_group"] += 1
+            return {
+                "msg": {
+                    "QueuedWorkflowsCount": len(self.queue),
+                    "ContainerInstances": [
+                        runner.as_dict() for runner in self.runners.values()
+                    ],
+                }
+            }
+
+    def stream_runner_group(self, org: str, runner_group: str):
+        msg = self.get_runner_group(org, runner_group)["msg"]
+        yield "QueuedWorkflowsCount", msg["QueuedWorkflowsCount"]
+        for runner in msg["ContainerInstances"]:
+            yield "runner", runner
+
+    def update_runner_status(
+        self, org: str, runner_group: str, runner_id: str, status: str
+    ):
+        with self._lock:
+            self.calls["update_runner_status"] += 1
+            self.runners[runner_id].status = status
+
+    def deregister_runner(self, org: str, runner_group: str, runner_id: str):
+        with self._lock:
+            self.calls["deregister_runner"] += 1
+            runner = self.runners.pop(runner_id)
+            self._requeue(runner)
+
+    def get_stats(self) -> Dict:
+        return dict(self.calls)
+
+    def close(self):
+        pass
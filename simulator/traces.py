@@ -0,0 +1,112 @@
+"""
+Job traces the simulator replays. A trace is a list of JobSpec, sorted by
+arrival. Synthetic traces are seeded so a benchmark run can be repeated;
+recorded traces are CSV files with the columns arrival_seconds and
+duration_seconds, relative to the start of the trace.
+"""
+
+import csv
+import math
+import random
+from typing import List, NamedTuple
+
+
+class JobSpec(NamedTuple):
+    # seconds after the start of the simulation
+    arrival_seconds: float
+    duration_seconds: float
+
+
+def _duration(rng: random.Random, mean_minutes: float) -> float:
+    # workflow run times are right skewed, a few runs take much longer
+    sigma = 0.5
+    mu = math.log(mean_minutes * 60) - sigma**2 / 2
+    return rng.lognormvariate(mu, sigma)
+
+
+def poisson_trace(
+    rate_per_minute: float,
+    minutes: float,
+    mean_duration_minutes: float = 10,
+    seed: int = 0,
+) -> List[JobSpec]:
+    """Jobs arriving at a constant average rate"""
+    rng = random.Random(seed)
+    trace = []
+    arrival = rng.expovariate(rate_per_minute / 60)
+    while arrival < minutes * 60:
+        trace.append(JobSpec(arrival, _duration(rng, mean_duration_minutes)))
+        arrival += rng.expovariate(rate_per_minute / 60)
+    return trace
+
+
+def diurnal_trace(
+    peak_rate_per_minute: float,
+    minutes: float,
+    period_minutes: float = 24 * 60,
+    mean_duration_minutes: float = 10,
+    seed: int = 0,
+) -> List[JobSpec]:
+    """
+    Jobs arriving at a rate that follows a sine wave between zero and
+    peak_rate_per_minute, starting at the quietest point of the period
+    """
+    rng = random.Random(seed)
+    trace = []
+    # thinning: draw at the peak rate, keep each arrival with the ratio of
+    # the rate at that time to the peak rate
+    arrival = rng.expovariate(peak_rate_per_minute / 60)
+    while arrival < minutes * 60:
+        phase = 2 * math.pi * arrival / (period_minutes * 60)
+        if rng.random() < (1 - math.cos(phase)) / 2:
+            trace.append(
+                JobSpec(arrival, _duration(rng, mean_duration_minutes))
+            )
+        arrival += rng.expovariate(peak_rate_per_minute / 60)
+    return trace
+
+
+def burst_trace(
+    jobs_per_burst: int,
+    interval_minutes: float,
+    minutes: float,
+    mean_duration_minutes: float = 10,
+    seed: int = 0,
+) -> List[JobSpec]:
+    """
+    Bursts of jobs_per_burst jobs every interval_minutes, e.g. a pipeline
+    fanning out over many stacks, spread over the first minute of the burst
+    """
+    rng = random.Random(seed)
+    trace = []
+    burst = 0.0
+    while burst < minutes * 60:
+        for _ in range(jobs_per_burst):
+            trace.append(
+                JobSpec(
+                    burst + rng.uniform(0, 60),
+                    _duration(rng, mean_duration_minutes),
+                )
+            )
+        burst += interval_minutes * 60
+    return sorted(trace)
+
+
+def load_trace(path: str) -> List[JobSpec]:
+    with open(path, newline="") as trace_file:
+        return sorted(
+            JobSpec(
+                float(row["arrival_seconds"]), float(row["duration_seconds"])
+            )
+            for row in csv.DictReader(trace_file)
+        )
+
+
+def save_trace(path: str, trace: List[JobSpec]):
+    with open(path, "w", newline="") as trace_file:
+        writer = csv.writer(trace_file)
+        writer.writerow(JobSpec._fields)
+        for job in trace:
+            writer.writerow(
+                [round(job.arrival_seconds, 3), round(job.duration_seconds, 3)]
+            )
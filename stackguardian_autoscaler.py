@@ -1,12 +1,43 @@
 from abc import ABC, abstractmethod
-import requests
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import heapq
+import math
 import os
+import time
 from datetime import datetime, timedelta
 import logging
-from typing import List, Dict
+from typing import Callable, List, Dict, Optional, Tuple, TypeVar
+
+import metrics
+import rate_limit
+from forecasting import DemandSample, create_forecaster
+from rate_limit import DeferredError
+from schedule import load_schedule
+from sg_api_client import SGApiClient, get_shared_client
+from state_store import Lease, StateStore
+
+T = TypeVar("T")
 
 
 class SGRunner:
+    """
+    The fields of a runner the autoscaler uses. The rest of the runner's
+    response, e.g. its active workflows, is not kept.
+    """
+
+    __slots__ = (
+        "ip_address",
+        "computer_name",
+        "instance_arn",
+        "connection_status",
+        "status",
+        "runnerID",
+        "running_tasks_count",
+        "pending_tasks_count",
+        "oldest_workflow_started_at",
+    )
+
     def __init__(self, sg_runner: Dict):
         self.ip_address: str = sg_runner.get("instanceDetails")[0].get(
             "IPAddress"
@@ -20,10 +51,128 @@ class SGRunner:
         self.runnerID: str = sg_runner.get("runnerId")
         self.running_tasks_count = sg_runner.get("runningTasksCount")
         self.pending_tasks_count = sg_runner.get("pendingTasksCount")
-        self.sg_runner = sg_runner
+        # epoch seconds, only returned with getActiveWorkflows=true
+        self.oldest_workflow_started_at: Optional[float] = (
+            _oldest_workflow_start(sg_runner.get("activeWorkflows"))
+        )
+
+
+# keys the start time of an active workflow may be reported under
+_WORKFLOW_START_KEYS = ("startedAt", "StartedAt", "createdAt", "CreatedAt")
+
+
+def _oldest_workflow_start(active_workflows) -> Optional[float]:
+    starts = []
+    for workflow in active_workflows or []:
+        if not isinstance(workflow, dict):
+            continue
+        for key in _WORKFLOW_START_KEYS:
+            value = workflow.get(key)
+            if isinstance(value, (int, float)):
+                # epoch milliseconds or seconds
+                starts.append(value / 1000 if value > 1e11 else float(value))
+                break
+            if isinstance(value, str):
+                try:
+                    starts.append(
+                        datetime.fromisoformat(
+                            value.replace("Z", "+00:00")
+                        ).timestamp()
+                    )
+                except ValueError:
+                    continue
+                break
+    return min(starts) if starts else None
+
+
+def drain_priority(
+    sg_runner: SGRunner, cost_per_slot: Optional[float] = None
+) -> Tuple:
+    """
+    Sort key for drain candidates, lowest first: disconnected runners, then
+    idle runners, the most expensive per workflow slot first, then busy
+    runners whose oldest active workflow started longest ago, as they are
+    the likeliest to become idle soon
+    """
+    load = (sg_runner.running_tasks_count or 0) + (
+        sg_runner.pending_tasks_count or 0
+    )
+    if not sg_runner.connection_status:
+        return (0, 0, load)
+    if load == 0:
+        return (1, -(cost_per_slot or 0.0), 0)
+    started_at = sg_runner.oldest_workflow_started_at
+    return (2, started_at if started_at is not None else math.inf, load)
+
+
+def select_drain_candidates(
+    sg_runners: List[SGRunner],
+    count: int,
+    cost_per_slot: Optional[Callable[[SGRunner], Optional[float]]] = None,
+) -> List[SGRunner]:
+    """The count runners to drain first, in O(n log count)"""
+    if count <= 0:
+        return []
+    if cost_per_slot is None:
+        return heapq.nsmallest(count, sg_runners, key=drain_priority)
+    return heapq.nsmallest(
+        count,
+        sg_runners,
+        key=lambda sg_runner: drain_priority(
+            sg_runner, cost_per_slot(sg_runner)
+        ),
+    )
+
+
+def get_setting(
+    settings: Optional[Dict[str, str]], name: str, default: str = None
+) -> Optional[str]:
+    """
+    Reads a setting from settings, e.g. a runner group binding, falling back
+    to the environment variable of the same name
+    """
+    if settings is not None and name in settings:
+        return settings[name]
+    return os.getenv(name, default)
+
+
+class BatchResult:
+    """Per-runner outcome of a call applied to several runners"""
+
+    def __init__(self):
+        self.succeeded: List[SGRunner] = []
+        self.failed: List[Tuple[SGRunner, Exception]] = []
+        # not called, left to the next tick
+        self.deferred: List[SGRunner] = []
+
+    def __len__(self):
+        return len(self.succeeded)
+
+
+class InventoryJoin:
+    """Runners and VM's of the autoscale service that did not match up"""
+
+    def __init__(
+        self,
+        ghost_runners: Optional[List[SGRunner]] = None,
+        orphan_vms: Optional[List[str]] = None,
+    ):
+        # registered runners without a VM
+        self.ghost_runners: List[SGRunner] = ghost_runners or []
+        # ids of runner VM's without a registered runner
+        self.orphan_vms: List[str] = orphan_vms or []
 
 
 class CloudService(ABC):
+    # where state that is not covered by the methods below is kept between
+    # ticks, e.g. the demand history used for forecasting
+    state_store: Optional[StateStore] = None
+    # overrides for the environment variables the cloud service reads
+    settings: Optional[Dict[str, str]] = None
+
+    def _getenv(self, name: str, default: str = None) -> Optional[str]:
+        return get_setting(self.settings, name, default)
+
     @abstractmethod
     def get_last_scale_out_event(self) -> datetime:
         """Get when did the last scale out event occurred"""
@@ -59,8 +208,35 @@ class CloudService(ABC):
     @abstractmethod
     def count_of_existing_vms(self) -> int:
         """
-        Get the existing number of VM's or runners in the cloud
+        Get the existing number of VM's or runners in the cloud, not
+        counting standby VM's
+        """
+        pass
+
+    def count_of_standby_vms(self) -> int:
         """
+        Get the number of stopped or hibernated VM's that can be resumed
+        as runners. Override when the cloud service keeps standby VM's.
+        """
+        return 0
+
+    def resume_standby_vms(self, count: int) -> int:
+        """
+        Resume up to count standby VM's as runners, on top of the existing
+        VM's, returns the number of VM's resumed
+        """
+        return 0
+
+    def configure_standby_pool(self, max_size: int):
+        """
+        Called by the autoscaler with its STANDBY_POOL_MAX before the first
+        tick, 0 when it keeps no standby VM's. Override when the cloud
+        service reads its VM's differently with a standby pool.
+        """
+        pass
+
+    def set_standby_pool_size(self, size: int):
+        """Keep size VM's on standby, called once per tick"""
         pass
 
     @abstractmethod
@@ -78,102 +254,916 @@ class CloudService(ABC):
         """
         pass
 
+    def add_scale_in_protection_bulk(self, sg_runners: List[SGRunner]):
+        """
+        Add scale in protection to the VM's of several runners. Override
+        when the cloud service can batch protection changes.
+        """
+        for sg_runner in sg_runners:
+            self.add_scale_in_protection(sg_runner)
+
+    def remove_scale_in_protection_bulk(self, sg_runners: List[SGRunner]):
+        """
+        Remove scale in protection from the VM's of several runners. Override
+        when the cloud service can batch protection changes.
+        """
+        for sg_runner in sg_runners:
+            self.remove_scale_in_protection(sg_runner)
+
+    def get_unmatched_runners(
+        self, sg_runners: List[SGRunner]
+    ) -> List[SGRunner]:
+        """
+        Get the runners for which no VM exists in the autoscale service
+        """
+        return []
+
+    def join_inventory(self, sg_runners: List[SGRunner]) -> InventoryJoin:
+        """
+        Match the runners with the VM's of the autoscale service in one
+        pass. Standby VM's are neither runners nor orphans. This default
+        only finds ghost runners, override to also find orphan VM's.
+        """
+        return InventoryJoin(
+            ghost_runners=self.get_unmatched_runners(sg_runners)
+        )
+
+    def terminate_orphan_vms(self, vm_ids: List[str]) -> int:
+        """
+        Terminate VM's that never registered as runners, by the ids
+        join_inventory returned, and lower the desired capacity by as
+        many. Returns the number of VM's terminated.
+        """
+        return 0
+
+    def defer_terminations(self, vm_ids: List[str]):
+        """
+        Remember VM's whose termination was deferred, e.g. because the API
+        was throttling, so the next tick terminates them
+        """
+        if len(vm_ids) == 0:
+            return
+        logging.info(f"STACKGUARDIAN: deferred terminating {vm_ids}")
+        metrics.increment("actions_deferred", len(vm_ids), action="terminate")
+        if self.state_store is not None:
+            deferred = self.state_store.get().deferred_terminations
+            self.state_store.update(
+                deferred_terminations=sorted(set(deferred).union(vm_ids))
+            )
+
+    def terminate_deferred_vms(self) -> int:
+        """Terminate the VM's earlier ticks deferred, by their ids"""
+        if self.state_store is None:
+            return 0
+        vm_ids = self.state_store.get().deferred_terminations
+        if len(vm_ids) == 0:
+            return 0
+        # deferred again when they still do not go through
+        self.state_store.update(deferred_terminations=[])
+        return self.terminate_orphan_vms(vm_ids)
+
+    def count_of_unfulfilled_vms(self) -> int:
+        """
+        Get the number of VM's counted by count_of_existing_vms that the
+        autoscale service could not launch, e.g. for lack of spot capacity.
+        Override when the cloud service can tell.
+        """
+        return 0
+
+    def replace_unfulfilled_vms(self) -> int:
+        """
+        Called once per tick, replace VM's that could not be launched with
+        VM's elsewhere, returns the number of VM's added. Only cloud
+        services with more than one scale group can.
+        """
+        return 0
+
+    def runner_capacity(self, sg_runner: SGRunner) -> Optional[int]:
+        """
+        Workflows the runner's VM runs at once, None for RUNNER_CONCURRENCY.
+        Override when the VM's differ in size.
+        """
+        return None
+
+    def runner_hourly_cost(self, sg_runner: SGRunner) -> Optional[float]:
+        """What the runner's VM costs per hour, None when unknown"""
+        return None
+
+    def terminate_runner_vms(self, sg_runners: List[SGRunner]) -> int:
+        """
+        Terminate the VM's of deregistered runners and lower the desired
+        capacity by as many, returns the number of VM's terminated. This
+        default releases their scale in protection and lowers the desired
+        capacity, leaving it to the autoscale service to pick the VM's.
+        Override when the cloud service can terminate specific VM's.
+        """
+        if len(sg_runners) == 0:
+            return 0
+        self.remove_scale_in_protection_bulk(sg_runners)
+        self.set_autoscale_vms(self.count_of_existing_vms() - len(sg_runners))
+        return len(sg_runners)
+
+    def refresh(self):
+        """
+        Called at the start of every tick, drop whatever was read during the
+        previous tick
+        """
+        if self.state_store is not None:
+            self.state_store.invalidate()
+
+    def flush_state(self):
+        """
+        Called at the end of every tick, write any state changed during the
+        tick that was not saved yet
+        """
+        if self.state_store is not None:
+            self.state_store.save()
+
 
 class StackGuardianAutoscaler:
-    def __init__(self, cloud_service: CloudService):
-        self.SG_BASE_URI = os.getenv("SG_BASE_URI")
-        self.SG_API_KEY = os.getenv("SG_API_KEY")
+    def __init__(
+        self,
+        cloud_service: CloudService,
+        sg_client: Optional[SGApiClient] = None,
+        settings: Optional[Dict[str, str]] = None,
+        clock: Callable[[], datetime] = datetime.now,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        # overrides for the environment variables read below
+        self.settings = settings
+        # current time, replaced by the simulator
+        self.clock = clock
+        self.sleep = sleep
+        self.SCALE_IN_THRESHOLD = int(self._getenv("SCALE_IN_THRESHOLD"))
+        self.SCALE_IN_STEP = int(self._getenv("SCALE_IN_STEP"))
+
+        self.SCALE_OUT_THRESHOLD = int(self._getenv("SCALE_OUT_THRESHOLD"))
+        self.SCALE_OUT_STEP = int(self._getenv("SCALE_OUT_STEP"))
+
+        self.MIN_RUNNERS = int(self._getenv("MIN_RUNNERS", "0"))
+        self.MAX_RUNNERS = _optional_int(self._getenv("MAX_RUNNERS"))
+        # floors and ceilings by time of day, evaluated once per tick into
+        # min_runners and max_runners, MIN_RUNNERS and MAX_RUNNERS outside
+        # of its windows
+        self.schedule = load_schedule(self._getenv("CAPACITY_SCHEDULE"))
+        self.min_runners = self.MIN_RUNNERS
+        self.max_runners = self.MAX_RUNNERS
 
-        self.SCALE_IN_THRESHOLD = int(os.getenv("SCALE_IN_THRESHOLD"))
-        self.SCALE_IN_STEP = int(os.getenv("SCALE_IN_STEP"))
+        # "step" scales by SCALE_OUT_STEP/SCALE_IN_STEP when the queue crosses
+        # a threshold, "target" sizes the group from queued and running
+        # workflows in one action
+        self.SCALING_MODE = self._getenv("SCALING_MODE", "step")
+        self.RUNNER_CONCURRENCY = int(self._getenv("RUNNER_CONCURRENCY", "1"))
+        self.MAX_SCALE_OUT_STEP = _optional_int(
+            self._getenv("MAX_SCALE_OUT_STEP")
+        )
+        self.MAX_SCALE_IN_STEP = _optional_int(
+            self._getenv("MAX_SCALE_IN_STEP")
+        )
 
-        self.SCALE_OUT_THRESHOLD = int(os.getenv("SCALE_OUT_THRESHOLD"))
-        self.SCALE_OUT_STEP = int(os.getenv("SCALE_OUT_STEP"))
+        self.SG_API_MAX_CONCURRENCY = int(
+            self._getenv("SG_API_MAX_CONCURRENCY", "8")
+        )
 
-        self.MIN_RUNNERS = 0
+        self.forecaster = create_forecaster(
+            self._getenv("FORECASTER"),
+            alpha=float(self._getenv("FORECAST_ALPHA", "0.5")),
+            beta=float(self._getenv("FORECAST_BETA", "0.3")),
+        )
+        # how far ahead to look, roughly the time a new VM needs to boot
+        # and register
+        self.forecast_horizon = timedelta(
+            minutes=float(self._getenv("FORECAST_HORIZON_MINUTES", "5"))
+        )
+        self.FORECAST_HISTORY_SIZE = int(
+            self._getenv("FORECAST_HISTORY_SIZE", "60")
+        )
+
+        # stopped VM's kept to resume on scale out, sized from the demand
+        # history within these bounds; 0 disables the standby pool
+        self.STANDBY_POOL_MIN = int(self._getenv("STANDBY_POOL_MIN", "0"))
+        self.STANDBY_POOL_MAX = int(self._getenv("STANDBY_POOL_MAX", "0"))
 
-        self.SG_ORG = os.getenv("SG_ORG")
-        self.SG_RUNNER_GROUP = os.getenv("SG_RUNNER_GROUP")
+        self.SG_ORG = self._getenv("SG_ORG")
+        self.SG_RUNNER_GROUP = self._getenv("SG_RUNNER_GROUP")
 
         self.cloud_service = cloud_service
+        self.cloud_service.configure_standby_pool(self.STANDBY_POOL_MAX)
+        self.sg_client = sg_client or get_shared_client()
+
+        # a tick runs only while holding the runner group's lease, an
+        # overlapping invocation skips its tick; 0 disables the lease
+        lease_ttl = float(self._getenv("LEASE_TTL_SECONDS", "60"))
+        self.lease: Optional[Lease] = None
+        if cloud_service.state_store is not None and lease_ttl > 0:
+            self.lease = cloud_service.state_store.create_lease(
+                timedelta(seconds=lease_ttl)
+            )
 
         self.scale_in_cooldown_duration = timedelta(
-            minutes=int(os.getenv("SCALE_IN_COOLDOWN_DURATION"))
+            minutes=int(self._getenv("SCALE_IN_COOLDOWN_DURATION"))
         )
         self.scale_out_cooldown_duration = timedelta(
-            minutes=int(os.getenv("SCALE_OUT_COOLDOWN_DURATION"))
+            minutes=int(self._getenv("SCALE_OUT_COOLDOWN_DURATION"))
         )
 
-        self.sg_runner_group = None
+        # json, emf or openmetrics, unset disables metrics export
+        self.METRICS_FORMAT = self._getenv("METRICS_FORMAT")
+        if self.METRICS_FORMAT and (
+            self.METRICS_FORMAT not in metrics.METRICS_FORMATS
+        ):
+            raise ValueError(f"Unknown METRICS_FORMAT {self.METRICS_FORMAT}")
+        self.METRICS_NAMESPACE = self._getenv(
+            "METRICS_NAMESPACE", "StackGuardianAutoscaler"
+        )
+        self.METRICS_FILE = self._getenv("METRICS_FILE")
+        # scale_out_on_demand waits this long before reading the queue,
+        # notifications arriving meanwhile are coalesced into it
+        self.event_coalesce_window = timedelta(
+            seconds=float(self._getenv("EVENT_COALESCE_SECONDS", "10"))
+        )
+        # runners and VM's that stay broken for longer than these are
+        # cleaned up by the inventory reconciliation, empty disables it:
+        # runners whose agent is not connected, runners whose VM is gone
+        # and VM's that never registered, which includes booting VM's. The
+        # last two rely on the join matching every runner to its VM, a
+        # runner registering under a name it does not index looks like
+        # both, so they are opt in
+        self.disconnected_grace = _optional_minutes(
+            self._getenv("DISCONNECTED_GRACE_MINUTES", "10")
+        )
+        self.ghost_grace = _optional_minutes(
+            self._getenv("GHOST_GRACE_MINUTES")
+        )
+        self.orphan_grace = _optional_minutes(
+            self._getenv("ORPHAN_GRACE_MINUTES")
+        )
+        # API calls that would not be made within this many seconds of the
+        # start of a tick are left to the next one, empty disables it
+        self.TICK_BUDGET_SECONDS = _optional_float(
+            self._getenv("TICK_BUDGET_SECONDS", "50")
+        )
+        self.last_tick_metrics: Optional[metrics.TickMetrics] = None
+
         self.queued_jobs = None
         self.sg_runners: List[SGRunner] = None
+        self._registered_runners = 0
+        # set when a change made during the tick did not go as planned, so
+        # the local snapshot may no longer match the runner group
+        self._snapshot_stale = False
+
+    def _getenv(self, name: str, default: str = None) -> Optional[str]:
+        return get_setting(self.settings, name, default)
+
+    def refresh(self):
+        """
+        Takes the snapshot of the runner group the tick is planned on.
+        Changes made during the tick are applied to this snapshot locally.
+        """
+        self.cloud_service.refresh()
         self._refresh_sg_runner_group()
-        self._refresh_queued_jobs()
+        self._snapshot_stale = False
+        self._refresh_capacity_limits()
+
+        metrics.gauge("queued_jobs", self.queued_jobs)
+        statuses = {}
+        for sg_runner in self.sg_runners:
+            statuses[sg_runner.status] = statuses.get(sg_runner.status, 0) + 1
+        for status, count in statuses.items():
+            metrics.gauge("runners", count, status=status)
+        metrics.gauge(
+            "runners_disconnected",
+            sum(
+                1
+                for sg_runner in self.sg_runners
+                if not sg_runner.connection_status
+            ),
+        )
+
+    def _refresh_capacity_limits(self):
+        if self.schedule is None:
+            return
+        limits = self.schedule.limits(
+            self.clock(), self.MIN_RUNNERS, self.MAX_RUNNERS
+        )
+        self.min_runners = limits.min_runners
+        self.max_runners = limits.max_runners
+        logging.info(
+            f"STACKGUARDIAN: capacity windows {limits.windows}, min runners {self.min_runners}, max runners {self.max_runners}"
+        )
+        metrics.gauge("min_runners", self.min_runners)
+        if self.max_runners is not None:
+            metrics.gauge("max_runners", self.max_runners)
 
     def start(self):
         logging.info("STACKGUARDIAN: starting the autoscale script")
-        sg_runners = self.sg_runners
+        self._run_tick(self._periodic_tick)
+        logging.info(
+            f"STACKGUARDIAN: sg api stats {self.sg_client.get_stats()}"
+        )
+
+    def scale_out_on_demand(self) -> str:
+        """
+        The scale out half of a tick, run when StackGuardian reports a
+        queued workflow instead of waiting for the next periodic tick.
+        Scaling in and terminating VM's are left to the periodic ticks, the
+        cooldown is shared with them through the state store.
+
+        The first notification waits EVENT_COALESCE_SECONDS before reading
+        the queue so a burst of workflows is sized for at once, rather than
+        the first of them using up the cooldown. It waits before taking the
+        lease, so periodic ticks are not held up. Returns "coalesced" for
+        notifications arriving meanwhile, "busy" while another invocation
+        holds the lease, "deferred" when the APIs are throttling, otherwise
+        "scaled_out" or "no_change".
+        """
+        logging.info("STACKGUARDIAN: workflow queued, checking scale out")
+        outcome = self._run_tick(
+            self._event_tick,
+            trigger="event",
+            busy="busy",
+            deferred="deferred",
+            before_lease=self._coalesce_event,
+        )
+        logging.info(f"STACKGUARDIAN: scale out on demand {outcome}")
+        return outcome
+
+    def _run_tick(
+        self,
+        stages: Callable[[], T],
+        trigger: str = None,
+        busy: T = None,
+        deferred: T = None,
+        before_lease: Optional[Callable[[], Optional[T]]] = None,
+    ) -> T:
+        """
+        Runs stages as a tick, returns busy when the lease is held and
+        deferred when the rest of the tick was left to the next one.
+        before_lease runs first, without the lease, the tick ends with
+        whatever it returns unless that is None.
+        """
+        labels = {"org": self.SG_ORG, "runner_group": self.SG_RUNNER_GROUP}
+        if trigger is not None:
+            labels["trigger"] = trigger
+        tick = metrics.TickMetrics(labels=labels)
+        token = metrics.activate(tick)
+        try:
+            with metrics.span("tick"), rate_limit.tick_budget(
+                self.TICK_BUDGET_SECONDS
+            ):
+                if before_lease is not None:
+                    outcome = before_lease()
+                    if outcome is not None:
+                        return outcome
+                if self.lease is not None and not self.lease.acquire():
+                    logging.info(
+                        "STACKGUARDIAN: another invocation is running, skipping the tick"
+                    )
+                    metrics.increment("ticks_skipped", reason="lease")
+                    return busy
+                try:
+                    return stages()
+                except DeferredError as e:
+                    # throttled or out of time, the next tick picks up
+                    # from wherever this one got
+                    logging.warning(f"STACKGUARDIAN: tick deferred: {e}")
+                    metrics.increment("ticks_deferred")
+                    return deferred
+                finally:
+                    if self.lease is not None:
+                        self.lease.release()
+        finally:
+            metrics.deactivate(token)
+            self.last_tick_metrics = tick
+            self._export_metrics(tick)
+
+    def _periodic_tick(self):
+        with metrics.span("stage", stage="refresh"):
+            self.refresh()
+        try:
+            with metrics.span("stage", stage="inventory"):
+                self._terminate_deferred_vms()
+                self._replace_unfulfilled_vms()
+                self._reconcile_inventory()
+            with metrics.span("stage", stage="reconcile"):
+                self._reconcile()
+        finally:
+            with metrics.span("stage", stage="flush_state"):
+                self.cloud_service.flush_state()
+
+    def _event_tick(self) -> str:
+        # periodic ticks may have scaled out while the event waited
+        with metrics.span("stage", stage="refresh"):
+            self.refresh()
+        try:
+            with metrics.span("stage", stage="reconcile"):
+                has_scaled_out = self._reconcile_scale_out()
+        finally:
+            with metrics.span("stage", stage="flush_state"):
+                self.cloud_service.flush_state()
+        return "scaled_out" if has_scaled_out else "no_change"
+
+    def _coalesce_event(self) -> Optional[str]:
+        """
+        Returns "coalesced" when a notification already claimed the
+        coalesce window, otherwise claims it and waits it out. The claim is
+        read and written apart from the state of the tick, a periodic tick
+        may be running in the process meanwhile.
+        """
+        with metrics.span("stage", stage="coalesce"):
+            if self._claim_coalesce_window():
+                self.sleep(self.event_coalesce_window.total_seconds())
+                return None
+            return "coalesced"
+
+    def _claim_coalesce_window(self) -> bool:
+        state_store = self.cloud_service.state_store
+        if state_store is None:
+            return True
+
+        timestamp_now = self.clock()
+        for attempt in range(state_store.MAX_WRITE_ATTEMPTS):
+            # a coalesced notification costs a single state read
+            state, etag = state_store.load_detached()
+            last_event_trigger = state.last_event_trigger
+            if (
+                last_event_trigger is not None
+                and timestamp_now - last_event_trigger
+                < self.event_coalesce_window
+            ):
+                logging.info(
+                    f"STACKGUARDIAN: coalesced into the notification at {last_event_trigger.isoformat()}"
+                )
+                metrics.increment("events_coalesced")
+                return False
+            # of concurrent notifications only one wins the conditional
+            # write, the others see its timestamp on the next attempt
+            state.last_event_trigger = timestamp_now
+            if state_store.try_write_detached(state, etag):
+                return True
+        # the periodic tick kept writing the state, the cooldown still
+        # applies so run rather than drop the notification
+        return True
+
+    def _fence(self):
+        """
+        Called before changing the runner group or its VM's, fails the tick
+        when the lease was lost so two invocations never both scale
+        """
+        if self.lease is not None:
+            self.lease.fence()
+
+    def _export_metrics(self, tick: metrics.TickMetrics):
+        try:
+            metrics.export(
+                tick,
+                self.METRICS_FORMAT,
+                namespace=self.METRICS_NAMESPACE,
+                path=self.METRICS_FILE,
+            )
+        except Exception as e:
+            # never fail a tick because its metrics could not be written
+            logging.warning(f"STACKGUARDIAN: exporting metrics failed: {e}")
+
+    def _record_demand(self) -> List[DemandSample]:
+        """
+        Records this tick's demand in the history kept in the state store,
+        for the forecast and the standby pool size
+        """
+        state_store = self.cloud_service.state_store
+        if state_store is None or (
+            self.forecaster is None and self.STANDBY_POOL_MAX == 0
+        ):
+            return []
+
+        sample = DemandSample(
+            timestamp=self.clock(),
+            queued_jobs=self.queued_jobs,
+            running_tasks=sum(
+                sg_runner.running_tasks_count or 0
+                for sg_runner in self.sg_runners
+            ),
+            runners=len(self.sg_runners),
+        )
+        demand_history = state_store.get().demand_history + [sample.to_list()]
+        demand_history = demand_history[-self.FORECAST_HISTORY_SIZE :]
+        # written with the rest of the state at the end of the tick
+        state_store.update(demand_history=demand_history)
+        return [DemandSample.from_list(s) for s in demand_history]
+
+    def _forecast_queued_jobs(
+        self, demand_history: List[DemandSample]
+    ) -> Optional[float]:
+        """Forecasts the queued jobs forecast_horizon from now"""
+        if self.forecaster is None or len(demand_history) == 0:
+            return None
+
+        forecast = self.forecaster.forecast(
+            demand_history, self.forecast_horizon
+        )
+        if forecast is not None:
+            metrics.gauge("forecast_queued_jobs", forecast)
+        return forecast
+
+    def _terminate_deferred_vms(self):
+        self._fence()
+        terminated = self.cloud_service.terminate_deferred_vms()
+        if terminated > 0:
+            metrics.increment("vms_terminated", terminated)
+
+    def _replace_unfulfilled_vms(self):
+        self._fence()
+        replaced = self.cloud_service.replace_unfulfilled_vms()
+        if replaced > 0:
+            metrics.increment("vms_replaced", replaced)
+
+    def _reconcile_inventory(self):
+        """
+        Joins the runners with the VM's of the autoscale service and cleans
+        up what stayed broken for longer than its grace period. Runners
+        whose agent is not connected are drained, deregistered and their
+        VM's terminated, runners whose VM is gone are deregistered and VM's
+        that never registered are terminated. Until then these runners do
+        not count as capacity for the tick's decisions.
+        """
         if (
-            self.queued_jobs >= self.SCALE_OUT_THRESHOLD
-            or len(sg_runners) < self.MIN_RUNNERS
-            or (self.queued_jobs > 0 and len(sg_runners) == 0)
+            self.disconnected_grace is None
+            and self.ghost_grace is None
+            and self.orphan_grace is None
         ):
-            self.scale_out()
+            return
+
+        join = self.cloud_service.join_inventory(self.sg_runners)
+        ghost_runners = set(join.ghost_runners)
+        orphan_vms = join.orphan_vms
+        if (
+            len(ghost_runners) > 0
+            and len(ghost_runners) == len(self.sg_runners)
+            and len(orphan_vms) > 0
+        ):
+            # not a single runner matched a VM, rather the runners register
+            # under names the cloud service does not index than all of them
+            # being gone at once
+            logging.warning(
+                "STACKGUARDIAN: no runner matches a VM, skipping ghost runners and orphan VM's"
+            )
+            ghost_runners = set()
+            orphan_vms = []
+        disconnected_runners = [
+            sg_runner
+            for sg_runner in self.sg_runners
+            if not sg_runner.connection_status
+            and sg_runner not in ghost_runners
+        ]
+        metrics.gauge("ghost_runners", len(ghost_runners))
+        metrics.gauge("orphan_vms", len(orphan_vms))
+
+        # when each of them was first seen broken, kept between ticks
+        state_store = self.cloud_service.state_store
+        previous = state_store.get().unhealthy_since if state_store else {}
+        unhealthy_since = {}
+        timestamp_now = self.clock()
+
+        def overdue(key: str, grace: Optional[timedelta]) -> bool:
+            since = previous.get(key)
+            since = datetime.fromisoformat(since) if since else timestamp_now
+            unhealthy_since[key] = since.isoformat()
+            return grace is not None and timestamp_now - since >= grace
+
+        overdue_ghosts = [
+            sg_runner
+            for sg_runner in ghost_runners
+            if overdue(f"ghost:{sg_runner.runnerID}", self.ghost_grace)
+        ]
+        overdue_disconnected = [
+            sg_runner
+            for sg_runner in disconnected_runners
+            if overdue(
+                f"disconnected:{sg_runner.runnerID}", self.disconnected_grace
+            )
+        ]
+        overdue_orphans = [
+            vm_id
+            for vm_id in orphan_vms
+            if overdue(f"orphan:{vm_id}", self.orphan_grace)
+        ]
+        if state_store is not None and unhealthy_since != previous:
+            # written with the rest of the state at the end of the tick
+            state_store.update(unhealthy_since=unhealthy_since)
+        if overdue_ghosts or overdue_disconnected or overdue_orphans:
+            self._fence()
+
+        if len(overdue_ghosts) > 0:
+            logging.info(
+                f"STACKGUARDIAN: deregistering runners without a VM {[sg_runner.computer_name for sg_runner in overdue_ghosts]}"
+            )
+            deregistered = self._run_for_runners(
+                self._deregister_sg_runner, overdue_ghosts
+            )
+            metrics.increment("ghost_runners_deregistered", len(deregistered))
+
+        if len(overdue_disconnected) > 0:
+            logging.info(
+                f"STACKGUARDIAN: removing disconnected runners {[sg_runner.computer_name for sg_runner in overdue_disconnected]}"
+            )
+            # a runner left draining when deregistering fails gets no new
+            # workflows, terminate_vms retries it
+            self._update_sg_runners_status(
+                [
+                    sg_runner
+                    for sg_runner in overdue_disconnected
+                    if sg_runner.status != "DRAINING"
+                ],
+                "DRAINING",
+            )
+            deregistered = self._run_for_runners(
+                self._deregister_sg_runner,
+                [
+                    sg_runner
+                    for sg_runner in overdue_disconnected
+                    if sg_runner.status == "DRAINING"
+                ],
+            )
+            metrics.increment(
+                "disconnected_runners_deregistered", len(deregistered)
+            )
+            terminated = self.cloud_service.terminate_runner_vms(
+                deregistered.succeeded
+            )
+            metrics.increment("vms_terminated", terminated)
+
+        if len(overdue_orphans) > 0:
+            logging.info(
+                f"STACKGUARDIAN: terminating VM's without a runner {overdue_orphans}"
+            )
+            terminated = self.cloud_service.terminate_orphan_vms(
+                overdue_orphans
+            )
+            metrics.increment("orphan_vms_terminated", terminated)
+
+        # left to scale in as before when their cleanup is disabled
+        if self.ghost_grace is None:
+            ghost_runners = set()
+        if self.disconnected_grace is None:
+            disconnected_runners = []
+        excluded = ghost_runners.union(disconnected_runners)
+        self.sg_runners = [
+            sg_runner
+            for sg_runner in self.sg_runners
+            if sg_runner not in excluded
+        ]
+
+    def _reconcile(self):
+        demand_history = self._record_demand()
+        forecast = self._forecast_queued_jobs(demand_history)
+        if self.STANDBY_POOL_MAX > 0:
+            self._size_standby_pool(demand_history)
+        if self.SCALING_MODE == "target":
+            self._reconcile_target(forecast)
+        else:
+            self._reconcile_step(forecast)
+
+    def _reconcile_scale_out(self) -> bool:
+        """
+        The scale out decision of _reconcile_step or _reconcile_target on
+        the current queue, without recording a forecast sample since
+        notifications do not arrive at tick intervals
+        """
+        if self.SCALING_MODE == "target":
+            target, active_runners = self._target_runners(None)
+            scale_out_step = self._limit_scale_out_step(
+                target - active_runners
+            )
+        else:
+            scale_out_step = self._step_scale_out_size(self._queue_scale_out())
+
+        if scale_out_step <= 0:
+            metrics.increment("decisions", action="hold")
+            return False
+        metrics.increment("decisions", action="scale_out")
+        return self.scale_out(scale_out_step)
+
+    def _reactive_scale_out(self) -> bool:
+        return (
+            self._queue_scale_out() or len(self.sg_runners) < self.min_runners
+        )
+
+    def _queue_scale_out(self) -> bool:
+        return self.queued_jobs >= self.SCALE_OUT_THRESHOLD or (
+            self.queued_jobs > 0 and len(self.sg_runners) == 0
+        )
+
+    def _step_scale_out_size(self, demand: bool) -> int:
+        """
+        SCALE_OUT_STEP when there is demand, at least enough VM's to reach
+        the floor, e.g. when a capacity window starts, and at most enough to
+        reach the ceiling. VM's still booting count towards both.
+        """
+        scale_out_step = self.SCALE_OUT_STEP if demand else 0
+        below_floor = len(self.sg_runners) < self.min_runners
+        if not below_floor and self.max_runners is None:
+            return scale_out_step
+        existing_vms = self.cloud_service.count_of_existing_vms()
+        if below_floor:
+            scale_out_step = max(
+                scale_out_step,
+                self._limit_scale_out_step(self.min_runners - existing_vms),
+            )
+        if self.max_runners is not None:
+            scale_out_step = min(
+                scale_out_step, self.max_runners - existing_vms
+            )
+        return max(0, scale_out_step)
+
+    def _reconcile_step(self, forecast: Optional[float]):
+        reactive_scale_out = self._reactive_scale_out()
+        forecast_scale_out = (
+            forecast is not None and forecast >= self.SCALE_OUT_THRESHOLD
+        )
+        if forecast is not None:
+            logging.info(
+                f"STACKGUARDIAN: decision queued {self.queued_jobs}, reactive scale out {reactive_scale_out}, forecast queued {forecast:.2f} in {self.forecast_horizon}, forecast scale out {forecast_scale_out}"
+            )
+
+        scale_out_step = self._step_scale_out_size(
+            self._queue_scale_out() or forecast_scale_out
+        )
+        if scale_out_step > 0:
+            if not reactive_scale_out:
+                logging.info(
+                    "STACKGUARDIAN: scaling out ahead of forecast demand"
+                )
+            metrics.increment("decisions", action="scale_out")
+            self.scale_out(scale_out_step)
             # incase there are any draining VM's left to delete even after scaling out depending on the scale_out_step and scale_in_step.
             self.terminate_vms()
-        elif self.queued_jobs <= self.SCALE_IN_THRESHOLD:
+        elif (
+            not reactive_scale_out
+            and not forecast_scale_out
+            and self.queued_jobs <= self.SCALE_IN_THRESHOLD
+        ):
+            metrics.increment("decisions", action="scale_in")
             self.scale_in(self.SCALE_IN_STEP)
             # delete draining VM's
             self.terminate_vms()
         else:
+            metrics.increment("decisions", action="hold")
             self.terminate_vms()
 
-    def scale_out(self):
+    def _reconcile_target(self, forecast: Optional[float]):
+        target, active_runners = self._target_runners(forecast)
+        if target > active_runners:
+            metrics.increment("decisions", action="scale_out")
+            self.scale_out(self._limit_scale_out_step(target - active_runners))
+        elif target < active_runners:
+            scale_in_step = active_runners - target
+            if self.MAX_SCALE_IN_STEP is not None:
+                scale_in_step = min(scale_in_step, self.MAX_SCALE_IN_STEP)
+            metrics.increment("decisions", action="scale_in")
+            self.scale_in(scale_in_step)
+        else:
+            metrics.increment("decisions", action="hold")
+        self.terminate_vms()
+
+    def _limit_scale_out_step(self, scale_out_step: int) -> int:
+        if self.MAX_SCALE_OUT_STEP is not None:
+            return min(scale_out_step, self.MAX_SCALE_OUT_STEP)
+        return scale_out_step
+
+    def _target_runners(self, forecast: Optional[float]) -> Tuple[int, int]:
+        """
+        The target and the active runner counts, runners not draining and
+        VM's still booting
+        """
+        running_tasks = sum(
+            (sg_runner.running_tasks_count or 0)
+            + (sg_runner.pending_tasks_count or 0)
+            for sg_runner in self.sg_runners
+        )
+        target = self.target_runner_count(self.queued_jobs + running_tasks)
+        if forecast is not None:
+            forecast_target = self.target_runner_count(
+                forecast + running_tasks
+            )
+            if forecast_target > target:
+                logging.info(
+                    "STACKGUARDIAN: sizing for forecast demand ahead of the queue"
+                )
+                target = forecast_target
+
+        # in runners of RUNNER_CONCURRENCY, VM's may differ in size
+        active_slots = sum(
+            self._runner_capacity(sg_runner)
+            for sg_runner in self.sg_runners
+            if sg_runner.status != "DRAINING"
+        )
+        # VM's whose runner has not registered yet already cover part of
+        # the target, otherwise every tick of their boot asks for them again
+        pending_vms = max(
+            0,
+            self.cloud_service.count_of_existing_vms()
+            - self._registered_runners,
+        )
+        active_runners = active_slots // self.RUNNER_CONCURRENCY + pending_vms
+        metrics.gauge("target_runners", target)
+        metrics.gauge("pending_vms", pending_vms)
+        logging.info(
+            f"STACKGUARDIAN: target runners {target}, active runners {active_runners}, pending VM's {pending_vms}, queued jobs {self.queued_jobs}, running tasks {running_tasks}"
+        )
+        return target, active_runners
+
+    def standby_pool_size(self, demand_history: List[DemandSample]) -> int:
+        """
+        Standby VM's for the longest queue in the demand history, the
+        workflows that last had to wait for new VM's, within
+        STANDBY_POOL_MIN and STANDBY_POOL_MAX
+        """
+        peak = max(
+            (sample.queued_jobs for sample in demand_history), default=0
+        )
+        size = math.ceil(peak / self.RUNNER_CONCURRENCY)
+        return min(max(size, self.STANDBY_POOL_MIN), self.STANDBY_POOL_MAX)
+
+    def _size_standby_pool(self, demand_history: List[DemandSample]):
+        size = self.standby_pool_size(demand_history)
+        logging.info(f"STACKGUARDIAN: standby pool size {size}")
+        metrics.gauge("standby_pool_size", size)
+        self._fence()
+        self.cloud_service.set_standby_pool_size(size)
+        metrics.gauge("standby_vms", self.cloud_service.count_of_standby_vms())
+
+    def target_runner_count(self, workflows: float) -> int:
+        """
+        Runners needed for workflows, within the floor and ceiling of the
+        tick, MIN_RUNNERS and MAX_RUNNERS unless a capacity window applies
+        """
+        target = math.ceil(workflows / self.RUNNER_CONCURRENCY)
+        target = max(target, self.min_runners)
+        if self.max_runners is not None:
+            target = min(target, self.max_runners)
+        return target
+
+    def scale_out(self, scale_out_step: Optional[int] = None) -> bool:
+        """Returns whether runners were reactivated or VM's added"""
+        if scale_out_step is None:
+            scale_out_step = self.SCALE_OUT_STEP
         logging.info(
-            f"STACKGUARDIAN: scale out: queued jobs {self.queued_jobs}, number of sg runners {len(self.sg_runners)}, min runners {self.MIN_RUNNERS}, scale out threshold {self.SCALE_OUT_THRESHOLD}"
+            f"STACKGUARDIAN: scale out: queued jobs {self.queued_jobs}, number of sg runners {len(self.sg_runners)}, min runners {self.min_runners}, scale out threshold {self.SCALE_OUT_THRESHOLD}"
         )
 
         # cooldown
         last_scale_out_timestamp = (
             self.cloud_service.get_last_scale_out_event()
         )
-        timestamp_now = datetime.now()
+        timestamp_now = self.clock()
         if last_scale_out_timestamp is not None and (
             timestamp_now - last_scale_out_timestamp
-            < self.scale_in_cooldown_duration
+            < self.scale_out_cooldown_duration
         ):
             logging.info(
                 f"STACKGUARDIAN: waiting for cooldown last scale out event {last_scale_out_timestamp.isoformat()}"
             )
-            return
+            metrics.increment("cooldown_skips", action="scale_out")
+            return False
+        self._fence()
 
         # Check if there are VM's in draining state
         draining_virtual_machines = self._fetch_vms_in_draining_state()
 
-        has_scaled_out = False
-        # if yes remove vm equal to scale_out_step from draining state
-        if len(draining_virtual_machines) >= self.SCALE_OUT_STEP:
-            for sg_runner in draining_virtual_machines[
-                0 : self.SCALE_OUT_STEP
-            ]:
-                self._update_sg_runner_status(sg_runner, "ACTIVE")
-            has_scaled_out = True
-        # remove all from draining state and add the number of VM's after
-        # deducting the number of draining VM's from scale_out_step
-        elif len(draining_virtual_machines) < self.SCALE_OUT_STEP:
-            for sg_runner in draining_virtual_machines:
-                self._update_sg_runner_status(sg_runner, "ACTIVE")
-            self.cloud_service.set_autoscale_vms(
-                self.cloud_service.count_of_existing_vms()
-                + self.SCALE_OUT_STEP
-                - len(draining_virtual_machines),
-            )
-            has_scaled_out = True
+        # reactivate up to scale_out_step draining VM's first
+        reactivated = self._update_sg_runners_status(
+            draining_virtual_machines[0:scale_out_step], "ACTIVE"
+        )
+        metrics.increment("runners_reactivated", len(reactivated))
 
-        if has_scaled_out:
-            self.cloud_service.set_last_scale_out_event(datetime.now())
+        # add new VM's for whatever could not be covered by draining VM's,
+        # including reactivations that failed, resuming standby VM's first
+        new_vms = scale_out_step - len(reactivated)
+        resumed = 0
+        added = 0
+        try:
+            if new_vms > 0:
+                resumed = self.cloud_service.resume_standby_vms(new_vms)
+            if new_vms - resumed > 0:
+                self.cloud_service.set_autoscale_vms(
+                    self.cloud_service.count_of_existing_vms()
+                    + new_vms
+                    - resumed,
+                )
+                added = new_vms - resumed
+        finally:
+            # also when adding VM's failed or was deferred, otherwise the
+            # next tick repeats the reactivations without a cooldown
+            has_scaled_out = len(reactivated) > 0 or resumed > 0 or added > 0
+            if has_scaled_out:
+                self.cloud_service.set_last_scale_out_event(self.clock())
 
-        self._refresh_sg_runner_group()
+        logging.info(
+            f"STACKGUARDIAN: scaled out, reactivated {len(reactivated)}, resumed {resumed}, new VM's {added}"
+        )
+        metrics.increment("vms_resumed", resumed)
+        metrics.increment("vms_added", added)
+        return has_scaled_out
 
     def scale_in(self, scale_in_step):
         if len(self.sg_runners) == 0:
@@ -181,12 +1171,12 @@ class StackGuardianAutoscaler:
             return
 
         logging.info(
-            f"STACKGUARDIAN scale in: queued jobs {self.queued_jobs}, number of sg runners {len(self.sg_runners)}, min runners {self.MIN_RUNNERS}, scale in threshold {self.SCALE_IN_THRESHOLD}"
+            f"STACKGUARDIAN scale in: queued jobs {self.queued_jobs}, number of sg runners {len(self.sg_runners)}, min runners {self.min_runners}, scale in threshold {self.SCALE_IN_THRESHOLD}"
         )
 
         # Cool down for scale in
         last_scale_in_timestamp = self.cloud_service.get_last_scale_in_event()
-        timestamp_now = datetime.now()
+        timestamp_now = self.clock()
         timestamp_now.isocalendar()
         if last_scale_in_timestamp is not None and (
             timestamp_now - last_scale_in_timestamp
@@ -195,116 +1185,192 @@ class StackGuardianAutoscaler:
             logging.info(
                 f"STACKGUARDIAN: waiting for cooldown last scale in event {last_scale_in_timestamp.isoformat()}"
             )
+            metrics.increment("cooldown_skips", action="scale_in")
             return
+        self._fence()
 
         # add protection to newly spawned vm's
-        for sg_runner in self.sg_runners:
-            self.cloud_service.add_scale_in_protection(sg_runner)
+        self.cloud_service.add_scale_in_protection_bulk(self.sg_runners)
 
         vms_draining = self._fetch_vms_in_draining_state()
 
         active_drainable_vms = (
-            len(self.sg_runners) - len(vms_draining) - self.MIN_RUNNERS
+            len(self.sg_runners) - len(vms_draining) - self.min_runners
         )
 
         if active_drainable_vms < scale_in_step:
             scale_in_step = active_drainable_vms
 
-        has_scaled_in = False
         if active_drainable_vms > 0:
             drain_count = min(scale_in_step, active_drainable_vms)
-            for sg_runner in self.sg_runners:
-                if drain_count == 0:
-                    break
-
-                if sg_runner.status != "DRAINING":
-                    self._update_sg_runner_status(sg_runner, "DRAINING")
-                    drain_count -= 1
-                    has_scaled_in = True
+            drain_candidates = select_drain_candidates(
+                [
+                    sg_runner
+                    for sg_runner in self.sg_runners
+                    if sg_runner.status != "DRAINING"
+                ],
+                drain_count,
+                cost_per_slot=self._runner_cost_per_slot,
+            )
+            drained = self._update_sg_runners_status(
+                drain_candidates, "DRAINING"
+            )
+            metrics.increment("runners_drained", len(drained))
 
             # if there was a runner set to draining
-            if has_scaled_in:
-                logging.info(
-                    f"STACKGUARDIAN: scaled in {scale_in_step - drain_count}"
-                )
-                self.cloud_service.set_last_scale_in_event(datetime.now())
-
-            self._refresh_sg_runner_group()
+            if len(drained) > 0:
+                logging.info(f"STACKGUARDIAN: scaled in {len(drained)}")
+                self.cloud_service.set_last_scale_in_event(self.clock())
 
     def terminate_vms(self):
         logging.info("STACKGUARDIAN: terminating VM's")
 
-        self._refresh_sg_runner_group()
+        if self._snapshot_stale:
+            logging.info(
+                "STACKGUARDIAN: snapshot is stale, reading the runner group again"
+            )
+            # the runner group only, refreshing the cloud service would
+            # drop the state changed during the tick
+            self._refresh_sg_runner_group()
+            self._snapshot_stale = False
         sg_runner_draining = self._fetch_vms_in_draining_state()
         if len(sg_runner_draining) == 0:
             return
+        self._fence()
 
-        count = 0
-        for sg_runner in sg_runner_draining:
-            if (
-                sg_runner.running_tasks_count == 0
-                and sg_runner.pending_tasks_count == 0
-            ):
-                count += 1
-                self.cloud_service.remove_scale_in_protection(sg_runner)
-                self._deregister_sg_runner(sg_runner)
-        if count > 0:
-            self.cloud_service.set_autoscale_vms(
-                self.cloud_service.count_of_existing_vms() - count
-            )
+        idle_runners = [
+            sg_runner
+            for sg_runner in sg_runner_draining
+            if sg_runner.running_tasks_count == 0
+            and sg_runner.pending_tasks_count == 0
+        ]
+        deregistered = self._run_for_runners(
+            self._deregister_sg_runner, idle_runners
+        )
+        metrics.increment("runners_deregistered", len(deregistered))
+        deregistered_runners = set(deregistered.succeeded)
+        self.sg_runners = [
+            sg_runner
+            for sg_runner in self.sg_runners
+            if sg_runner not in deregistered_runners
+        ]
+        # only terminate VM's whose runner is really gone
+        terminated = self.cloud_service.terminate_runner_vms(
+            deregistered.succeeded
+        )
+        metrics.increment("vms_terminated", terminated)
 
     def _deregister_sg_runner(self, sg_runner: SGRunner):
         logging.info(
             f"STACKGUARDIAN: deregistering sg runner {sg_runner.computer_name}"
         )
-        payload = {"RunnerId": sg_runner.runnerID}
-
-        uri = f"{self.SG_BASE_URI}/api/v1/orgs/{self.SG_ORG}/runnergroups/{self.SG_RUNNER_GROUP}/deregister/"
-
-        headers = {"Authorization": f"apikey {self.SG_API_KEY}"}
-
-        res = requests.post(uri, payload, headers=headers)
-        res.raise_for_status()
+        self.sg_client.deregister_runner(
+            self.SG_ORG, self.SG_RUNNER_GROUP, sg_runner.runnerID
+        )
 
     def _refresh_sg_runner_group(self):
-        uri = f"{self.SG_BASE_URI}/api/v1/orgs/{self.SG_ORG}/runnergroups/{self.SG_RUNNER_GROUP}/?getActiveWorkflows=true"
-
-        headers = {"Authorization": f"apikey {self.SG_API_KEY}"}
-
-        res = requests.get(uri, headers=headers)
-        res.raise_for_status()
-
-        self.sg_runner_group = res.json()
+        """
+        Reads the queued workflows and the runners while the response is
+        parsed, only an SGRunner is kept of every runner
+        """
+        queued_jobs = None
         sg_runners = []
-        for runner in self.sg_runner_group.get("msg").get(
-            "ContainerInstances"
+        for key, value in self.sg_client.stream_runner_group(
+            self.SG_ORG, self.SG_RUNNER_GROUP
         ):
-            sg_runners.append(SGRunner(runner))
-
-        self.sg_runners = sg_runners
-
-    def _refresh_queued_jobs(self) -> int:
-        queued_jobs = self.sg_runner_group.get("msg").get(
-            "QueuedWorkflowsCount"
-        )
+            if key == "runner":
+                sg_runners.append(SGRunner(value))
+            elif key == "QueuedWorkflowsCount":
+                queued_jobs = value
 
         if queued_jobs is None:
             raise Exception("Failed to fetch queued jobs")
 
+        self.sg_runners = sg_runners
         self.queued_jobs = queued_jobs
+        # including the runners the inventory reconciliation leaves out,
+        # their VM's exist too
+        self._registered_runners = len(sg_runners)
 
     def _update_sg_runner_status(self, sg_runner: SGRunner, status: str):
         logging.info(
-            f"STACKGUARDIAN: updating runner VM status {sg_runner.computer_name} to {sg_runner.status}"
+            f"STACKGUARDIAN: updating runner VM status {sg_runner.computer_name} to {status}"
+        )
+        self.sg_client.update_runner_status(
+            self.SG_ORG, self.SG_RUNNER_GROUP, sg_runner.runnerID, status
         )
-        payload = {"Status": status, "RunnerId": sg_runner.runnerID}
 
-        headers = {"Authorization": f"apikey {self.SG_API_KEY}"}
+    def _update_sg_runners_status(
+        self, sg_runners: List[SGRunner], status: str
+    ) -> BatchResult:
+        result = self._run_for_runners(
+            lambda sg_runner: self._update_sg_runner_status(sg_runner, status),
+            sg_runners,
+        )
+        for sg_runner in result.succeeded:
+            sg_runner.status = status
+        return result
 
-        uri = f"{self.SG_BASE_URI}/api/v1/orgs/{self.SG_ORG}/runnergroups/{self.SG_RUNNER_GROUP}/runner_status/"
+    def _run_for_runners(
+        self, action: Callable[[SGRunner], None], sg_runners: List[SGRunner]
+    ) -> BatchResult:
+        """
+        Runs action for every runner on at most SG_API_MAX_CONCURRENCY
+        threads. A failing runner is recorded in the result instead of
+        aborting the rest of the batch.
+        """
+        result = BatchResult()
+        if len(sg_runners) == 0:
+            return result
+
+        max_workers = max(1, min(self.SG_API_MAX_CONCURRENCY, len(sg_runners)))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # each call runs in a copy of this context, so it records into
+            # the current tick's metrics
+            futures = [
+                (
+                    sg_runner,
+                    executor.submit(
+                        contextvars.copy_context().run, action, sg_runner
+                    ),
+                )
+                for sg_runner in sg_runners
+            ]
+            for sg_runner, future in futures:
+                try:
+                    future.result()
+                    result.succeeded.append(sg_runner)
+                except DeferredError:
+                    # nothing changed, the snapshot still holds
+                    result.deferred.append(sg_runner)
+                except Exception as e:
+                    logging.info(
+                        f"STACKGUARDIAN: call failed for runner {sg_runner.computer_name}: {e}"
+                    )
+                    result.failed.append((sg_runner, e))
+
+        if len(result.failed) > 0:
+            metrics.increment("runner_call_failures", len(result.failed))
+            self._snapshot_stale = True
+        if len(result.deferred) > 0:
+            logging.info(
+                f"STACKGUARDIAN: deferred calls for {len(result.deferred)} runners"
+            )
+            metrics.increment(
+                "actions_deferred", len(result.deferred), action="runner_call"
+            )
 
-        res = requests.post(uri, payload, headers=headers)
-        res.raise_for_status()
+        return result
+
+    def _runner_capacity(self, sg_runner: SGRunner) -> int:
+        capacity = self.cloud_service.runner_capacity(sg_runner)
+        return self.RUNNER_CONCURRENCY if capacity is None else capacity
+
+    def _runner_cost_per_slot(self, sg_runner: SGRunner) -> Optional[float]:
+        cost = self.cloud_service.runner_hourly_cost(sg_runner)
+        if cost is None:
+            return None
+        return cost / max(1, self._runner_capacity(sg_runner))
 
     def _fetch_vms_in_draining_state(self) -> List[SGRunner]:
         """API call to get if vm's are in draining state
@@ -316,3 +1382,15 @@ class StackGuardianAutoscaler:
                 vms_draining.append(sg_runner)
 
         return vms_draining
+
+
+def _optional_int(value: Optional[str]) -> Optional[int]:
+    return int(value) if value else None
+
+
+def _optional_float(value: Optional[str]) -> Optional[float]:
+    return float(value) if value else None
+
+
+def _optional_minutes(value: Optional[str]) -> Optional[timedelta]:
+    return timedelta(minutes=float(value)) if value else None
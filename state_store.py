@@ -0,0 +1,533 @@
+import contextvars
+import json
+import logging
+import threading
+import uuid
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+import metrics
+
+
+class StateConflictError(Exception):
+    """The state document was changed by someone else since it was read"""
+
+
+class LeaseLostError(Exception):
+    """The lease expired or another invocation took it over"""
+
+
+class AutoscalerState:
+    """Cooldown and capacity bookkeeping kept between ticks"""
+
+    VERSION = 1
+
+    def __init__(
+        self,
+        last_scale_out_event: Optional[datetime] = None,
+        last_scale_in_event: Optional[datetime] = None,
+        last_desired_capacity: Optional[int] = None,
+        last_action: Optional[str] = None,
+        demand_history: Optional[List[List]] = None,
+        last_event_trigger: Optional[datetime] = None,
+        unhealthy_since: Optional[Dict[str, str]] = None,
+        lease_token: Optional[int] = None,
+        deferred_terminations: Optional[List[str]] = None,
+        pools_unavailable_until: Optional[Dict[str, str]] = None,
+        capacity_gap_since: Optional[datetime] = None,
+    ):
+        self.last_scale_out_event = last_scale_out_event
+        self.last_scale_in_event = last_scale_in_event
+        self.last_desired_capacity = last_desired_capacity
+        self.last_action = last_action
+        # DemandSample.to_list() of the most recent ticks, oldest first
+        self.demand_history = demand_history or []
+        # when an event triggered scale out last ran, events shortly after
+        # it are coalesced
+        self.last_event_trigger = last_event_trigger
+        # when runners and VM's found broken by the inventory
+        # reconciliation were first seen, ISO timestamps by kind and id
+        self.unhealthy_since = unhealthy_since or {}
+        # fencing token of the lease holder that last wrote the document
+        self.lease_token = lease_token
+        # ids of VM's whose termination was left to the next tick
+        self.deferred_terminations = deferred_terminations or []
+        # scale pools that could not launch VM's are not scaled out until
+        # then, ISO timestamps by pool name
+        self.pools_unavailable_until = pools_unavailable_until or {}
+        # since when the scale group has had fewer VM's than desired
+        self.capacity_gap_since = capacity_gap_since
+
+    @classmethod
+    def from_json(cls, content: str) -> "AutoscalerState":
+        document = json.loads(content)
+        return cls(
+            last_scale_out_event=_parse_datetime(
+                document.get("last_scale_out_event")
+            ),
+            last_scale_in_event=_parse_datetime(
+                document.get("last_scale_in_event")
+            ),
+            last_desired_capacity=document.get("last_desired_capacity"),
+            last_action=document.get("last_action"),
+            demand_history=document.get("demand_history"),
+            last_event_trigger=_parse_datetime(
+                document.get("last_event_trigger")
+            ),
+            unhealthy_since=document.get("unhealthy_since"),
+            lease_token=document.get("lease_token"),
+            deferred_terminations=document.get("deferred_terminations"),
+            pools_unavailable_until=document.get("pools_unavailable_until"),
+            capacity_gap_since=_parse_datetime(
+                document.get("capacity_gap_since")
+            ),
+        )
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {
+                "version": self.VERSION,
+                "last_scale_out_event": _format_datetime(
+                    self.last_scale_out_event
+                ),
+                "last_scale_in_event": _format_datetime(
+                    self.last_scale_in_event
+                ),
+                "last_desired_capacity": self.last_desired_capacity,
+                "last_action": self.last_action,
+                "demand_history": self.demand_history,
+                "last_event_trigger": _format_datetime(
+                    self.last_event_trigger
+                ),
+                "unhealthy_since": self.unhealthy_since,
+                "lease_token": self.lease_token,
+                "deferred_terminations": self.deferred_terminations,
+                "pools_unavailable_until": self.pools_unavailable_until,
+                "capacity_gap_since": _format_datetime(
+                    self.capacity_gap_since
+                ),
+            }
+        )
+
+    def merge(self, other: "AutoscalerState") -> "AutoscalerState":
+        """
+        Merges a state written concurrently by another invocation into this
+        one. The most recent timestamps win, the bookkeeping either of them
+        keeps by VM, runner or pool is combined: deferred terminations of
+        both, the earliest time something was first seen broken and the
+        latest time a pool is backed off until. Everything else is ours.
+        """
+        return AutoscalerState(
+            last_scale_out_event=_latest(
+                self.last_scale_out_event, other.last_scale_out_event
+            ),
+            last_scale_in_event=_latest(
+                self.last_scale_in_event, other.last_scale_in_event
+            ),
+            last_desired_capacity=self.last_desired_capacity,
+            last_action=self.last_action,
+            demand_history=self.demand_history,
+            last_event_trigger=_latest(
+                self.last_event_trigger, other.last_event_trigger
+            ),
+            unhealthy_since=_merge_timestamps(
+                self.unhealthy_since, other.unhealthy_since, min
+            ),
+            lease_token=max(self.lease_token or 0, other.lease_token or 0)
+            or None,
+            deferred_terminations=sorted(
+                set(self.deferred_terminations).union(
+                    other.deferred_terminations
+                )
+            ),
+            pools_unavailable_until=_merge_timestamps(
+                self.pools_unavailable_until,
+                other.pools_unavailable_until,
+                max,
+            ),
+            capacity_gap_since=_earliest(
+                self.capacity_gap_since, other.capacity_gap_since
+            ),
+        )
+
+
+def _parse_datetime(value: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if value else None
+
+
+def _format_datetime(value: Optional[datetime]) -> Optional[str]:
+    return value.isoformat() if value is not None else None
+
+
+def _latest(a: Optional[datetime], b: Optional[datetime]):
+    if a is None or b is None:
+        return a or b
+    return max(a, b)
+
+
+def _earliest(a: Optional[datetime], b: Optional[datetime]):
+    if a is None or b is None:
+        return a or b
+    return min(a, b)
+
+
+def _merge_timestamps(
+    a: Dict[str, str], b: Dict[str, str], pick: Callable
+) -> Dict[str, str]:
+    """ISO timestamps by key of both, pick of the two for keys in both"""
+    merged = dict(b)
+    for key, value in a.items():
+        if key in merged:
+            value = pick(value, merged[key], key=datetime.fromisoformat)
+        merged[key] = value
+    return merged
+
+
+class StateStore(ABC):
+    """
+    Keeps the autoscaler state as a single document in object storage.
+
+    The document is read at most once per tick. Across warm invocations the
+    last copy is kept in process and revalidated with its ETag, so an
+    unchanged document costs a 304 instead of a download. Writes are
+    conditional on the ETag that was read; when another invocation wrote in
+    between, its state is merged and the write retried.
+    """
+
+    MAX_WRITE_ATTEMPTS = 3
+
+    # (etag, content) by cache key, shared by all stores in the process
+    _cache: Dict[str, Tuple[str, str]] = {}
+    _cache_lock = threading.Lock()
+
+    def __init__(self, cache_key: str):
+        self.cache_key = cache_key
+        self._state: Optional[AutoscalerState] = None
+        self._etag: Optional[str] = None
+        self._dirty = False
+        # token of the lease this invocation holds, the document is never
+        # written over one written with a newer token
+        self.fencing_token: Optional[int] = None
+
+    @abstractmethod
+    def _read(
+        self, etag: Optional[str]
+    ) -> Tuple[Optional[str], Optional[str]]:
+        """
+        Read the document unless its ETag still matches etag. Returns
+        (content, etag), (None, etag) when not modified and (None, None)
+        when the document does not exist.
+        """
+
+    @abstractmethod
+    def _write(self, content: str, etag: Optional[str]) -> str:
+        """
+        Write the document if its ETag still matches etag, or only if it
+        does not exist yet when etag is None. Returns the new ETag and raises
+        StateConflictError when the condition does not hold.
+        """
+
+    def _read_legacy(self) -> Optional[AutoscalerState]:
+        """Seed state for when the document does not exist yet"""
+        return None
+
+    def _lease_store(self) -> Optional["StateStore"]:
+        """Where the lease is kept, override to support leases"""
+        return None
+
+    def create_lease(self, ttl: timedelta) -> Optional["Lease"]:
+        lease_store = self._lease_store()
+        if lease_store is None:
+            return None
+        return Lease(self, lease_store, ttl)
+
+    def invalidate(self):
+        """
+        Forget the state read during the previous tick. Changes not saved
+        yet are dropped, call it at the start of a tick only.
+        """
+        if self._dirty:
+            logging.warning(
+                f"STACKGUARDIAN: dropping unsaved changes to state {self.cache_key}"
+            )
+        self._state = None
+        self._etag = None
+        self._dirty = False
+
+    def get(self) -> AutoscalerState:
+        if self._state is None:
+            self._state, self._etag = self._load()
+        return self._state
+
+    def update(self, **changes):
+        """Change the state locally, it is written on the next save()"""
+        state = self.get()
+        for name, value in changes.items():
+            setattr(state, name, value)
+        self._dirty = True
+
+    def save(self, **changes):
+        if changes:
+            self.update(**changes)
+        if not self._dirty:
+            return
+
+        for attempt in range(self.MAX_WRITE_ATTEMPTS):
+            try:
+                self._write_state()
+            except StateConflictError:
+                logging.info(
+                    f"STACKGUARDIAN: state {self.cache_key} changed concurrently, merging"
+                )
+                theirs, self._etag = self._load(use_cache=False)
+                self._state = self._state.merge(theirs)
+                continue
+            return
+
+        raise StateConflictError(
+            f"Could not write state {self.cache_key} after {self.MAX_WRITE_ATTEMPTS} attempts"
+        )
+
+    def load_detached(self) -> Tuple[AutoscalerState, Optional[str]]:
+        """
+        Reads the document apart from the state of the tick, which a tick
+        running concurrently in the process may be changing. Returns the
+        state and its ETag for try_write_detached().
+        """
+        return self._load()
+
+    def try_write_detached(
+        self, state: AutoscalerState, etag: Optional[str]
+    ) -> bool:
+        """
+        Writes a state read with load_detached() only if nobody else wrote
+        the document since. Returns False instead of merging when someone
+        did, e.g. to claim something only one invocation may do.
+        """
+        content = state.to_json()
+        try:
+            with metrics.span("api_call", service="state", call="write"):
+                etag = self._write(content, etag)
+        except StateConflictError:
+            metrics.increment("state_conflicts")
+            logging.info(
+                f"STACKGUARDIAN: state {self.cache_key} changed concurrently"
+            )
+            return False
+        with self._cache_lock:
+            self._cache[self.cache_key] = (etag, content)
+        return True
+
+    def _write_state(self):
+        if self.fencing_token is not None:
+            if (self._state.lease_token or 0) > self.fencing_token:
+                raise LeaseLostError(
+                    f"State {self.cache_key} was written by a newer lease holder"
+                )
+            self._state.lease_token = self.fencing_token
+        content = self._state.to_json()
+        try:
+            with metrics.span("api_call", service="state", call="write"):
+                self._etag = self._write(content, self._etag)
+        except StateConflictError:
+            metrics.increment("state_conflicts")
+            raise
+
+        self._dirty = False
+        with self._cache_lock:
+            self._cache[self.cache_key] = (self._etag, content)
+
+    def _load(
+        self, use_cache: bool = True
+    ) -> Tuple[AutoscalerState, Optional[str]]:
+        with self._cache_lock:
+            cached = self._cache.get(self.cache_key) if use_cache else None
+        cached_etag, cached_content = cached if cached else (None, None)
+
+        with metrics.span("api_call", service="state", call="read"):
+            content, etag = self._read(cached_etag)
+        if content is None and etag is not None and etag == cached_etag:
+            metrics.increment("state_not_modified")
+            logging.info(f"STACKGUARDIAN: state {self.cache_key} not modified")
+            return AutoscalerState.from_json(cached_content), etag
+
+        if content is None:
+            with self._cache_lock:
+                self._cache.pop(self.cache_key, None)
+            state = self._read_legacy() or AutoscalerState()
+            return state, None
+
+        with self._cache_lock:
+            self._cache[self.cache_key] = (etag, content)
+        return AutoscalerState.from_json(content), etag
+
+
+class Lease:
+    """
+    Lets a single invocation at a time tick a runner group. The lease is a
+    small document next to the state document, taken and renewed with the
+    same conditional writes, and expires ttl after it was last renewed so
+    an invocation that died blocks the group no longer than that. It is
+    renewed in the background while held.
+
+    Every acquisition increments the fencing token. The state document is
+    written with the token and never over a newer one, so a holder that
+    lost its lease can no longer change the state.
+    """
+
+    def __init__(
+        self, state_store: StateStore, lease_store: StateStore, ttl: timedelta
+    ):
+        self.state_store = state_store
+        self.lease_store = lease_store
+        self.ttl = ttl
+        self.holder = uuid.uuid4().hex
+        self.token: Optional[int] = None
+        self.expires: Optional[datetime] = None
+        self._etag: Optional[str] = None
+        self._lost = False
+        self._lock = threading.Lock()
+        # held from acquire() to release(), invocations sharing this lease
+        # in one process, e.g. the timer and HTTP triggers of a function
+        # app, take turns like any other holder
+        self._held = threading.Lock()
+        self._stop_renewing: Optional[threading.Event] = None
+
+    @staticmethod
+    def _now() -> datetime:
+        return datetime.now(timezone.utc)
+
+    def acquire(self) -> bool:
+        """
+        Takes the lease unless someone else holds it, including another
+        invocation in this process
+        """
+        if not self._held.acquire(blocking=False):
+            logging.info(
+                f"STACKGUARDIAN: lease {self.lease_store.cache_key} is held by this process"
+            )
+            return False
+        try:
+            acquired = self._acquire()
+        except BaseException:
+            self._held.release()
+            raise
+        if not acquired:
+            self._held.release()
+        return acquired
+
+    def _acquire(self) -> bool:
+        with metrics.span("api_call", service="state", call="read_lease"):
+            content, etag = self.lease_store._read(None)
+        if content is None:
+            # tokens keep growing when the lease document is deleted
+            token = self.state_store.get().lease_token or 0
+        else:
+            document = json.loads(content)
+            expires = _parse_datetime(document["expires"])
+            if document["holder"] != self.holder and expires > self._now():
+                logging.info(
+                    f"STACKGUARDIAN: lease {self.lease_store.cache_key} is held until {expires.isoformat()}"
+                )
+                return False
+            token = document["token"]
+
+        with self._lock:
+            self.token = token + 1
+            try:
+                self._write(etag)
+            except StateConflictError:
+                logging.info(
+                    f"STACKGUARDIAN: lease {self.lease_store.cache_key} was taken concurrently"
+                )
+                self.token = None
+                return False
+            self._lost = False
+        self.state_store.fencing_token = self.token
+        logging.info(f"STACKGUARDIAN: acquired lease with token {self.token}")
+        self._start_renewing()
+        return True
+
+    def _write(self, etag: Optional[str], expires: Optional[datetime] = None):
+        # taken before writing, so the holder never assumes it holds the
+        # lease for longer than the others do
+        expires = expires or self._now() + self.ttl
+        content = json.dumps(
+            {
+                "holder": self.holder,
+                "token": self.token,
+                "expires": expires.isoformat(),
+            }
+        )
+        with metrics.span("api_call", service="state", call="write_lease"):
+            self._etag = self.lease_store._write(content, etag)
+        self.expires = expires
+
+    def renew(self):
+        with self._lock:
+            if self.token is None or self._lost:
+                return
+            try:
+                self._write(self._etag)
+            except StateConflictError:
+                logging.warning(
+                    f"STACKGUARDIAN: lease {self.lease_store.cache_key} was taken over"
+                )
+                self._lost = True
+            except Exception as e:
+                # retried on the next renewal, fence() fails once it expired
+                logging.warning(
+                    f"STACKGUARDIAN: renewing the lease failed: {e}"
+                )
+
+    def fence(self):
+        """Raises LeaseLostError unless the lease is still held"""
+        with self._lock:
+            if (
+                self._lost
+                or self.expires is None
+                or (self._now() >= self.expires)
+            ):
+                raise LeaseLostError(
+                    f"Lease {self.lease_store.cache_key} is no longer held"
+                )
+
+    def release(self):
+        """Lets the next invocation take the lease right away"""
+        if self._stop_renewing is not None:
+            self._stop_renewing.set()
+            self._stop_renewing = None
+        with self._lock:
+            if self.token is None:
+                return
+            if not self._lost:
+                try:
+                    # expired rather than deleted, the token keeps growing
+                    self._write(self._etag, expires=self._now())
+                except Exception as e:
+                    logging.warning(
+                        f"STACKGUARDIAN: releasing the lease failed: {e}"
+                    )
+            self.token = None
+            self.expires = None
+        self.state_store.fencing_token = None
+        self._held.release()
+
+    def _start_renewing(self):
+        if self._stop_renewing is not None:
+            self._stop_renewing.set()
+        stop = threading.Event()
+        self._stop_renewing = stop
+        interval = self.ttl.total_seconds() / 3
+
+        def renew_until_released():
+            while not stop.wait(interval):
+                self.renew()
+
+        threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(renew_until_released,),
+            name="lease-renewal",
+            daemon=True,
+        ).start()
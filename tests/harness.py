@@ -0,0 +1,102 @@
+"""
+A runner group scaled by the real autoscaler against the simulator fakes,
+ticked by hand instead of by the simulation's event loop.
+"""
+
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Callable, List, Optional
+
+from simulator.engine import SIMULATION_DEFAULTS
+from simulator.fakes import (
+    FakeRunner,
+    FakeRunnerGroup,
+    FakeScaleGroup,
+    Job,
+    MemoryStateStore,
+    SimClock,
+)
+from stackguardian_autoscaler import StackGuardianAutoscaler
+
+START = datetime(2026, 1, 5, 8, 0, tzinfo=timezone.utc)
+
+
+class LeasedStateStore(MemoryStateStore):
+    """MemoryStateStore with its lease in a second in-memory document"""
+
+    def __init__(self, calls: Counter):
+        super().__init__(calls)
+        self.lease_document = MemoryStateStore(calls)
+
+    def _lease_store(self) -> MemoryStateStore:
+        return self.lease_document
+
+
+class Group:
+    """A scale group and runner group with a runner on each VM"""
+
+    def __init__(self, vms: int = 0, lease: bool = False, **settings):
+        self.clock = SimClock(START)
+        self.scale_group = FakeScaleGroup(self.clock, timedelta(minutes=3))
+        if lease:
+            self.scale_group.state_store = LeasedStateStore(
+                self.scale_group.calls
+            )
+            settings.setdefault("LEASE_TTL_SECONDS", 60)
+        self.runner_group = FakeRunnerGroup(self.clock)
+        for _ in range(vms):
+            self.add_vm(register=True)
+        # no scale in, so only what a test is about removes anything
+        settings.setdefault("MIN_RUNNERS", vms)
+        self.settings = {
+            **SIMULATION_DEFAULTS,
+            **{name: str(value) for name, value in settings.items()},
+        }
+        self.slept: List[float] = []
+        # run while the autoscaler sleeps, e.g. other invocations during a
+        # coalesce window
+        self.during_sleep: List[Callable[[], None]] = []
+        self.autoscaler = self.invocation()
+
+    def invocation(self) -> StackGuardianAutoscaler:
+        """Another autoscaler on the group, like a concurrent invocation"""
+        return StackGuardianAutoscaler(
+            self.scale_group,
+            sg_client=self.runner_group,
+            settings=self.settings,
+            clock=self.clock.now,
+            sleep=self.sleep,
+        )
+
+    def sleep(self, seconds: float):
+        self.slept.append(seconds)
+        callbacks, self.during_sleep = self.during_sleep, []
+        for callback in callbacks:
+            callback()
+        self.clock.advance_to(self.clock.now() + timedelta(seconds=seconds))
+
+    def add_vm(self, register: bool) -> str:
+        vm = self.scale_group.launch(ready=True)
+        self.scale_group.desired_capacity += 1
+        if register:
+            self.runner_group.register(vm.name)
+        return vm.name
+
+    def enqueue(self, jobs: int):
+        for _ in range(jobs):
+            self.runner_group.enqueue(
+                Job(self.clock.now(), timedelta(minutes=10))
+            )
+
+    def at(self, minutes: float):
+        self.clock.advance_to(START + timedelta(minutes=minutes))
+
+    def tick_at(self, minutes: float):
+        self.at(minutes)
+        self.autoscaler.start()
+
+    def runner_on(self, vm_name: str) -> Optional[FakeRunner]:
+        for runner in self.runner_group.runners.values():
+            if runner.computer_name == vm_name:
+                return runner
+        return None
@@ -0,0 +1,284 @@
+from collections import Counter
+
+import pytest
+
+import aws_service
+import rate_limit
+from aws_service import AwsService
+from simulator.fakes import MemoryStateStore
+from stackguardian_autoscaler import SGRunner
+
+
+class Paginator:
+    def __init__(self, client: "FakeAws", operation: str):
+        self.client = client
+        self.operation = operation
+
+    def paginate(self, **kwargs):
+        yield getattr(self.client, self.operation)(**kwargs)
+
+
+class FakeAws:
+    """The Auto Scaling and EC2 calls of AwsService against one ASG"""
+
+    def __init__(self):
+        self.desired_capacity = 0
+        # protected from scale in by instance id
+        self.instances = {}
+        # InService unless set
+        self.lifecycle_states = {}
+        self.calls = Counter()
+        self.protection_batches = []
+
+    def launch(self, protected: bool = False) -> str:
+        instance_id = f"i-{len(self.instances) + 1}"
+        self.instances[instance_id] = protected
+        self.desired_capacity += 1
+        return instance_id
+
+    def get_paginator(self, operation: str) -> Paginator:
+        return Paginator(self, operation)
+
+    def describe_auto_scaling_groups(self, **kwargs) -> dict:
+        self.calls["describe_auto_scaling_groups"] += 1
+        instances = [
+            {
+                "InstanceId": instance_id,
+                "LifecycleState": self.lifecycle_states.get(
+                    instance_id, "InService"
+                ),
+                "ProtectedFromScaleIn": protected,
+            }
+            for instance_id, protected in self.instances.items()
+        ]
+        return {
+            "AutoScalingGroups": [
+                {
+                    "DesiredCapacity": self.desired_capacity,
+                    "Instances": instances,
+                }
+            ]
+        }
+
+    def describe_instances(self, **kwargs) -> dict:
+        self.calls["describe_instances"] += 1
+        instances = [
+            {
+                "InstanceId": instance_id,
+                "PrivateDnsName": f"{instance_id}.internal",
+                "PrivateIpAddress": f"10.0.0.{instance_id[2:]}",
+            }
+            for instance_id in self.instances
+        ]
+        return {"Reservations": [{"Instances": instances}]}
+
+    def set_desired_capacity(self, DesiredCapacity, **kwargs) -> dict:
+        self.calls["set_desired_capacity"] += 1
+        self.desired_capacity = DesiredCapacity
+        return {}
+
+    def set_instance_protection(
+        self, InstanceIds, ProtectedFromScaleIn, **kwargs
+    ) -> dict:
+        self.protection_batches.append(list(InstanceIds))
+        for instance_id in InstanceIds:
+            self.instances[instance_id] = ProtectedFromScaleIn
+        return {}
+
+    def terminate_instance_in_auto_scaling_group(
+        self, InstanceId, **kwargs
+    ) -> dict:
+        self.calls["terminate"] += 1
+        del self.instances[InstanceId]
+        self.desired_capacity -= 1
+        return {}
+
+    def describe_scaling_activities(self, **kwargs) -> dict:
+        return {"Activities": []}
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    fake = FakeAws()
+    # fresh buckets, without waiting for the ASG's rate limit
+    monkeypatch.setattr(rate_limit, "_buckets", {})
+    monkeypatch.setenv("RATE_LIMIT_ASG", "1000")
+    monkeypatch.setitem(aws_service._clients, "autoscaling", fake)
+    monkeypatch.setitem(aws_service._clients, "ec2", fake)
+    return fake
+
+
+def service(**settings) -> AwsService:
+    service = AwsService({"AWS_ASG_NAME": "runners", **settings})
+    service.state_store = MemoryStateStore(Counter())
+    return service
+
+
+def runner(instance_id: str) -> SGRunner:
+    return SGRunner(
+        {"instanceDetails": [{"ComputerName": f"{instance_id}.internal"}]}
+    )
+
+
+def test_inventory_is_read_every_tick_by_default(aws):
+    aws.launch()
+    cloud_service = service()
+    for _ in range(3):
+        cloud_service.refresh()
+        assert cloud_service.count_of_existing_vms() == 1
+    assert aws.calls["describe_auto_scaling_groups"] == 3
+
+
+def test_inventory_is_reused_within_its_ttl(aws):
+    aws.launch()
+    cloud_service = service(INVENTORY_TTL_SECONDS="60")
+    for _ in range(3):
+        cloud_service.refresh()
+        assert cloud_service._find_aws_vm(runner("i-1")) is not None
+    assert aws.calls["describe_auto_scaling_groups"] == 1
+    assert aws.calls["describe_instances"] == 1
+
+
+def test_inventory_expires_after_its_ttl(aws):
+    cloud_service = service(INVENTORY_TTL_SECONDS="30")
+    cloud_service.refresh()
+    cloud_service.count_of_existing_vms()
+
+    cloud_service._asg_vms_read_at -= 30
+    cloud_service.refresh()
+    cloud_service.count_of_existing_vms()
+    assert aws.calls["describe_auto_scaling_groups"] == 2
+
+
+def test_changing_the_capacity_expires_the_inventory(aws):
+    cloud_service = service(INVENTORY_TTL_SECONDS="60")
+    cloud_service.refresh()
+    cloud_service.count_of_existing_vms()
+    cloud_service.set_autoscale_vms(1)
+    aws.launch()
+    aws.desired_capacity = 1
+
+    cloud_service.refresh()
+    assert cloud_service._find_aws_vm(runner("i-1")) is not None
+    assert aws.calls["describe_auto_scaling_groups"] == 2
+
+
+def test_runner_of_a_new_instance_reads_the_inventory_again(aws):
+    cloud_service = service(INVENTORY_TTL_SECONDS="60")
+    cloud_service.refresh()
+    cloud_service.count_of_existing_vms()
+    # launched by the ASG itself, e.g. replacing an unhealthy instance
+    aws.launch()
+
+    cloud_service.refresh()
+    assert cloud_service._find_aws_vm(runner("i-1")) is not None
+    assert cloud_service._find_aws_vm(runner("i-1")) is not None
+    assert aws.calls["describe_auto_scaling_groups"] == 2
+
+
+def test_capacity_saved_by_another_invocation_expires_the_inventory(aws):
+    cloud_service = service(INVENTORY_TTL_SECONDS="60")
+    cloud_service.refresh()
+    cloud_service.count_of_existing_vms()
+    aws.desired_capacity = 2
+    cloud_service.state_store.save(last_desired_capacity=2)
+
+    cloud_service.refresh()
+    assert cloud_service.count_of_existing_vms() == 2
+
+
+def test_protection_is_set_in_batches_of_50(aws):
+    instance_ids = [aws.launch() for _ in range(120)]
+    cloud_service = service()
+    cloud_service.refresh()
+
+    runners = [runner(instance_id) for instance_id in instance_ids]
+    cloud_service.add_scale_in_protection_bulk(runners)
+
+    assert [len(batch) for batch in aws.protection_batches] == [50, 50, 20]
+    assert all(aws.instances.values())
+
+
+def test_protection_skips_instances_already_in_the_wanted_state(aws):
+    protected = [aws.launch(protected=True) for _ in range(3)]
+    unprotected = [aws.launch() for _ in range(2)]
+    cloud_service = service()
+    cloud_service.refresh()
+    runners = [runner(instance_id) for instance_id in protected + unprotected]
+
+    cloud_service.add_scale_in_protection_bulk(runners)
+    assert aws.protection_batches == [unprotected]
+
+    # the copy of the tick is up to date, nothing is left to change
+    cloud_service.add_scale_in_protection_bulk(runners)
+    assert len(aws.protection_batches) == 1
+
+
+def test_runner_is_matched_by_dns_name_or_ip_address(aws):
+    aws.launch()
+    cloud_service = service()
+    cloud_service.refresh()
+
+    by_ip = SGRunner(
+        {
+            "instanceDetails": [
+                {"ComputerName": "ip-10", "IPAddress": "10.0.0.1"}
+            ]
+        }
+    )
+    assert cloud_service._find_aws_vm(by_ip)["InstanceId"] == "i-1"
+    assert cloud_service._find_aws_vm(runner("i-1"))["InstanceId"] == "i-1"
+    assert cloud_service._find_aws_vm(runner("i-2")) is None
+
+
+def test_terminated_runner_vms_leave_the_inventory(aws):
+    for _ in range(3):
+        aws.launch()
+    cloud_service = service()
+    cloud_service.refresh()
+    runners = [runner("i-1"), runner("i-2"), runner("i-9")]
+
+    assert cloud_service.terminate_runner_vms(runners) == 2
+
+    assert set(aws.instances) == {"i-3"}
+    assert [vm["InstanceId"] for vm in cloud_service.asg_vms] == ["i-3"]
+    assert cloud_service.asg_protection == {"i-3": False}
+    assert cloud_service._find_aws_vm(runner("i-1")) is None
+    assert cloud_service.count_of_existing_vms() == 1
+    assert cloud_service.state_store.get().last_desired_capacity == 1
+    # nothing terminated is reported as an orphan later in the tick
+    join = cloud_service.join_inventory([runner("i-3")])
+    assert join.orphan_vms == []
+    assert aws.calls["describe_auto_scaling_groups"] == 1
+
+
+def test_inventory_is_read_once_per_tick(aws):
+    for _ in range(3):
+        aws.launch()
+    # on its way out, not counted or matched
+    aws.lifecycle_states["i-3"] = "Terminating"
+    aws.desired_capacity = 2
+    cloud_service = service()
+    cloud_service.refresh()
+
+    assert cloud_service._find_aws_vm(runner("i-1")) is not None
+    assert cloud_service._find_aws_vm(runner("i-3")) is None
+    join = cloud_service.join_inventory([runner("i-1")])
+    assert join.orphan_vms == ["i-2"]
+    assert cloud_service.count_of_existing_vms() == 2
+    assert cloud_service.count_of_unfulfilled_vms() == 0
+    assert aws.calls["describe_auto_scaling_groups"] == 1
+    assert aws.calls["describe_instances"] == 1
+
+
+def test_search_projects_every_page():
+    class Pages:
+        def get_paginator(self, operation):
+            return self
+
+        def paginate(self, **kwargs):
+            yield {"Items": [{"Id": 1, "Unused": "x"}]}
+            yield {"Items": [{"Id": 2}], "ResponseMetadata": {}}
+            yield {}
+
+    assert aws_service._search("ec2", Pages(), "list", "Items[].Id") == [1, 2]
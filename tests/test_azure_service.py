@@ -0,0 +1,272 @@
+import logging
+from collections import Counter
+from types import SimpleNamespace
+
+import pytest
+
+import azure_service
+import rate_limit
+from azure_service import AzureService, VmssVm
+from simulator.engine import SIMULATION_DEFAULTS
+from simulator.fakes import FakeRunnerGroup, MemoryStateStore, SimClock
+from stackguardian_autoscaler import SGRunner, StackGuardianAutoscaler
+from tests.harness import START
+
+
+def service(*computer_names: str, **settings) -> AzureService:
+    """A service whose VM's of this tick are already listed"""
+    service = AzureService({"AZURE_VMSS_NAME": "runners", **settings})
+    service.state_store = MemoryStateStore(Counter())
+    service.vmss_vms = [
+        VmssVm(str(index), f"runners_{index}", name, "westeurope", False)
+        for index, name in enumerate(computer_names)
+    ]
+    service.vmss_vm_index = {vm.computer_name: vm for vm in service.vmss_vms}
+    service._vmss_vms_loaded = True
+    return service
+
+
+def runner(computer_name: str) -> SGRunner:
+    return SGRunner({"instanceDetails": [{"ComputerName": computer_name}]})
+
+
+@pytest.mark.parametrize(
+    "computer_name, vm_name",
+    [
+        ("runner1", "runner1"),
+        # registered with the FQDN
+        ("runner1.internal.cloudapp.net", "runner1"),
+        # the longest prefix, not the first one
+        ("runner12.internal.cloudapp.net", "runner12"),
+        ("runner2", None),
+        ("", None),
+        (None, None),
+    ],
+)
+def test_runner_is_matched_to_the_longest_computer_name(
+    computer_name, vm_name
+):
+    cloud_service = service("runner1", "runner12")
+    vm = cloud_service._find_azure_vm(runner(computer_name))
+    assert (vm and vm.computer_name) == vm_name
+
+
+class Poller:
+    """A long running operation that is done once finished by the test"""
+
+    def __init__(self, result=None):
+        self._result = result
+        self._done = False
+        self.error = None
+
+    def done(self) -> bool:
+        return self._done
+
+    def finish(self, error: Exception = None):
+        self._done = True
+        self.error = error
+
+    def result(self):
+        self._done = True
+        if self.error is not None:
+            raise self.error
+        return self._result
+
+
+class FakeScaleSet:
+    """
+    The scale set and VM calls of AzureService. Changes apply at once, the
+    operations are done when finished by the test.
+    """
+
+    def __init__(self, vms: int = 0):
+        self.capacity = 0
+        # VM models by instance id
+        self.vms = {}
+        self.calls = []
+        self.pollers = []
+        for _ in range(vms):
+            self.create_vm()
+        self.virtual_machine_scale_sets = SimpleNamespace(
+            get=self.get,
+            begin_update=self.update,
+            begin_delete_instances=self.delete_instances,
+        )
+        self.virtual_machine_scale_set_vms = SimpleNamespace(
+            list=self.list_vms, begin_update=self.update_vm
+        )
+
+    def create_vm(self) -> str:
+        instance_id = str(len(self.vms))
+        self.vms[instance_id] = SimpleNamespace(
+            instance_id=instance_id,
+            name=f"runners_{instance_id}",
+            os_profile=SimpleNamespace(computer_name=f"runner{instance_id}"),
+            location="westeurope",
+            protection_policy=None,
+            instance_view=None,
+        )
+        self.capacity += 1
+        return instance_id
+
+    def _started(self, call: str, result=None) -> Poller:
+        self.calls.append(call)
+        poller = Poller(result)
+        self.pollers.append(poller)
+        return poller
+
+    def get(self, resource_group, name):
+        self.calls.append("get")
+        return SimpleNamespace(
+            sku=SimpleNamespace(
+                name="Standard_D2s_v5", tier="Standard", capacity=self.capacity
+            )
+        )
+
+    def update(self, resource_group, name, parameters) -> Poller:
+        self.capacity = parameters.sku.capacity
+        return self._started("update", self.get(resource_group, name))
+
+    def delete_instances(self, resource_group, name, instance_ids) -> Poller:
+        for instance_id in instance_ids.instance_ids:
+            del self.vms[instance_id]
+        self.capacity -= len(instance_ids.instance_ids)
+        return self._started("delete_instances")
+
+    def list_vms(self, resource_group, name, expand=None):
+        self.calls.append("list_vms")
+        self.expand = expand
+        return list(self.vms.values())
+
+    def update_vm(self, resource_group, name, instance_id, parameters):
+        self.vms[instance_id].protection_policy = parameters.protection_policy
+        return self._started("update_vm")
+
+
+@pytest.fixture
+def scale_set(monkeypatch):
+    fake = FakeScaleSet(3)
+    # fresh buckets, without waiting for the scale set's rate limit
+    monkeypatch.setattr(rate_limit, "_buckets", {})
+    monkeypatch.setenv("RATE_LIMIT_VMSS", "1000")
+    monkeypatch.setattr(
+        azure_service, "get_compute_client", lambda *args: fake
+    )
+    return fake
+
+
+def listed(**settings) -> AzureService:
+    """A service that lists the VM's of the fake scale set"""
+    service = AzureService({"AZURE_VMSS_NAME": "runners", **settings})
+    service.state_store = MemoryStateStore(Counter())
+    service.refresh()
+    return service
+
+
+def test_protection_updates_are_not_waited_for(scale_set, caplog):
+    cloud_service = listed()
+    runners = [runner(f"runner{index}") for index in range(3)]
+
+    cloud_service.add_scale_in_protection_bulk(runners)
+
+    assert scale_set.calls.count("update_vm") == 3
+    assert all(vm.protected for vm in cloud_service.vmss_vms)
+    assert len(cloud_service.pending_operations) == 3
+    # already in the wanted state, nothing is started again
+    cloud_service.add_scale_in_protection_bulk(runners)
+    assert scale_set.calls.count("update_vm") == 3
+
+    first, second, _ = scale_set.pollers
+    first.finish()
+    second.finish(azure_service.AzureError("conflict"))
+    with caplog.at_level(logging.INFO):
+        cloud_service.refresh()
+    # the one still running is checked again in the next tick
+    assert len(cloud_service.pending_operations) == 1
+    assert "failed: scale in protection True for runners_1" in caplog.text
+
+
+def test_capacity_update_is_waited_for_before_deleting(scale_set):
+    cloud_service = listed()
+    cloud_service.set_autoscale_vms(5)
+    assert cloud_service.count_of_existing_vms() == 5
+    [update] = scale_set.pollers
+    assert not update.done()
+
+    assert cloud_service.terminate_runner_vms([runner("runner0")]) == 1
+
+    # its result was taken, two updates of the scale set conflict
+    assert update.done()
+    assert "0" not in scale_set.vms
+    # the deletion lowers the capacity without waiting for it
+    assert cloud_service.count_of_existing_vms() == 4
+    assert cloud_service._find_azure_vm(runner("runner0")) is None
+    assert len(cloud_service.pending_operations) == 1
+
+
+def test_inventory_is_reused_within_its_ttl(scale_set):
+    cloud_service = listed(INVENTORY_TTL_SECONDS="60")
+    for _ in range(3):
+        cloud_service.refresh()
+        assert cloud_service.count_of_existing_vms() == 3
+        assert cloud_service._find_azure_vm(runner("runner0")) is not None
+    assert scale_set.calls == ["get", "list_vms"]
+
+
+def test_operations_of_the_last_tick_expire_the_inventory(scale_set):
+    cloud_service = listed(INVENTORY_TTL_SECONDS="60")
+    cloud_service.add_scale_in_protection(runner("runner0"))
+    scale_set.pollers[0].finish()
+
+    cloud_service.refresh()
+    cloud_service._find_azure_vm(runner("runner0"))
+    assert scale_set.calls.count("list_vms") == 2
+
+
+def test_waited_capacity_update_expires_the_inventory(scale_set):
+    cloud_service = listed(INVENTORY_TTL_SECONDS="60")
+    cloud_service._find_azure_vm(runner("runner0"))
+    cloud_service.set_autoscale_vms(4)
+    scale_set.create_vm()
+    # taken within the tick, nothing is left pending
+    scale_set.pollers[0].finish()
+    cloud_service.count_of_existing_vms()
+    cloud_service.flush_state()
+
+    cloud_service.refresh()
+    # the new VM is listed even before its runner registers
+    runners = [runner(f"runner{index}") for index in range(3)]
+    assert cloud_service.join_inventory(runners).orphan_vms == ["3"]
+
+
+def test_runner_of_a_new_vm_lists_the_vms_again(scale_set):
+    cloud_service = listed(INVENTORY_TTL_SECONDS="60")
+    cloud_service._find_azure_vm(runner("runner0"))
+    # e.g. a VM the scale set created to repair itself
+    scale_set.create_vm()
+
+    cloud_service.refresh()
+    assert cloud_service._find_azure_vm(runner("runner3")) is not None
+    assert scale_set.calls.count("list_vms") == 2
+
+
+@pytest.mark.parametrize(
+    "standby_pool_max, expand", [("0", None), ("2", "instanceView")]
+)
+def test_standby_pool_follows_the_autoscaler(
+    scale_set, monkeypatch, standby_pool_max, expand
+):
+    # the environment of the service says otherwise
+    monkeypatch.setenv(
+        "STANDBY_POOL_MAX", "5" if standby_pool_max == "0" else "0"
+    )
+    cloud_service = listed()
+    StackGuardianAutoscaler(
+        cloud_service,
+        sg_client=FakeRunnerGroup(SimClock(START)),
+        settings={**SIMULATION_DEFAULTS, "STANDBY_POOL_MAX": standby_pool_max},
+    )
+
+    assert cloud_service.STANDBY_ENABLED == (standby_pool_max != "0")
+    cloud_service._find_azure_vm(runner("runner0"))
+    assert scale_set.expand == expand
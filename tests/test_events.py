@@ -0,0 +1,162 @@
+import importlib
+
+import pytest
+
+from multi_group import GroupResult
+from state_store import AutoscalerState
+from tests.harness import Group
+
+lambda_module = importlib.import_module("lambda")
+
+
+def test_notification_waits_out_the_window_then_scales_out():
+    group = Group(EVENT_COALESCE_SECONDS=10)
+    group.enqueue(3)
+
+    assert group.autoscaler.scale_out_on_demand() == "scaled_out"
+    assert group.slept == [10]
+    assert group.scale_group.desired_capacity == 1
+
+
+def test_notification_within_the_window_is_coalesced():
+    group = Group(EVENT_COALESCE_SECONDS=10)
+    group.enqueue(3)
+    outcomes = []
+
+    def notify():
+        group.scale_group.calls.clear()
+        group.runner_group.calls.clear()
+        outcomes.append(group.invocation().scale_out_on_demand())
+        # a single state read, neither the queue nor the VM's are read
+        assert group.scale_group.calls == {"state_read": 1}
+        assert group.runner_group.calls == {}
+
+    group.during_sleep.append(notify)
+    assert group.autoscaler.scale_out_on_demand() == "scaled_out"
+    assert outcomes == ["coalesced"]
+    assert group.slept == [10]
+
+
+def test_notification_after_the_window_claims_a_new_one():
+    group = Group(EVENT_COALESCE_SECONDS=10)
+    group.autoscaler.scale_out_on_demand()
+
+    group.at(1)
+    assert group.invocation().scale_out_on_demand() == "no_change"
+    assert group.slept == [10, 10]
+
+
+def test_periodic_tick_runs_during_the_window():
+    # the window is waited out before the lease is taken
+    group = Group(lease=True, EVENT_COALESCE_SECONDS=10)
+    group.enqueue(3)
+    periodic = group.invocation()
+    group.during_sleep.append(periodic.start)
+
+    assert group.autoscaler.scale_out_on_demand() == "no_change"
+    counters = periodic.last_tick_metrics.as_dict()["counters"]
+    assert "ticks_skipped{reason=lease}" not in counters
+    # the periodic tick scaled out for the queue, its cooldown applies
+    assert group.scale_group.desired_capacity == 1
+
+
+def test_notification_is_busy_while_a_tick_holds_the_lease():
+    group = Group(lease=True, EVENT_COALESCE_SECONDS=10)
+    group.enqueue(3)
+    periodic = group.invocation()
+    group.during_sleep.append(periodic.lease.acquire)
+
+    assert group.autoscaler.scale_out_on_demand() == "busy"
+    assert group.scale_group.desired_capacity == 0
+    periodic.lease.release()
+
+
+def test_concurrent_claims_of_the_window():
+    group = Group(EVENT_COALESCE_SECONDS=10)
+    state_store = group.scale_group.state_store
+    try_write_detached = state_store.try_write_detached
+
+    def claimed_concurrently(state, etag):
+        # another notification wins the conditional write
+        state_store.try_write_detached = try_write_detached
+        other, other_etag = state_store.load_detached()
+        other.last_event_trigger = group.clock.now()
+        assert try_write_detached(other, other_etag)
+        return try_write_detached(state, etag)
+
+    state_store.try_write_detached = claimed_concurrently
+    assert not group.autoscaler._claim_coalesce_window()
+
+
+def test_claim_leaves_the_tick_state_alone():
+    group = Group(EVENT_COALESCE_SECONDS=10)
+    state_store = group.scale_group.state_store
+    # a periodic tick in the process has unsaved changes
+    state_store.update(last_desired_capacity=4)
+
+    assert group.autoscaler._claim_coalesce_window()
+
+    assert state_store.get().last_desired_capacity == 4
+    state_store.save()
+    saved = AutoscalerState.from_json(state_store.content)
+    assert saved.last_desired_capacity == 4
+    assert saved.last_event_trigger == group.clock.now()
+
+
+@pytest.fixture
+def webhook(monkeypatch):
+    group = Group(EVENT_COALESCE_SECONDS=0)
+    monkeypatch.delenv("AUTOSCALER_CONFIG", raising=False)
+    monkeypatch.setattr(
+        lambda_module, "_get_autoscaler", lambda: group.autoscaler
+    )
+    return lambda_module.webhook_handler
+
+
+def test_webhook_is_refused_without_a_configured_token(webhook, monkeypatch):
+    monkeypatch.delenv("WEBHOOK_TOKEN", raising=False)
+    assert webhook({"headers": {}}, None)["statusCode"] == 401
+
+
+@pytest.mark.parametrize(
+    "headers, status_code",
+    [
+        ({}, 401),
+        ({"authorization": "Bearer wrong"}, 401),
+        ({"Authorization": "Bearer secret"}, 200),
+        ({"authorization": "Bearer secret"}, 200),
+    ],
+)
+def test_webhook_checks_the_token(webhook, monkeypatch, headers, status_code):
+    monkeypatch.setenv("WEBHOOK_TOKEN", "secret")
+    assert webhook({"headers": headers}, None)["statusCode"] == status_code
+
+
+def test_sqs_messages_need_no_token(webhook, monkeypatch):
+    monkeypatch.delenv("WEBHOOK_TOKEN", raising=False)
+    assert webhook({"Records": [{"body": "{}"}]}, None)["statusCode"] == 200
+
+
+@pytest.mark.parametrize(
+    "status, status_code",
+    [("success", 200), ("skipped", 200), ("failed", 500), ("timeout", 500)],
+)
+def test_multi_group_webhook_fails_for_failed_groups(
+    monkeypatch, status, status_code
+):
+    results = [
+        GroupResult("acme/linux", "success"),
+        GroupResult("acme/windows", status),
+    ]
+
+    class Autoscaler:
+        def scale_out_on_demand(self):
+            return results
+
+    monkeypatch.setenv("AUTOSCALER_CONFIG", "groups.json")
+    monkeypatch.setattr(
+        lambda_module, "_get_multi_group_autoscaler", lambda: Autoscaler()
+    )
+    event = {"Records": [{"body": "{}"}]}
+    response = lambda_module.webhook_handler(event, None)
+    assert response["statusCode"] == status_code
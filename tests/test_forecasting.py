@@ -0,0 +1,84 @@
+from datetime import timedelta
+
+import pytest
+
+from forecasting import (
+    DemandSample,
+    EwmaForecaster,
+    HoltForecaster,
+    create_forecaster,
+)
+from tests.harness import START
+
+HORIZON = timedelta(minutes=5)
+
+
+def history(*queued_jobs: int, every=timedelta(minutes=1)):
+    return [
+        DemandSample(START + index * every, jobs, 0, 1)
+        for index, jobs in enumerate(queued_jobs)
+    ]
+
+
+def test_sample_round_trip():
+    sample = DemandSample(START, 3, 2, 1)
+    copy = DemandSample.from_list(sample.to_list())
+    assert copy.to_list() == sample.to_list()
+    assert copy.timestamp == START
+
+
+def test_ewma_needs_a_sample():
+    assert EwmaForecaster().forecast([], HORIZON) is None
+
+
+def test_ewma_averages_and_projects_flat():
+    forecaster = EwmaForecaster(alpha=0.5)
+    assert forecaster.forecast(history(0, 4), HORIZON) == 2
+    assert forecaster.forecast(history(0, 4), 10 * HORIZON) == 2
+    assert forecaster.forecast(history(3, 3, 3), HORIZON) == 3
+
+
+def test_holt_needs_two_samples():
+    assert HoltForecaster().forecast(history(5), HORIZON) is None
+
+
+def test_holt_extrapolates_the_trend_per_minute():
+    # without smoothing, the level is the last sample and the trend its
+    # slope
+    forecaster = HoltForecaster(alpha=1, beta=1)
+    assert forecaster.forecast(history(0, 2, 4), HORIZON) == 14
+    # the same slope over samples two minutes apart
+    slower = history(0, 4, 8, every=timedelta(minutes=2))
+    assert forecaster.forecast(slower, HORIZON) == 18
+
+
+def test_holt_follows_a_growing_queue():
+    forecast = HoltForecaster().forecast(history(0, 1, 2, 3, 4, 5), HORIZON)
+    assert forecast > 5
+
+
+def test_holt_does_not_forecast_below_zero():
+    forecaster = HoltForecaster(alpha=1, beta=1)
+    assert forecaster.forecast(history(10, 5, 0), HORIZON) == 0
+
+
+def test_holt_samples_close_together_only_update_the_level():
+    forecaster = HoltForecaster(alpha=1, beta=1)
+    samples = history(0, 6)
+    samples.append(
+        DemandSample(samples[-1].timestamp + timedelta(seconds=5), 100, 0, 1)
+    )
+    assert forecaster.forecast(samples, timedelta(minutes=1)) == 106
+
+
+@pytest.mark.parametrize(
+    "name, forecaster",
+    [(None, type(None)), ("ewma", EwmaForecaster), ("holt", HoltForecaster)],
+)
+def test_create_forecaster(name, forecaster):
+    assert isinstance(create_forecaster(name), forecaster)
+
+
+def test_unknown_forecaster():
+    with pytest.raises(ValueError):
+        create_forecaster("arima")
@@ -0,0 +1,103 @@
+import pytest
+
+from tests.harness import Group
+
+
+def test_disconnected_runner_is_removed_after_its_grace():
+    group = Group(3, DISCONNECTED_GRACE_MINUTES="10")
+    vm_name = next(iter(group.scale_group.vms))
+    group.runner_on(vm_name).connected = False
+
+    for minutes in (0, 5, 9):
+        group.tick_at(minutes)
+        assert group.runner_on(vm_name).status == "ACTIVE"
+        assert vm_name in group.scale_group.vms
+
+    group.tick_at(10)
+    assert group.runner_on(vm_name) is None
+    assert vm_name not in group.scale_group.vms
+    assert group.runner_group.calls["deregister_runner"] == 1
+
+
+def test_reconnected_runner_starts_its_grace_over():
+    group = Group(3, DISCONNECTED_GRACE_MINUTES="10")
+    vm_name = next(iter(group.scale_group.vms))
+    runner = group.runner_on(vm_name)
+
+    runner.connected = False
+    group.tick_at(0)
+    runner.connected = True
+    group.tick_at(5)
+    runner.connected = False
+    group.tick_at(10)
+
+    assert group.runner_on(vm_name) is runner
+    assert vm_name in group.scale_group.vms
+
+
+def test_unmatched_vm_is_terminated_after_its_grace():
+    group = Group(3, ORPHAN_GRACE_MINUTES="15")
+    orphan = group.add_vm(register=False)
+
+    for minutes in (0, 5, 10, 14):
+        group.tick_at(minutes)
+        assert orphan in group.scale_group.vms
+
+    group.tick_at(15)
+    assert orphan not in group.scale_group.vms
+    assert len(group.runner_group.runners) == 3
+
+
+def test_vm_registering_within_its_grace_survives():
+    group = Group(3, ORPHAN_GRACE_MINUTES="15")
+    booting = group.add_vm(register=False)
+
+    group.tick_at(0)
+    group.runner_group.register(booting)
+    group.tick_at(15)
+
+    assert booting in group.scale_group.vms
+
+
+def test_runner_without_vm_is_deregistered_after_its_grace():
+    group = Group(3, GHOST_GRACE_MINUTES="5")
+    ghost = group.runner_group.register("gone")
+
+    group.tick_at(0)
+    group.tick_at(4)
+    assert ghost.runner_id in group.runner_group.runners
+
+    group.tick_at(5)
+    assert ghost.runner_id not in group.runner_group.runners
+    assert len(group.scale_group.vms) == 3
+
+
+@pytest.mark.parametrize("minutes", [60, 24 * 60])
+def test_ghosts_and_orphans_are_left_alone_by_default(minutes):
+    group = Group(3, MIN_RUNNERS=4)
+    ghost = group.runner_group.register("gone")
+    orphan = group.add_vm(register=False)
+
+    group.tick_at(0)
+    group.tick_at(minutes)
+
+    assert ghost.runner_id in group.runner_group.runners
+    assert orphan in group.scale_group.vms
+    assert group.scale_group.calls["terminate"] == 0
+
+
+def test_nothing_is_cleaned_up_when_no_runner_matches():
+    group = Group(
+        0, MIN_RUNNERS=3, GHOST_GRACE_MINUTES="5", ORPHAN_GRACE_MINUTES="15"
+    )
+    # the runners register under names the join does not index
+    for index in range(3):
+        group.add_vm(register=False)
+        group.runner_group.register(f"unindexed-{index}")
+    vms = set(group.scale_group.vms)
+
+    group.tick_at(0)
+    group.tick_at(60)
+
+    assert set(group.scale_group.vms) == vms
+    assert len(group.runner_group.runners) == 3
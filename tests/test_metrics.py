@@ -0,0 +1,116 @@
+import json
+
+import pytest
+
+import metrics
+from metrics import TickMetrics
+
+
+@pytest.fixture
+def tick() -> TickMetrics:
+    tick = TickMetrics({"runner_group": "acme/linux"})
+    tick.timestamp = 1767600000.5
+    tick.record_span("api_call", 0.25, True, service="asg")
+    tick.record_span("api_call", 0.5, False, service="asg")
+    tick.increment("runners_drained", 2)
+    tick.gauge("queued_jobs", 7)
+    return tick
+
+
+def test_recording_outside_of_a_tick_does_nothing():
+    metrics.increment("runners_drained")
+    assert metrics.current() is None
+
+
+def test_recording_into_the_active_tick(tick):
+    token = metrics.activate(tick)
+    try:
+        metrics.increment("runners_drained")
+        with metrics.span("api_call", service="asg"):
+            pass
+    finally:
+        metrics.deactivate(token)
+
+    document = tick.as_dict()
+    assert document["counters"]["runners_drained"] == 3
+    assert document["spans"]["api_call{service=asg}"]["count"] == 3
+
+
+def test_json(tick):
+    document = json.loads(metrics.format_json(tick))["metrics"]
+    assert document["labels"] == {"runner_group": "acme/linux"}
+    assert document["spans"]["api_call{service=asg}"] == {
+        "count": 2,
+        "errors": 1,
+        "total_seconds": 0.75,
+        "max_seconds": 0.5,
+    }
+    assert document["gauges"] == {"queued_jobs": 7}
+
+
+def test_emf(tick):
+    document = json.loads(metrics.format_emf(tick, "Autoscaler"))
+    [directive] = document["_aws"]["CloudWatchMetrics"]
+    assert document["_aws"]["Timestamp"] == 1767600000500
+    assert directive["Namespace"] == "Autoscaler"
+    # the tick labels are the dimensions and values of the document
+    assert directive["Dimensions"] == [["runner_group"]]
+    assert document["runner_group"] == "acme/linux"
+    # other labels are folded into the metric name
+    assert document["api_call.asg.count"] == 2
+    assert document["api_call.asg.errors"] == 1
+    assert document["api_call.asg.duration"] == 750
+    assert document["api_call.asg.max"] == 500
+    assert document["runners_drained"] == 2
+    assert document["queued_jobs"] == 7
+    units = {metric["Name"]: metric["Unit"] for metric in directive["Metrics"]}
+    assert units["api_call.asg.duration"] == "Milliseconds"
+    assert units["runners_drained"] == "Count"
+
+
+def test_emf_splits_directives_at_100_metrics():
+    tick = TickMetrics()
+    for index in range(150):
+        tick.gauge(f"gauge_{index}", index)
+    document = json.loads(metrics.format_emf(tick, "Autoscaler"))
+    directives = document["_aws"]["CloudWatchMetrics"]
+    assert [len(directive["Metrics"]) for directive in directives] == [
+        100,
+        50,
+    ]
+
+
+def test_openmetrics(tick):
+    text = metrics.format_openmetrics(tick, "sg")
+    lines = text.splitlines()
+    labels = '{runner_group="acme/linux",service="asg"}'
+    assert "# TYPE sg_api_call_count gauge" in lines
+    assert f"sg_api_call_count{labels} 2" in lines
+    assert f"sg_api_call_seconds{labels} 0.75" in lines
+    assert 'sg_queued_jobs{runner_group="acme/linux"} 7' in lines
+    timestamp = '{runner_group="acme/linux"} 1767600000.5'
+    assert f"sg_last_tick_timestamp_seconds{timestamp}" in lines
+    assert lines[-1] == "# EOF"
+    # every metric family has a single TYPE line
+    types = [line for line in lines if line.startswith("# TYPE")]
+    assert len(types) == len(set(types))
+
+
+def test_openmetrics_escapes_label_values():
+    tick = TickMetrics({"runner_group": 'say "hi"\\\n'})
+    tick.gauge("queued-jobs", 1)
+    lines = metrics.format_openmetrics(tick, "sg").splitlines()
+    assert 'sg_queued_jobs{runner_group="say \\"hi\\"\\\\\\n"} 1' in lines
+
+
+def test_export_replaces_the_file(tick, tmp_path):
+    path = tmp_path / "metrics.prom"
+    path.write_text("stale")
+    metrics.export(tick, "openmetrics", path=str(path))
+    assert path.read_text().endswith("# EOF\n")
+    assert [entry.name for entry in tmp_path.iterdir()] == ["metrics.prom"]
+
+
+def test_unknown_format(tick):
+    with pytest.raises(ValueError):
+        metrics.export(tick, "statsd")
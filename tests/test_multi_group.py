@@ -0,0 +1,105 @@
+import json
+
+import pytest
+
+from multi_group import RunnerGroupBinding, load_config
+
+
+def test_settings_override_the_defaults_with_the_policy(monkeypatch):
+    monkeypatch.delenv("METRICS_FILE", raising=False)
+    binding = RunnerGroupBinding(
+        "acme",
+        "linux",
+        "aws",
+        scale_group="asg-linux",
+        policy={"SCALE_OUT_STEP": 3},
+    )
+    settings = binding.settings({"SCALE_OUT_STEP": 2, "SCALE_IN_STEP": 1})
+
+    assert settings["SCALE_OUT_STEP"] == "3"
+    assert settings["SCALE_IN_STEP"] == "1"
+    assert settings["SG_ORG"] == "acme"
+    assert settings["SG_RUNNER_GROUP"] == "linux"
+    assert settings["AWS_ASG_NAME"] == "asg-linux"
+    # groups sharing a bucket keep their state apart
+    assert settings["AUTOSCALER_STATE_BLOB_NAME"] == (
+        "acme/linux/stackguardian-autoscaler-state.json"
+    )
+    assert "METRICS_FILE" not in settings
+
+
+def test_pools_are_passed_as_json():
+    pools = [{"name": "spot", "scale_group": "vmss-spot"}]
+    binding = RunnerGroupBinding("acme", "linux", "azure", pools=pools)
+    settings = binding.settings({})
+    assert json.loads(settings["SCALE_POOLS"]) == pools
+    assert "AZURE_VMSS_NAME" not in settings
+
+
+@pytest.mark.parametrize(
+    "defaults, environment, metrics_file",
+    [
+        (
+            {"METRICS_FILE": "/metrics/out.prom"},
+            None,
+            "/metrics/out.acme.linux.prom",
+        ),
+        ({}, "/metrics/out.json", "/metrics/out.acme.linux.json"),
+    ],
+)
+def test_every_group_gets_a_metrics_file_of_its_own(
+    monkeypatch, defaults, environment, metrics_file
+):
+    if environment is None:
+        monkeypatch.delenv("METRICS_FILE", raising=False)
+    else:
+        monkeypatch.setenv("METRICS_FILE", environment)
+    binding = RunnerGroupBinding("acme", "linux", "aws", scale_group="asg")
+    assert binding.settings(defaults)["METRICS_FILE"] == metrics_file
+
+
+def test_metrics_file_of_the_policy_is_kept():
+    binding = RunnerGroupBinding(
+        "acme",
+        "linux",
+        "aws",
+        scale_group="asg",
+        policy={"METRICS_FILE": "/metrics/linux.prom"},
+    )
+    settings = binding.settings({"METRICS_FILE": "/metrics/out.prom"})
+    assert settings["METRICS_FILE"] == "/metrics/linux.prom"
+
+
+@pytest.mark.parametrize(
+    "cloud, scale_group, pools",
+    [("gcp", "mig", None), ("aws", None, None), ("aws", "asg", [{}])],
+)
+def test_invalid_bindings(cloud, scale_group, pools):
+    with pytest.raises(ValueError):
+        RunnerGroupBinding(
+            "acme", "linux", cloud, scale_group=scale_group, pools=pools
+        )
+
+
+def test_load_config(tmp_path):
+    path = tmp_path / "groups.json"
+    path.write_text(
+        json.dumps(
+            {
+                "defaults": {"SCALE_OUT_STEP": 2},
+                "bindings": [
+                    {
+                        "org": "acme",
+                        "runner_group": "linux",
+                        "cloud": "aws",
+                        "scale_group": "asg",
+                        "policy": {"SCALE_OUT_THRESHOLD": 3},
+                    }
+                ],
+            }
+        )
+    )
+    [binding], defaults = load_config(str(path))
+    assert binding.name == "acme/linux"
+    assert binding.policy == {"SCALE_OUT_THRESHOLD": 3}
+    assert defaults == {"SCALE_OUT_STEP": 2}
@@ -0,0 +1,114 @@
+from datetime import timedelta
+
+import pytest
+
+from multi_pool import ScalePool, _cheapest_cover, plan_placement
+from simulator.engine import Simulation
+from simulator.traces import JobSpec
+
+
+def pool(name, hourly_cost, runner_concurrency=1, **kwargs):
+    return ScalePool(name, None, hourly_cost, runner_concurrency, **kwargs)
+
+
+SMALL = pool("small", 1.0)
+LARGE = pool("large", 3.0, runner_concurrency=4)
+
+
+@pytest.mark.parametrize(
+    "slots, expected",
+    [
+        (1, {"small": 1}),
+        # 3 small VM's cost as much as a large one, fewer VM's win the tie
+        (3, {"large": 1}),
+        (4, {"large": 1}),
+        (5, {"large": 1, "small": 1}),
+        (8, {"large": 2}),
+        (9, {"large": 2, "small": 1}),
+    ],
+)
+def test_cheapest_cover(slots, expected):
+    headroom = {"small": None, "large": None}
+    assert _cheapest_cover([SMALL, LARGE], slots, headroom) == expected
+
+
+def test_cheapest_cover_keeps_to_headroom():
+    headroom = {"small": None, "large": 1}
+    placement = _cheapest_cover([SMALL, LARGE], 9, headroom)
+    assert placement == {"large": 1, "small": 5}
+
+
+def test_cheapest_cover_covers_at_least_the_slots():
+    # a large VM covers 2 slots for less than 2 small ones
+    large = pool("large", 1.5, runner_concurrency=4)
+    placement = _cheapest_cover([SMALL, large], 2, {"small": 5, "large": 5})
+    assert placement == {"large": 1}
+
+
+def test_placement_prefers_spot():
+    spot = pool("spot", 2.0, spot=True)
+    on_demand = pool("on-demand", 1.0)
+    headroom = {"spot": None, "on-demand": None}
+    assert plan_placement([on_demand, spot], 3, headroom) == {"spot": 3}
+
+
+def test_placement_spills_over_to_the_next_tier():
+    spot = pool("spot", 2.0, spot=True)
+    on_demand = pool("on-demand", 1.0)
+    headroom = {"spot": 2, "on-demand": None}
+    placement = plan_placement([on_demand, spot], 5, headroom)
+    assert placement == {"spot": 2, "on-demand": 3}
+
+
+def test_placement_prefers_pools_booting_in_time():
+    fast = pool("fast", 2.0, boot_seconds=60)
+    slow = pool("slow", 1.0, boot_seconds=600)
+    headroom = {"fast": None, "slow": None}
+    assert plan_placement([slow, fast], 2, headroom, 300) == {"fast": 2}
+    # without a target wait the cheapest pool wins
+    assert plan_placement([slow, fast], 2, headroom) == {"slow": 2}
+
+
+def test_placement_skips_pools_without_headroom():
+    spot = pool("spot", 1.0, spot=True)
+    on_demand = pool("on-demand", 2.0)
+    # no headroom for spot, e.g. backing off after a capacity error, and
+    # pools missing from headroom are not used
+    assert plan_placement([spot, on_demand], 2, {"spot": 0}) == {}
+    placement = plan_placement(
+        [spot, on_demand], 2, {"spot": 0, "on-demand": None}
+    )
+    assert placement == {"on-demand": 2}
+
+
+def test_placement_beyond_all_headroom():
+    headroom = {"small": 1, "large": 1}
+    placement = plan_placement([SMALL, LARGE], 20, headroom)
+    assert placement == {"small": 1, "large": 1}
+
+
+def test_placement_of_no_slots():
+    assert plan_placement([SMALL], 0, {"small": None}) == {}
+
+
+def test_simulated_spot_shortage_falls_back_to_on_demand():
+    pools = [
+        {"name": "spot", "hourly_cost": 0.02, "spot": True, "capacity": 2},
+        {"name": "od", "hourly_cost": 0.05},
+    ]
+    trace = [JobSpec(0, 20 * 60)] * 6
+    simulation = Simulation(
+        trace,
+        settings={"SCALING_MODE": "target"},
+        pools=pools,
+        duration=timedelta(hours=2),
+    )
+    report = simulation.run()
+
+    assert report.jobs_finished == 6
+    assert report.tick_errors == 0
+    assert max(report.capacity) == 6
+    # the 4 slots spot could not cover were placed on on-demand
+    spot, on_demand = simulation.scale_groups
+    assert spot.calls["set_capacity"] > 0
+    assert on_demand.calls["set_capacity"] > 0
@@ -0,0 +1,125 @@
+import time
+
+import pytest
+
+import rate_limit
+from rate_limit import DeferredError, ThrottledError, TokenBucket
+from tests.harness import Group
+
+
+@pytest.fixture
+def buckets(monkeypatch):
+    """Fresh buckets, the process wide ones are shared by all tests"""
+    monkeypatch.setattr(rate_limit, "_buckets", {})
+    return rate_limit._buckets
+
+
+def test_acquire_takes_the_burst_without_waiting():
+    bucket = TokenBucket(rate=1, burst=3)
+    started = time.monotonic()
+    assert all(bucket.acquire() for _ in range(3))
+    assert time.monotonic() - started < 0.5
+
+
+def test_acquire_refuses_past_the_deadline():
+    bucket = TokenBucket(rate=1, burst=1)
+    assert bucket.acquire()
+
+    started = time.monotonic()
+    # the next token comes in a second
+    assert not bucket.acquire(deadline=started + 0.5)
+    # without waiting for it
+    assert time.monotonic() - started < 0.1
+
+
+def test_acquire_waits_within_the_deadline():
+    bucket = TokenBucket(rate=50, burst=1)
+    assert bucket.acquire()
+    assert bucket.acquire(deadline=time.monotonic() + 1)
+
+
+def test_throttled_halves_the_rate_down_to_a_floor():
+    bucket = TokenBucket(rate=10, burst=20)
+    bucket.throttled()
+    assert bucket.rate == 5
+    # no burst right after being throttled
+    assert bucket.tokens <= 0
+    for _ in range(10):
+        bucket.throttled()
+    assert bucket.rate == bucket.min_rate == 0.5
+
+
+def test_succeeded_grows_the_rate_back_up_to_the_maximum():
+    bucket = TokenBucket(rate=10, burst=20)
+    bucket.throttled()
+    bucket.succeeded()
+    assert bucket.rate == pytest.approx(5.5)
+    for _ in range(20):
+        bucket.succeeded()
+    assert bucket.rate == 10
+
+
+def test_rate_from_the_environment(buckets, monkeypatch):
+    monkeypatch.setenv("RATE_LIMIT_SG", "2")
+    bucket = rate_limit.get_bucket("sg")
+    assert (bucket.rate, bucket.burst) == (2, 4)
+    assert rate_limit.get_bucket("asg").rate == rate_limit.DEFAULT_RATES["asg"]
+
+
+def test_throttled_and_succeeded_by_api(buckets):
+    rate_limit.throttled("sg")
+    assert rate_limit.get_bucket("sg").rate == 5
+    rate_limit.succeeded("sg")
+    assert rate_limit.get_bucket("sg").rate == 5.5
+    assert rate_limit.get_bucket("asg").rate == 5
+
+
+def test_tick_budget_defers_calls_past_it(buckets):
+    buckets["sg"] = TokenBucket(rate=1, burst=1)
+    with rate_limit.tick_budget(0.5):
+        rate_limit.acquire("sg")
+        with pytest.raises(DeferredError):
+            rate_limit.acquire("sg")
+
+
+def test_no_budget_outside_of_a_tick():
+    assert rate_limit.remaining() is None
+    with rate_limit.tick_budget(None):
+        assert rate_limit.remaining() is None
+    with rate_limit.tick_budget(30):
+        assert 29 < rate_limit.remaining() <= 30
+    assert rate_limit.remaining() is None
+
+
+def test_sleep_past_the_budget_is_deferred():
+    with rate_limit.tick_budget(0.5):
+        with pytest.raises(DeferredError):
+            rate_limit.sleep(1)
+        rate_limit.sleep(0)
+
+
+def test_throttled_error_is_deferred():
+    assert issubclass(ThrottledError, DeferredError)
+
+
+def test_deferred_scale_out_keeps_the_reactivations_cooldown(monkeypatch):
+    group = Group(2, SCALE_OUT_STEP=2)
+    draining = group.runner_on(next(iter(group.scale_group.vms)))
+    draining.status = "DRAINING"
+    group.enqueue(3)
+
+    def deferred(count_of_vms):
+        raise DeferredError("No time left in the tick for an asg call")
+
+    monkeypatch.setattr(group.scale_group, "set_autoscale_vms", deferred)
+    group.tick_at(0)
+
+    assert draining.status == "ACTIVE"
+    state = group.scale_group.state_store.get()
+    assert state.last_scale_out_event == group.clock.now()
+
+    # the next tick within the cooldown does not reactivate again
+    draining.status = "DRAINING"
+    group.runner_group.calls.clear()
+    group.tick_at(1)
+    assert group.runner_group.calls["update_runner_status"] == 0
@@ -0,0 +1,220 @@
+import json
+from datetime import date, datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+import pytest
+
+from schedule import CapacitySchedule, CronExpression, load_schedule
+from simulator.engine import Simulation
+
+OFFICE_HOURS = {
+    "name": "office-hours",
+    "cron": "0 8 * * 1-5",
+    "duration_minutes": 600,
+    "min_runners": 5,
+    "max_runners": 40,
+}
+
+
+def utc(*when) -> datetime:
+    return datetime(*when, tzinfo=timezone.utc)
+
+
+def limits(config, now, min_runners=0, max_runners=None):
+    schedule = CapacitySchedule({"timezone": "UTC", **config})
+    return schedule.limits(now, min_runners, max_runners)
+
+
+@pytest.mark.parametrize(
+    "field, expected",
+    [
+        ("*/15", {0, 15, 30, 45}),
+        ("5/20", {5, 25, 45}),
+        ("1-3,10", {1, 2, 3, 10}),
+        ("10-20/5", {10, 15, 20}),
+    ],
+)
+def test_cron_minute_field(field, expected):
+    assert CronExpression(f"{field} * * * *").minutes == expected
+
+
+@pytest.mark.parametrize(
+    "expression", ["60 * * * *", "* 24 * * *", "* * 0 * *", "5-1 * * * *"]
+)
+def test_cron_out_of_range(expression):
+    with pytest.raises(ValueError):
+        CronExpression(expression)
+
+
+def test_cron_needs_five_fields():
+    with pytest.raises(ValueError):
+        CronExpression("0 8 * *")
+
+
+def test_cron_sunday_is_0_and_7():
+    sunday = date(2026, 3, 1)
+    assert CronExpression("0 0 * * 0").matches_day(sunday)
+    assert CronExpression("0 0 * * 7").matches_day(sunday)
+    assert not CronExpression("0 0 * * 1-5").matches_day(sunday)
+
+
+def test_cron_day_of_month_or_day_of_week():
+    # like cron, the 15th or any Monday when both are restricted
+    cron = CronExpression("0 0 15 * 1")
+    assert cron.matches_day(date(2026, 1, 15))  # a Thursday
+    assert cron.matches_day(date(2026, 1, 5))  # a Monday
+    assert not cron.matches_day(date(2026, 1, 6))
+    # only the 15th when the day of week is not restricted
+    cron = CronExpression("0 0 15 * *")
+    assert not cron.matches_day(date(2026, 1, 5))
+
+
+def test_cron_month():
+    cron = CronExpression("0 0 * 12 *")
+    assert cron.matches_day(date(2026, 12, 1))
+    assert not cron.matches_day(date(2026, 11, 30))
+
+
+@pytest.mark.parametrize(
+    "hour, minute, applies",
+    [
+        (7, 59, False),
+        (8, 0, True),
+        (17, 59, True),
+        # the window lasts duration_minutes after its start, not including
+        # the end
+        (18, 0, False),
+    ],
+)
+def test_window_edges(hour, minute, applies):
+    # Monday
+    result = limits({"windows": [OFFICE_HOURS]}, utc(2026, 1, 5, hour, minute))
+    assert (result.windows == ["office-hours"]) is applies
+
+
+def test_window_day_of_week():
+    # Saturday
+    result = limits({"windows": [OFFICE_HOURS]}, utc(2026, 1, 10, 12, 0))
+    assert result.windows == []
+
+
+def test_window_past_midnight_applies_the_next_day():
+    window = {"cron": "0 22 * * 5", "duration_minutes": 240, "min_runners": 3}
+    # Friday 22:00 until Saturday 02:00
+    config = {"windows": [window]}
+    assert limits(config, utc(2026, 1, 10, 1, 59)).min_runners == 3
+    assert limits(config, utc(2026, 1, 10, 2, 0)).min_runners == 0
+
+
+def test_prewarm():
+    config = {"prewarm_minutes": 15, "windows": [OFFICE_HOURS]}
+    assert limits(config, utc(2026, 1, 5, 7, 44)).windows == []
+    assert limits(config, utc(2026, 1, 5, 7, 45)).windows == ["office-hours"]
+
+
+def test_window_prewarm_overrides_the_schedule():
+    window = {**OFFICE_HOURS, "prewarm_minutes": 30}
+    config = {"prewarm_minutes": 15, "windows": [window]}
+    assert limits(config, utc(2026, 1, 5, 7, 30)).windows == ["office-hours"]
+
+
+def test_holidays():
+    nightly = {
+        "name": "nightly",
+        "cron": "0 1 * * *",
+        "duration_minutes": 60,
+        "min_runners": 2,
+    }
+    config = {
+        "holidays": ["2026-12-24"],
+        "windows": [
+            OFFICE_HOURS,
+            {**nightly, "holidays": "include"},
+            {
+                "name": "holiday-support",
+                "cron": "0 9 * * *",
+                "duration_minutes": 60,
+                "min_runners": 1,
+                "holidays": "only",
+            },
+        ],
+    }
+    # Thursday 24 December
+    assert limits(config, utc(2026, 12, 24, 9, 30)).windows == [
+        "holiday-support"
+    ]
+    assert limits(config, utc(2026, 12, 24, 1, 30)).windows == ["nightly"]
+    assert limits(config, utc(2026, 12, 23, 9, 30)).windows == ["office-hours"]
+
+
+def test_bad_holiday_mode():
+    with pytest.raises(ValueError):
+        CapacitySchedule({"windows": [{**OFFICE_HOURS, "holidays": "never"}]})
+
+
+def test_limits_outside_of_windows():
+    result = limits(
+        {"windows": [OFFICE_HOURS]},
+        utc(2026, 1, 5, 20, 0),
+        min_runners=1,
+        max_runners=10,
+    )
+    assert result == (1, 10, [])
+
+
+def test_overlapping_windows_take_the_highest_limits():
+    release = {
+        "name": "release",
+        "cron": "0 12 * * *",
+        "duration_minutes": 60,
+        "min_runners": 10,
+    }
+    result = limits(
+        {"windows": [OFFICE_HOURS, release]},
+        utc(2026, 1, 5, 12, 30),
+        max_runners=20,
+    )
+    assert result.min_runners == 10
+    assert result.max_runners == 40
+    assert result.windows == ["office-hours", "release"]
+
+
+def test_floor_wins_over_a_ceiling_it_does_not_set():
+    window = {"cron": "0 8 * * *", "duration_minutes": 60, "min_runners": 8}
+    result = limits(
+        {"windows": [window]}, utc(2026, 1, 5, 8, 0), max_runners=5
+    )
+    assert result.min_runners == 8
+    assert result.max_runners == 8
+
+
+def test_timezone():
+    schedule = CapacitySchedule(
+        {"timezone": "Europe/Berlin", "windows": [OFFICE_HOURS]}
+    )
+    # 08:00 in Berlin is 07:00 UTC in winter
+    assert schedule.limits(utc(2026, 1, 5, 7, 0)).windows
+    assert not schedule.limits(utc(2026, 1, 5, 6, 59)).windows
+    berlin = datetime(2026, 1, 5, 8, 0, tzinfo=ZoneInfo("Europe/Berlin"))
+    assert schedule.limits(berlin).windows
+
+
+def test_load_schedule(tmp_path):
+    assert load_schedule("") is None
+    assert len(load_schedule('{"windows": []}').windows) == 0
+    path = tmp_path / "schedule.json"
+    path.write_text('{"holidays": ["2026-12-24"]}')
+    assert load_schedule(str(path)).holidays == {date(2026, 12, 24)}
+
+
+def test_floor_counts_booting_vms():
+    window = {"cron": "0 0 * * *", "duration_minutes": 120, "min_runners": 5}
+    report = Simulation(
+        [],
+        settings={"CAPACITY_SCHEDULE": json.dumps({"windows": [window]})},
+        boot_delay=timedelta(minutes=15),
+        duration=timedelta(hours=3),
+    ).run()
+
+    assert max(report.capacity) == 5
+    assert report.capacity[-1] == 0
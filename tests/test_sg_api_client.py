@@ -0,0 +1,176 @@
+import io
+import json
+import logging
+import sys
+
+import pytest
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+import sg_api_client
+from sg_api_client import SGApiClient, iter_runner_group
+
+RUNNERS = [
+    {
+        "RunnerId": "runner-1",
+        "Status": "ACTIVE",
+        "RunningWorkflowsCount": 2,
+        "LoadAverage": 0.5,
+        # nested maps and lists are kept whole
+        "Metadata": {"Tags": {"pool": "spot"}, "Labels": ["a", "b"]},
+        "LastHeartbeat": None,
+    },
+    {"RunnerId": "runner-2", "Status": "DRAINING", "Metadata": {}},
+]
+
+
+def runner_group(msg) -> io.BytesIO:
+    return io.BytesIO(json.dumps({"msg": msg}).encode())
+
+
+@pytest.fixture(params=["ijson", "json"])
+def parser(request, monkeypatch):
+    """Runs a test with and without ijson installed"""
+    if request.param == "json":
+        # None in sys.modules makes the import raise ImportError
+        monkeypatch.setitem(sys.modules, "ijson", None)
+        monkeypatch.setattr(sg_api_client, "_json_fallback_logged", False)
+    return request.param
+
+
+def test_runners_and_queued_workflows(parser):
+    msg = {
+        "Name": "group",
+        "QueuedWorkflowsCount": 4,
+        "ContainerInstances": RUNNERS,
+    }
+    events = list(iter_runner_group(runner_group(msg)))
+    assert events == [
+        ("QueuedWorkflowsCount", 4),
+        ("runner", RUNNERS[0]),
+        ("runner", RUNNERS[1]),
+    ]
+
+
+def test_floats_are_not_decimals(parser):
+    msg = {"ContainerInstances": [{"LoadAverage": 0.25}]}
+    [(_, runner)] = iter_runner_group(runner_group(msg))
+    assert type(runner["LoadAverage"]) is float
+
+
+@pytest.mark.parametrize("instances", [None, []])
+def test_no_runners(parser, instances):
+    msg = {"QueuedWorkflowsCount": 0, "ContainerInstances": instances}
+    events = list(iter_runner_group(runner_group(msg)))
+    assert events == [("QueuedWorkflowsCount", 0)]
+
+
+def test_empty_msg(parser):
+    assert list(iter_runner_group(runner_group(None))) == []
+
+
+def test_fallback_is_logged_once(monkeypatch, caplog):
+    monkeypatch.setitem(sys.modules, "ijson", None)
+    monkeypatch.setattr(sg_api_client, "_json_fallback_logged", False)
+    with caplog.at_level(logging.WARNING):
+        list(iter_runner_group(runner_group({})))
+        list(iter_runner_group(runner_group({})))
+    assert caplog.text.count("ijson is not installed") == 1
+
+
+def test_ijson_does_not_log(caplog):
+    with caplog.at_level(logging.WARNING):
+        list(iter_runner_group(runner_group({})))
+    assert "ijson" not in caplog.text
+
+
+def response(status_code: int) -> requests.Response:
+    res = requests.Response()
+    res.status_code = status_code
+    res.raw = io.BytesIO(b"{}")
+    return res
+
+
+def refused() -> requests.ConnectionError:
+    reason = NewConnectionError(None, "Connection refused")
+    return requests.ConnectionError(MaxRetryError(None, "/", reason))
+
+
+@pytest.fixture
+def client():
+    return SGApiClient("https://api.example.com", "key", backoff_base=0)
+
+
+def send(client, monkeypatch, *outcomes):
+    """
+    Answers the client's requests with outcomes in turn, responses or
+    exceptions, and returns how many requests were sent
+    """
+    outcomes = list(outcomes)
+    sent = []
+
+    def request(method, uri, **kwargs):
+        sent.append(method)
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    monkeypatch.setattr(client.session, "request", request)
+    return sent
+
+
+@pytest.mark.parametrize("status_code", [500, 502, 503, 504])
+def test_get_is_retried_on_5xx(client, monkeypatch, status_code):
+    sent = send(client, monkeypatch, response(status_code), response(200))
+    assert client._request("get", "GET", "/").status_code == 200
+    assert len(sent) == 2
+    assert client.get_stats()["get"]["retries"] == 1
+
+
+def test_get_is_retried_on_a_read_timeout(client, monkeypatch):
+    sent = send(client, monkeypatch, requests.ReadTimeout(), response(200))
+    client._request("get", "GET", "/")
+    assert len(sent) == 2
+
+
+def test_get_gives_up_after_max_retries(client, monkeypatch):
+    sent = send(client, monkeypatch, *[response(503)] * 4)
+    with pytest.raises(requests.HTTPError):
+        client._request("get", "GET", "/")
+    assert len(sent) == client.max_retries + 1
+
+
+@pytest.mark.parametrize("status_code", [500, 502, 503, 504])
+def test_post_is_not_retried_on_5xx(client, monkeypatch, status_code):
+    # the runner may have been deregistered already
+    sent = send(client, monkeypatch, response(status_code), response(200))
+    with pytest.raises(requests.HTTPError):
+        client.deregister_runner("org", "group", "runner-1")
+    assert len(sent) == 1
+
+
+def test_post_is_not_retried_on_a_read_timeout(client, monkeypatch):
+    sent = send(client, monkeypatch, requests.ReadTimeout(), response(200))
+    with pytest.raises(requests.ReadTimeout):
+        client.update_runner_status("org", "group", "runner-1", "DRAINING")
+    assert len(sent) == 1
+
+
+def test_post_is_not_retried_once_the_connection_dropped(client, monkeypatch):
+    dropped = requests.ConnectionError(ConnectionResetError())
+    sent = send(client, monkeypatch, dropped, response(200))
+    with pytest.raises(requests.ConnectionError):
+        client.deregister_runner("org", "group", "runner-1")
+    assert len(sent) == 1
+
+
+@pytest.mark.parametrize(
+    "failure",
+    [refused, requests.ConnectTimeout, lambda: response(429)],
+    ids=["refused", "connect-timeout", "throttled"],
+)
+def test_post_is_retried_when_not_acted_on(client, monkeypatch, failure):
+    sent = send(client, monkeypatch, failure(), response(200))
+    client.deregister_runner("org", "group", "runner-1")
+    assert sent == ["POST", "POST"]
@@ -0,0 +1,69 @@
+from datetime import timedelta
+
+from simulator.engine import Simulation, percentile
+from simulator.traces import JobSpec, burst_trace, poisson_trace
+
+
+def test_percentile_is_nearest_rank():
+    assert percentile([], 50) is None
+    assert percentile([4, 1, 3, 2], 50) == 2
+    assert percentile([4, 1, 3, 2], 95) == 4
+    assert percentile([4, 1, 3, 2], 100) == 4
+
+
+def test_runs_every_job_and_scales_back_in():
+    trace = poisson_trace(rate_per_minute=1, minutes=60, seed=1)
+    # step mode scales in by one runner per cooldown
+    report = Simulation(trace, duration=timedelta(hours=4)).run()
+
+    assert report.jobs == len(trace)
+    assert report.jobs_finished == len(trace)
+    assert report.jobs_never_started == 0
+    assert report.tick_errors == 0
+    assert report.capacity[-1] == 0
+
+
+def test_same_trace_gives_same_report():
+    trace = burst_trace(10, interval_minutes=30, minutes=120, seed=2)
+
+    first = Simulation(trace).run().as_dict()
+    second = Simulation(trace).run().as_dict()
+
+    assert first == second
+
+
+def test_step_mode_keeps_to_max_runners():
+    trace = [JobSpec(0, 30 * 60)] * 20
+    report = Simulation(
+        trace,
+        settings={"SCALE_OUT_STEP": 4, "MAX_RUNNERS": 6},
+        duration=timedelta(hours=3),
+    ).run()
+
+    assert report.jobs_finished == 20
+    assert max(report.capacity) == 6
+
+
+def test_target_mode_counts_booting_vms():
+    # VM's boot for longer than the cooldown, a tick that ignored them
+    # would keep adding capacity for the same queued jobs
+    trace = [JobSpec(0, 60 * 60)] * 20
+    report = Simulation(
+        trace,
+        settings={"SCALING_MODE": "target"},
+        boot_delay=timedelta(minutes=15),
+    ).run()
+
+    assert report.jobs_finished == 20
+    assert max(report.capacity) == 20
+
+
+def test_standby_vms_are_resumed_before_new_ones_launch():
+    trace = [JobSpec(10 * 60, 10 * 60)] * 3
+    settings = {"STANDBY_POOL_MIN": 3, "STANDBY_POOL_MAX": 3}
+
+    warm = Simulation(trace, settings=settings).run()
+    cold = Simulation(trace).run()
+
+    assert warm.standby_vm_minutes > 0
+    assert max(warm.queue_waits) < max(cold.queue_waits)
@@ -0,0 +1,103 @@
+import pytest
+
+from rate_limit import DeferredError
+from stackguardian_autoscaler import SGRunner, select_drain_candidates
+from tests.harness import Group
+
+
+@pytest.fixture
+def group():
+    group = Group(4)
+    group.autoscaler.refresh()
+    return group
+
+
+def test_a_failing_runner_does_not_abort_the_batch(group, monkeypatch):
+    runners = group.autoscaler.sg_runners
+    failing, deferred = runners[1].runnerID, runners[2].runnerID
+    update_runner_status = group.runner_group.update_runner_status
+
+    def update(org, runner_group, runner_id, status):
+        if runner_id == failing:
+            raise ConnectionError("reset by peer")
+        if runner_id == deferred:
+            raise DeferredError("out of budget")
+        update_runner_status(org, runner_group, runner_id, status)
+
+    monkeypatch.setattr(group.runner_group, "update_runner_status", update)
+    result = group.autoscaler._update_sg_runners_status(runners, "DRAINING")
+
+    assert result.succeeded == [runners[0], runners[3]]
+    assert [runner for runner, _ in result.failed] == [runners[1]]
+    assert isinstance(result.failed[0][1], ConnectionError)
+    assert result.deferred == [runners[2]]
+    assert len(result) == 2
+    # only the runners that were updated change in the snapshot
+    assert [runner.status for runner in runners] == [
+        "DRAINING",
+        "ACTIVE",
+        "ACTIVE",
+        "DRAINING",
+    ]
+    # a failed call may have been applied, the next step reads them again
+    assert group.autoscaler._snapshot_stale
+
+
+def test_deferred_runners_keep_the_snapshot(group, monkeypatch):
+    def update(org, runner_group, runner_id, status):
+        raise DeferredError("out of budget")
+
+    monkeypatch.setattr(group.runner_group, "update_runner_status", update)
+    runners = group.autoscaler.sg_runners
+    result = group.autoscaler._update_sg_runners_status(runners, "DRAINING")
+
+    assert result.deferred == runners
+    assert not group.autoscaler._snapshot_stale
+
+
+def runner(name, connected=True, running=0, started_at=None) -> SGRunner:
+    workflows = [] if started_at is None else [{"startedAt": started_at}]
+    return SGRunner(
+        {
+            "instanceDetails": [{"ComputerName": name}],
+            "agentConnected": connected,
+            "runningTasksCount": running,
+            "activeWorkflows": workflows,
+        }
+    )
+
+
+def names(sg_runners):
+    return [sg_runner.computer_name for sg_runner in sg_runners]
+
+
+def test_drain_candidates_disconnected_then_idle_then_oldest_busy():
+    runners = [
+        runner("busy-recent", running=1, started_at=1767600600),
+        runner("idle", running=0),
+        runner("busy-unknown", running=1),
+        # epoch milliseconds
+        runner("busy-oldest", running=2, started_at=1767600000000),
+        runner("disconnected", connected=False, running=1),
+    ]
+    assert names(select_drain_candidates(runners, 5)) == [
+        "disconnected",
+        "idle",
+        "busy-oldest",
+        "busy-recent",
+        "busy-unknown",
+    ]
+    assert names(select_drain_candidates(runners, 2)) == [
+        "disconnected",
+        "idle",
+    ]
+    assert select_drain_candidates(runners, 0) == []
+
+
+def test_drain_candidates_most_expensive_idle_runner_first():
+    runners = [runner("cheap"), runner("unknown"), runner("expensive")]
+    cost = {"cheap": 0.1, "expensive": 0.5}
+    candidates = select_drain_candidates(
+        runners, 3, lambda sg_runner: cost.get(sg_runner.computer_name)
+    )
+    assert names(candidates) == ["expensive", "cheap", "unknown"]
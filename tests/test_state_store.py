@@ -0,0 +1,275 @@
+import logging
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from simulator.fakes import MemoryStateStore
+from state_store import (
+    AutoscalerState,
+    Lease,
+    LeaseLostError,
+    StateConflictError,
+)
+
+EARLIER = datetime(2026, 1, 5, 8, 0, tzinfo=timezone.utc)
+LATER = EARLIER + timedelta(minutes=5)
+TTL = timedelta(minutes=1)
+
+
+def write_concurrently(store: MemoryStateStore, state: AutoscalerState):
+    """Writes the document like another invocation would"""
+    store.content = state.to_json()
+    store.version += 1
+
+
+@pytest.fixture
+def store():
+    return MemoryStateStore(Counter())
+
+
+@pytest.fixture
+def lease_store():
+    return MemoryStateStore(Counter())
+
+
+def test_round_trip():
+    state = AutoscalerState(
+        last_scale_out_event=EARLIER,
+        last_desired_capacity=3,
+        demand_history=[[1, 2]],
+        unhealthy_since={"vm:a": EARLIER.isoformat()},
+        capacity_gap_since=LATER,
+    )
+    copy = AutoscalerState.from_json(state.to_json())
+    assert copy.to_json() == state.to_json()
+    assert copy.capacity_gap_since == LATER
+
+
+def test_save_writes_only_changes(store):
+    store.save()
+    assert store.calls["state_write"] == 0
+    store.save(last_desired_capacity=2)
+    store.save()
+    assert store.calls["state_write"] == 1
+
+
+def test_get_reads_once_per_tick(store):
+    store.save(last_desired_capacity=2)
+    store.calls.clear()
+    store.invalidate()
+    store.get()
+    store.get()
+    assert store.calls["state_read"] == 1
+    # revalidated against the copy cached by the write
+    assert store.get().last_desired_capacity == 2
+
+
+def test_conflict_merges_the_latest_timestamps(store):
+    store.save(last_scale_out_event=EARLIER, last_desired_capacity=2)
+    write_concurrently(
+        store,
+        AutoscalerState(
+            last_scale_out_event=LATER,
+            last_scale_in_event=EARLIER,
+            last_desired_capacity=9,
+        ),
+    )
+
+    store.save(last_desired_capacity=3)
+
+    saved = AutoscalerState.from_json(store.content)
+    assert saved.last_scale_out_event == LATER
+    assert saved.last_scale_in_event == EARLIER
+    # everything else is ours
+    assert saved.last_desired_capacity == 3
+
+
+def test_conflict_keeps_the_other_writers_bookkeeping(store):
+    store.save(
+        deferred_terminations=["i-1"],
+        unhealthy_since={"ghost:a": LATER.isoformat()},
+        pools_unavailable_until={"spot": EARLIER.isoformat()},
+    )
+    write_concurrently(
+        store,
+        AutoscalerState(
+            deferred_terminations=["i-1", "i-2"],
+            unhealthy_since={
+                "ghost:a": EARLIER.isoformat(),
+                "orphan:b": LATER.isoformat(),
+            },
+            pools_unavailable_until={
+                "spot": LATER.isoformat(),
+                "large": EARLIER.isoformat(),
+            },
+            capacity_gap_since=LATER,
+        ),
+    )
+
+    store.save(deferred_terminations=["i-1", "i-3"])
+
+    saved = AutoscalerState.from_json(store.content)
+    assert saved.deferred_terminations == ["i-1", "i-2", "i-3"]
+    # first seen broken at the earliest, backed off until the latest
+    assert saved.unhealthy_since == {
+        "ghost:a": EARLIER.isoformat(),
+        "orphan:b": LATER.isoformat(),
+    }
+    assert saved.pools_unavailable_until == {
+        "spot": LATER.isoformat(),
+        "large": EARLIER.isoformat(),
+    }
+    assert saved.capacity_gap_since == LATER
+
+
+@pytest.mark.parametrize(
+    "ours, theirs, merged",
+    [
+        (None, None, None),
+        (EARLIER, None, EARLIER),
+        (None, LATER, LATER),
+        (LATER, EARLIER, EARLIER),
+    ],
+)
+def test_merge_takes_the_earliest_capacity_gap(ours, theirs, merged):
+    state = AutoscalerState(capacity_gap_since=ours).merge(
+        AutoscalerState(capacity_gap_since=theirs)
+    )
+    assert state.capacity_gap_since == merged
+
+
+def test_merge_compares_timestamps_across_offsets():
+    # 09:00+02:00 is earlier than 08:00 UTC
+    offset = datetime(2026, 1, 5, 9, 0, tzinfo=timezone(timedelta(hours=2)))
+    state = AutoscalerState(unhealthy_since={"ghost:a": EARLIER.isoformat()})
+    theirs = AutoscalerState(unhealthy_since={"ghost:a": offset.isoformat()})
+    merged = state.merge(theirs)
+    assert merged.unhealthy_since == {"ghost:a": offset.isoformat()}
+
+
+def test_conflict_on_every_attempt(store, monkeypatch):
+    store.save(last_desired_capacity=1)
+
+    def conflict(content, etag):
+        raise StateConflictError()
+
+    monkeypatch.setattr(store, "_write", conflict)
+    with pytest.raises(StateConflictError):
+        store.save(last_desired_capacity=2)
+
+
+def test_invalidate_warns_about_unsaved_changes(store, caplog):
+    store.update(last_desired_capacity=2)
+    with caplog.at_level(logging.WARNING):
+        store.invalidate()
+    assert "dropping unsaved changes" in caplog.text
+    assert store.get().last_desired_capacity is None
+
+
+def test_try_write_detached(store):
+    state, etag = store.load_detached()
+    state.last_event_trigger = EARLIER
+    assert store.try_write_detached(state, etag)
+    # the etag is stale now, another invocation claimed it first
+    state.last_event_trigger = LATER
+    assert not store.try_write_detached(state, etag)
+    saved = AutoscalerState.from_json(store.content)
+    assert saved.last_event_trigger == EARLIER
+
+
+def test_detached_write_after_a_tick_wrote(store):
+    state, etag = store.load_detached()
+    store.save(last_desired_capacity=2)
+
+    state.last_event_trigger = EARLIER
+    assert not store.try_write_detached(state, etag)
+    saved = AutoscalerState.from_json(store.content)
+    assert saved.last_desired_capacity == 2
+    assert saved.last_event_trigger is None
+
+
+def test_detached_read_and_write_keep_the_tick_state(store):
+    store.update(last_desired_capacity=2)
+
+    state, etag = store.load_detached()
+    assert state.last_desired_capacity is None
+    state.last_event_trigger = EARLIER
+    assert store.try_write_detached(state, etag)
+
+    # still unsaved, and merged with the detached write when saved
+    assert store.get().last_desired_capacity == 2
+    store.save()
+    saved = AutoscalerState.from_json(store.content)
+    assert saved.last_desired_capacity == 2
+    assert saved.last_event_trigger == EARLIER
+
+
+def test_lease_is_exclusive(store, lease_store):
+    first = Lease(store, lease_store, TTL)
+    second = Lease(store, lease_store, TTL)
+
+    assert first.acquire()
+    assert first.token == 1
+    assert not second.acquire()
+
+    first.release()
+    assert second.acquire()
+    assert second.token == 2
+    second.release()
+
+
+def test_lease_is_not_reentrant(store, lease_store):
+    # the timer and HTTP triggers of a function app share one lease
+    lease = Lease(store, lease_store, TTL)
+    assert lease.acquire()
+    assert not lease.acquire()
+    assert lease.token == 1
+
+    lease.release()
+    assert lease.token is None
+    assert lease.acquire()
+    assert lease.token == 2
+    lease.release()
+
+
+def test_lease_can_be_taken_once_expired(store, lease_store):
+    first = Lease(store, lease_store, TTL)
+    second = Lease(store, lease_store, TTL)
+    assert first.acquire()
+    first.fence()
+
+    second._now = lambda: datetime.now(timezone.utc) + 2 * TTL
+    assert second.acquire()
+
+    # the first holder finds out when renewing
+    first.renew()
+    with pytest.raises(LeaseLostError):
+        first.fence()
+    first.release()
+    second.release()
+
+
+def test_lost_lease_cannot_write_the_state(store, lease_store):
+    first = Lease(store, lease_store, TTL)
+    assert first.acquire()
+    store.get()
+
+    # another invocation takes over the expired lease and writes the state
+    second = Lease(MemoryStateStore(Counter()), lease_store, TTL)
+    second._now = lambda: datetime.now(timezone.utc) + 2 * TTL
+    assert second.acquire()
+    write_concurrently(store, AutoscalerState(lease_token=second.token))
+
+    with pytest.raises(LeaseLostError):
+        store.save(last_desired_capacity=5)
+    first.release()
+    second.release()
+
+
+def test_lease_token_survives_a_deleted_lease_document(store, lease_store):
+    store.save(lease_token=7)
+    lease = Lease(store, lease_store, TTL)
+    assert lease.acquire()
+    assert lease.token == 8
+    lease.release()